@@ -1,3 +1,5 @@
+import argparse
+
 import uvicorn
 
 from server.database import RedisConnection
@@ -7,13 +9,30 @@ from server.video_recorder.record_launcher import RecordManager
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recorder-only', action='store_true',
+                        help='Запустить только узел записи (без API и загрузки на диск)')
+    args = parser.parse_args()
+
     redis_db = RedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
 
-    yandex_disk = DiskConnection(token=CLOUD_ACCESS_TOKEN)
-    redis_db.reset_tasks()
+    # Индексы перестраивает только основной узел (с API)
+    if not args.recorder_only:
+        redis_db.rebuild_indexes()
+
+    # Таски других узлов записи не сбрасываются: освобождаются только таски с истекшей арендой
+    for key in redis_db.reap_expired_tasks():
+        redis_db.change_record_status(key, 'error')
 
     recorder = RecordManager()
 
+    if args.recorder_only:
+        recorder.start()
+        recorder.join()
+        return
+
+    yandex_disk = DiskConnection(token=CLOUD_ACCESS_TOKEN)
+
     recorder.start()
     yandex_disk.start()
 
@@ -0,0 +1,186 @@
+import time
+
+import redis.asyncio as aioredis
+
+from datetime import datetime
+
+from server.const import METRICS_GAUGE_TTL_SECONDS
+from server.database import METRICS_COUNTERS_KEY, METRICS_GAUGES_KEY, METRICS_GAUGES_UPDATED_KEY, \
+    RECORDS_VERSION_KEY, REGULAR_INDEX, VIDEOS_FROM_INDEX, VIDEOS_TO_INDEX, bump_records_version, decode_keys, \
+    decode_record, drop_stale_records, encode_record, index_record, name_index, record_names, unindex_record
+
+
+class AsyncRedisConnection:
+    """
+    Асинхронное подключение к базе данных Redis для обработчиков FastAPI (redis.asyncio, бывший aioredis).
+    Асинхронный аналог RedisConnection с пулом соединений. Набор ключей и индексов тот же, что и у RedisConnection.
+    Singleton.
+    """
+    connection = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls.connection is None:
+            cls.connection = super().__new__(cls)
+            cls.connection._r = None
+        return cls.connection
+
+    def __init__(self, host='127.0.0.1', port=6379, db_num=0, max_connections=50):
+        # Пул создается один раз, повторные вызовы конструктора возвращают то же подключение
+        if self._r is None:
+            pool = aioredis.ConnectionPool(host=host, port=port, db=db_num, max_connections=max_connections)
+            self._r = aioredis.Redis(connection_pool=pool)
+
+    async def close(self):
+        """
+        Закрытие пула соединений.
+        """
+        if self._r is not None:
+            await self._r.close()
+            await self._r.connection_pool.disconnect()
+            type(self).connection = None
+
+    async def add_records(self, records: dict[str, dict]):
+        """
+        Сохранение нескольких записей вместе с индексами одной транзакцией с удалением интервалов прежних версий
+        записей (см. RedisConnection.add_records).
+        :param records: Словарь "ключ записи -> информация о записи"
+        """
+        names = record_names(records)
+        async with self._r.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(*names)
+                    members = decode_keys(await pipe.sunion(*names))
+
+                    pipe.multi()
+                    drop_stale_records(pipe, records, members)
+                    for key, info in records.items():
+                        pipe.delete(key)
+                        pipe.hset(key, mapping=encode_record(info))
+                        index_record(pipe, key, info)
+                    bump_records_version(pipe)
+                    await pipe.execute()
+                    return
+                except aioredis.WatchError:
+                    continue
+
+    async def get_records(self, keys: list[str]) -> dict[str, dict]:
+        """
+        Получение нескольких записей за один запрос к серверу.
+        :param keys: Ключи записей
+        :return: Словарь "ключ записи -> информация о записи" (только для существующих записей)
+        """
+        if not keys:
+            return {}
+
+        async with self._r.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            results = await pipe.execute()
+        return {key: decode_record(fields) for key, fields in zip(keys, results) if fields}
+
+    async def get_versioned_records(self) -> tuple[int, dict]:
+        """
+        Получение версии списка записей (см. bump_records_version) и самих записей в json-friendly формате.
+        Версия читается до записей, поэтому изменения после ее чтения приведут к новой версии.
+        :return: Версия и словарь со всеми записями
+        """
+        async with self._r.pipeline(transaction=False) as pipe:
+            pipe.get(RECORDS_VERSION_KEY)
+            pipe.zrange(VIDEOS_FROM_INDEX, 0, -1)
+            pipe.smembers(REGULAR_INDEX)
+            version, videos, regular = await pipe.execute()
+            videos, regular = decode_keys(videos), decode_keys(regular)
+
+        records = await self.get_records(videos + regular)
+        return int(version or 0), {
+            'records': {rec: records[rec] for rec in videos if rec in records},
+            'regularRecords': {rec: records[rec] for rec in regular if rec in records},
+        }
+
+    async def get_all_records(self):
+        """
+        Получение отложенных и регулярных записей в json-friendly формате.
+        :return: Словарь со всеми записями
+        """
+        _, records = await self.get_versioned_records()
+        return records
+
+    async def get_active_records(self, now: datetime):
+        """
+        Получение еще не закончившихся отложенных записей и всех регулярных записей в json-friendly формате
+        (см. RedisConnection.get_unfinished_record_keys).
+        :param now: Текущий момент
+        :return: Словарь с записями
+        """
+        async with self._r.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(VIDEOS_TO_INDEX, f'({now.timestamp()}', '+inf')
+            pipe.smembers(REGULAR_INDEX)
+            videos, regular = (decode_keys(keys) for keys in await pipe.execute())
+
+        records = await self.get_records(videos + regular)
+        return {
+            'records': {rec: records[rec] for rec in videos if rec in records},
+            'regularRecords': {rec: records[rec] for rec in regular if rec in records},
+        }
+
+    async def delete_record(self, name: str):
+        """
+        Удаление записи по имени (всех ее интервалов).
+        :param name: Имя записи
+        """
+        keys = decode_keys(await self._r.smembers(name_index(name)))
+
+        async with self._r.pipeline() as pipe:
+            for key in keys:
+                pipe.delete(key, f'tasks:{key}')
+                unindex_record(pipe, key)
+            pipe.delete(name_index(name))
+            bump_records_version(pipe)
+            await pipe.execute()
+
+    async def get_metrics(self) -> tuple[dict[str, float], dict[str, float]]:
+        """
+        Получение метрик, отправленных процессами (см. RedisConnection.push_metrics).
+        Gauge-метрики, которые не обновлялись дольше METRICS_GAUGE_TTL_SECONDS (процесс завершился или умер),
+        удаляются.
+        :return: Счетчики и gauge-метрики
+        """
+        async with self._r.pipeline(transaction=False) as pipe:
+            pipe.hgetall(METRICS_COUNTERS_KEY)
+            pipe.hgetall(METRICS_GAUGES_KEY)
+            pipe.hgetall(METRICS_GAUGES_UPDATED_KEY)
+            counters, gauges, updated = await pipe.execute()
+
+        def decode(fields: dict) -> dict[str, float]:
+            return {key.decode('utf-8'): float(value) for key, value in fields.items()}
+
+        counters, gauges, updated = decode(counters), decode(gauges), decode(updated)
+        expired_before = time.time() - METRICS_GAUGE_TTL_SECONDS
+        if stale := [key for key in gauges if updated.get(key, 0) < expired_before]:
+            async with self._r.pipeline(transaction=False) as pipe:
+                pipe.hdel(METRICS_GAUGES_KEY, *stale)
+                pipe.hdel(METRICS_GAUGES_UPDATED_KEY, *stale)
+                await pipe.execute()
+            for key in stale:
+                del gauges[key]
+
+        return counters, gauges
+
+    async def subscribe(self, channel: str):
+        """
+        Subscribe-метод из Redis Publisher-Subscriber.
+        :param channel: Канал записи
+        :return: Объект подписки
+        """
+        p = self._r.pubsub()
+        await p.subscribe(channel)
+        return p
+
+    async def publish(self, channel: str, message: str):
+        """
+        Publish-метод из Redis Publisher-Subscriber.
+        :param channel: Канал записи
+        :param message: Сообщение
+        """
+        await self._r.publish(channel, message)
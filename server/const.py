@@ -2,7 +2,8 @@ VIDEO_EXTENSION = 'mkv'
 VIDEO_CODEC = 'h264'
 IMAGE_EXTENSIONS = ('.jpg', 'jpeg', 'png', 'tiff', 'bmp', 'webp')
 
-PUBSUB_VIDEO_CHANNEL_NAME = "video"
+PUBSUB_SCHEDULE_CHANNEL_NAME = "schedule"
+PUBSUB_RECORDS_CHANNEL_NAME = "records"
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 TIME_FORMAT = '%H-%M'
@@ -11,6 +12,83 @@ DEFAULT_SEGMENT_TIME = 60
 
 RECONNECT_DELAY_SECONDS = 10
 
+# Очередь кадров между захватом и кодированием в VideoRecorder ('drop_oldest' или 'drop_newest').
+# Размер очереди ограничен и количеством кадров, и памятью: кадр 1080p занимает ~6 МБ, поэтому при разрешении камеры
+# очередь уменьшается так, чтобы кадры в ней занимали не больше FRAME_QUEUE_MEMORY_MB (часть RECORDER_MEMORY_MB)
+FRAME_QUEUE_SIZE = 64
+FRAME_QUEUE_MEMORY_MB = 128
+FRAME_QUEUE_POLICY = 'drop_oldest'
+
+# Количество последних кадров записи в разделяемой памяти для других процессов (0 - не публиковать)
+FRAME_RING_SLOTS = 8
+
+# Общий пул кодировщиков на узел записи (0 - каждый процесс записи кодирует кадры сам).
+# При включенном пуле кольцевой буфер кадров записи содержит не меньше ENCODER_POOL_RING_SLOTS кадров:
+# это максимальное отставание воркера от записи, более старые кадры теряются (см. EncoderPool)
+ENCODER_POOL_SIZE = 0
+ENCODER_POOL_RING_SLOTS = 64
+
+# Запись с fpm не больше этого значения идет в режиме timelapse (по ключевым кадрам)
+TIMELAPSE_MAX_FPM = 12
+
+METRICS_FLUSH_INTERVAL_SECONDS = 5
+# Gauge-метрики, которые процесс не обновлял дольше этого времени, больше не отдаются
+METRICS_GAUGE_TTL_SECONDS = 60
+
+# Аренда тасок узлами записи (несколько RecordManager на разных машинах)
+LEASE_TTL_SECONDS = 30
+LEASE_HEARTBEAT_SECONDS = 10
+NODE_MAX_RECORDERS = 32
+
+# Бюджет узла записи (RecordSupervisor): записей на ядро, предельная средняя загрузка на ядро,
+# память, которая должна быть свободна для запуска еще одной записи (очередь кадров FRAME_QUEUE_MEMORY_MB,
+# кольцевой буфер FRAME_RING_SLOTS кадров и сам процесс)
+SUPERVISOR_RECORDERS_PER_CPU = 4
+SUPERVISOR_MAX_LOAD_PER_CPU = 1.5
+RECORDER_MEMORY_MB = 300
+
+# Перезапуск упавших процессов записи
+SUPERVISOR_RESTART_BACKOFF_SECONDS = 5
+SUPERVISOR_MAX_RESTART_BACKOFF_SECONDS = 300
+SUPERVISOR_MAX_RESTARTS = 10
+
+# Параллельная загрузка видео на диск: всего и в одну папку на диске
+UPLOAD_WORKERS = 4
+UPLOAD_WORKERS_PER_DESTINATION = 2
+
+# Очередь загрузки: количество попыток, задержка перед повторной попыткой (удваивается с каждой попыткой)
+# и время, после которого неподтвержденное сообщение умершего загрузчика забирает другой загрузчик
+# (живой загрузчик продлевает свои сообщения каждые UPLOAD_HEARTBEAT_SECONDS)
+UPLOAD_MAX_ATTEMPTS = 5
+UPLOAD_RETRY_BACKOFF_SECONDS = 30
+UPLOAD_MAX_RETRY_BACKOFF_SECONDS = 3600
+UPLOAD_CLAIM_IDLE_SECONDS = 60
+UPLOAD_HEARTBEAT_SECONDS = 15
+
+# Количество папок на диске, про которые загрузчик помнит, что они уже созданы
+UPLOAD_DIRECTORY_CACHE_SIZE = 1024
+
+# Хранилище для загрузки видео: адрес HTTP-хранилища с возобновляемой загрузкой (None - Яндекс Диск)
+# и размер части файла при загрузке по частям
+UPLOAD_STORAGE_URL = None
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Ограничение скорости загрузки по времени суток: (начало, конец в формате TIME_FORMAT, байт в секунду);
+# вне интервалов скорость не ограничена. Токены ограничителя копятся не больше UPLOAD_BANDWIDTH_BURST_SECONDS секунд.
+# Пример: [('09-00', '19-00', 2 * 1024 * 1024)] - не больше 2 МБ/с в рабочее время
+UPLOAD_BANDWIDTH_PROFILES: list[tuple[str, str, float]] = []
+UPLOAD_BANDWIDTH_BURST_SECONDS = 1
+
+# Приоритет загрузки по папкам записей (меньше - раньше), для остальных папок - UPLOAD_DEFAULT_PRIORITY.
+# У каждого приоритета своя очередь; загрузчик держит не больше UPLOAD_QUEUE_WINDOW видео и берет их из очередей
+# по порядку приоритетов
+UPLOAD_PRIORITIES: dict[str, int] = {}
+UPLOAD_DEFAULT_PRIORITY = 10
+UPLOAD_QUEUE_WINDOW = 64
+
+# Объем очереди загрузки оценивается по размеру UPLOAD_BACKLOG_SAMPLE_SIZE последних видео в очереди
+UPLOAD_BACKLOG_SAMPLE_SIZE = 32
+
 REDIS_SERVER = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0
@@ -1,9 +1,288 @@
 import json
+import os
+import time
+
+from collections import defaultdict
 
 import redis
 
+from datetime import datetime
 from typing import Literal
-from itertools import chain
+
+from server.const import DATE_FORMAT, PUBSUB_RECORDS_CHANNEL_NAME, LEASE_TTL_SECONDS, UPLOAD_CLAIM_IDLE_SECONDS, \
+    UPLOAD_PRIORITIES, UPLOAD_DEFAULT_PRIORITY
+from server.weekly_schedule import compile_regular_record
+
+
+TASKS_KEY = 'tasks'
+RECORDS_VERSION_KEY = 'records:version'
+METRICS_COUNTERS_KEY = 'metrics:counters'
+METRICS_GAUGES_KEY = 'metrics:gauges'
+METRICS_GAUGES_UPDATED_KEY = 'metrics:gauges:updated'
+NODES_KEY = 'nodes'
+LEASE_PREFIX = 'lease:'
+VIDEOS_FROM_INDEX = 'index:videos:from'
+VIDEOS_TO_INDEX = 'index:videos:to'
+REGULAR_INDEX = 'index:regular'
+UPLOADS_STREAM_PREFIX = 'uploads:priority:'
+UPLOADS_GROUP = 'uploaders'
+UPLOADS_RETRY_KEY = 'uploads:retry'
+UPLOADS_DEAD_KEY = 'uploads:dead'
+UPLOADS_CHECKPOINTS_KEY = 'uploads:checkpoints'
+
+
+def lease_key(key: str) -> str:
+    """
+    Ключ аренды (lease) таски записи. Значение - идентификатор узла, на котором идет запись.
+    Ключ живет LEASE_TTL_SECONDS и продлевается узлом, пока процесс записи жив.
+    :param key: Ключ записи
+    :return: Ключ аренды
+    """
+    return f'{LEASE_PREFIX}{key}'
+
+
+def name_index(name: str) -> str:
+    """
+    Ключ множества записей (ключей интервалов) с указанным именем.
+    :param name: Имя записи
+    :return: Ключ множества
+    """
+    return f'names:{name}'
+
+
+def _date_score(date_str: str) -> float:
+    return datetime.strptime(date_str, DATE_FORMAT).timestamp()
+
+
+def encode_record(info: dict) -> dict[str, str]:
+    """
+    Перевод записи в поля хэша Redis. Каждое значение хранится в json, чтобы сохранить типы (None, bool, list).
+    :param info: Информация о записи
+    :return: Поля хэша
+    """
+    return {field: json.dumps(value) for field, value in info.items()}
+
+
+def decode_record(fields: dict) -> dict:
+    """
+    Перевод полей хэша Redis в запись.
+    :param fields: Поля хэша
+    :return: Информация о записи
+    """
+    return {
+        (field.decode('utf-8') if isinstance(field, bytes) else field): json.loads(value)
+        for field, value in fields.items()
+    }
+
+
+def decode_keys(keys) -> list[str]:
+    """
+    Перевод ключей из ответа Redis в строки.
+    :param keys: Ключи (bytes или str)
+    :return: Список строк
+    """
+    return [k.decode('utf-8') if isinstance(k, bytes) else k for k in keys]
+
+
+def index_record(pipe, key: str, info: dict):
+    """
+    Добавление записи во вторичные индексы.
+    Подходит как для синхронного, так и для асинхронного pipeline.
+    :param pipe: Pipeline Redis
+    :param key: Ключ записи
+    :param info: Информация о записи
+    """
+    pipe.sadd(name_index(info['name']), key)
+    if key.startswith('videos:'):
+        pipe.zadd(VIDEOS_FROM_INDEX, {key: _date_score(info['date_from'])})
+        pipe.zadd(VIDEOS_TO_INDEX, {key: _date_score(info['date_to'])})
+    else:
+        pipe.sadd(REGULAR_INDEX, key)
+
+
+def unindex_record(pipe, key: str):
+    """
+    Удаление записи из вторичных индексов.
+    :param pipe: Pipeline Redis
+    :param key: Ключ записи
+    """
+    pipe.zrem(VIDEOS_FROM_INDEX, key)
+    pipe.zrem(VIDEOS_TO_INDEX, key)
+    pipe.srem(REGULAR_INDEX, key)
+    pipe.srem(TASKS_KEY, key)
+
+
+def record_names(records: dict[str, dict]) -> list[str]:
+    """
+    Ключи множеств имен (см. name_index) сохраняемых записей.
+    :param records: Словарь "ключ записи -> информация о записи"
+    """
+    return [name_index(name) for name in {info['name'] for info in records.values()}]
+
+
+def drop_stale_records(pipe, records: dict[str, dict], members: list[str]):
+    """
+    Удаление интервалов, оставшихся от прежней версии перезаписываемых записей: если у записи стало меньше
+    интервалов, ключи с большими номерами новыми записями не перезаписываются и иначе остались бы в БД и индексах.
+    Удаляются только интервалы того же типа (отложенные или регулярные), что и сохраняемые записи.
+    :param pipe: Pipeline Redis
+    :param records: Словарь "ключ записи -> информация о записи"
+    :param members: Ключи интервалов с именами сохраняемых записей (содержимое множеств record_names)
+    """
+    names = {key.rsplit(':', 1)[0]: info['name'] for key, info in records.items()}
+    for key in members:
+        name = names.get(key.rsplit(':', 1)[0])
+        if name is not None and key not in records:
+            pipe.delete(key, f'tasks:{key}')
+            pipe.srem(name_index(name), key)
+            unindex_record(pipe, key)
+
+
+def upload_priority(path: str) -> int:
+    """
+    Приоритет загрузки видео: приоритет самой вложенной из папок UPLOAD_PRIORITIES, в которой лежит видео,
+    или UPLOAD_DEFAULT_PRIORITY. Меньше - раньше.
+    :param path: Путь к видео
+    """
+    path = os.path.normpath(path)
+    folders = [
+        folder for folder in UPLOAD_PRIORITIES
+        if path == os.path.normpath(folder) or path.startswith(os.path.normpath(folder) + os.sep)
+    ]
+    folder = max(folders, key=len, default=None)
+    return UPLOAD_DEFAULT_PRIORITY if folder is None else UPLOAD_PRIORITIES[folder]
+
+
+def upload_priorities() -> list[int]:
+    """
+    Все приоритеты загрузки из настроек в порядке загрузки.
+    """
+    return sorted(set(UPLOAD_PRIORITIES.values()) | {UPLOAD_DEFAULT_PRIORITY})
+
+
+def upload_stream_key(priority: int) -> str:
+    """
+    Ключ очереди загрузки (Redis Stream) для видео с приоритетом priority.
+    :param priority: Приоритет загрузки
+    """
+    return f'{UPLOADS_STREAM_PREFIX}{priority}'
+
+
+def split_upload_id(entry_id: str) -> tuple[int, str]:
+    """
+    Приоритет и идентификатор сообщения в очереди этого приоритета.
+    Пример: '10:1700000000000-0' -> (10, '1700000000000-0')
+    :param entry_id: Идентификатор сообщения из decode_uploads
+    """
+    priority, stream_id = entry_id.split(':', 1)
+    return int(priority), stream_id
+
+
+def decode_uploads(priority: int, entries) -> list[tuple[str, str, int]]:
+    """
+    Декодирование сообщений очереди загрузки из ответа XREADGROUP/XAUTOCLAIM/XRANGE.
+    Идентификатор сообщения дополняется приоритетом очереди (см. split_upload_id).
+    :param priority: Приоритет очереди
+    :param entries: Сообщения (идентификатор, поля)
+    :return: Список (идентификатор сообщения, путь к видео, количество неудачных попыток)
+    """
+    return [
+        (f'{priority}:{entry_id.decode("utf-8")}', fields[b'path'].decode('utf-8'), int(fields.get(b'attempts', 0)))
+        for entry_id, fields in entries if fields
+    ]
+
+
+def bump_records_version(pipe):
+    """
+    Увеличение версии списка записей и оповещение API о том, что закэшированный список устарел.
+    :param pipe: Pipeline Redis (синхронный или асинхронный)
+    """
+    pipe.incr(RECORDS_VERSION_KEY)
+    pipe.publish(PUBSUB_RECORDS_CHANNEL_NAME, 'changed')
+
+
+# Изменение статуса только существующей записи (иначе HSET создал бы "обрезок" удаленной записи)
+SET_STATUS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[1])
+redis.call('INCR', KEYS[2])
+redis.call('PUBLISH', ARGV[2], 'changed')
+return 1
+"""
+
+# Атомарный захват таски: запись существует и аренда таски никем не удерживается
+CLAIM_TASK_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if not redis.call('SET', KEYS[4], ARGV[3], 'NX', 'PX', ARGV[4]) then
+    return 0
+end
+redis.call('SADD', KEYS[2], KEYS[1])
+redis.call('HSET', KEYS[1], 'status', ARGV[1])
+redis.call('INCR', KEYS[3])
+redis.call('PUBLISH', ARGV[2], 'changed')
+return 1
+"""
+
+# Продление аренды тасок узла. Истекшая аренда еще запущенной таски возвращается узлу.
+# KEYS[1] - множество запущенных тасок, KEYS[1 + i] - ключ аренды таски ARGV[2 + i].
+# Возвращает номера (с 1) аренд, захваченных другими узлами
+RENEW_LEASES_SCRIPT = """
+local lost = {}
+for i = 2, #KEYS do
+    local holder = redis.call('GET', KEYS[i])
+    if holder == ARGV[1] then
+        redis.call('PEXPIRE', KEYS[i], ARGV[2])
+    elseif holder then
+        table.insert(lost, i - 1)
+    elseif redis.call('SISMEMBER', KEYS[1], ARGV[1 + i]) == 1 then
+        redis.call('SET', KEYS[i], ARGV[1], 'PX', ARGV[2])
+    end
+end
+return lost
+"""
+
+# Освобождение таски узлом (вместе с отметкой tasks:{key}), только если аренда все еще принадлежит ему
+RELEASE_TASK_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[3])
+redis.call('SREM', KEYS[2], ARGV[2])
+return 1
+"""
+
+# Удаление отметок о запущенных тасках, аренда которых истекла (узел, на котором шла запись, умер).
+# KEYS[1] - множество запущенных тасок, KEYS[1 + i] - ключ аренды таски ARGV[i]
+REAP_TASKS_SCRIPT = """
+local reaped = {}
+for i, key in ipairs(ARGV) do
+    if redis.call('EXISTS', KEYS[1 + i]) == 0 and redis.call('SREM', KEYS[1], key) == 1 then
+        table.insert(reaped, key)
+    end
+end
+return reaped
+"""
+
+# Возврат в очередь загрузки видео, время повторной попытки которых наступило.
+# KEYS[1] - отложенные видео, KEYS[1 + i] - очередь приоритета ARGV[3 + i]; ARGV[3] - приоритет по умолчанию
+REQUEUE_UPLOADS_SCRIPT = """
+local streams = {}
+for i = 2, #KEYS do
+    streams[ARGV[i + 2]] = KEYS[i]
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(due) do
+    local upload = cjson.decode(item)
+    local stream = streams[tostring(upload.priority)] or streams[ARGV[3]]
+    redis.call('XADD', stream, '*', 'path', upload.path, 'attempts', upload.attempts)
+    redis.call('ZREM', KEYS[1], item)
+end
+return #due
+"""
 
 
 class RedisConnection:
@@ -22,43 +301,185 @@ class RedisConnection:
         self._r = redis.Redis(host=host, port=port, db=db_num)
         self._connection = self
 
-    def __getitem__(self, item):
-        if val := self._r.get(item):
-            return json.loads(val)
-
-    def __setitem__(self, key, value):
-        self._r.set(key, json.dumps(value))
+        self._set_status = self._r.register_script(SET_STATUS_SCRIPT)
+        self._claim_task = self._r.register_script(CLAIM_TASK_SCRIPT)
+        self._renew_leases = self._r.register_script(RENEW_LEASES_SCRIPT)
+        self._release_task = self._r.register_script(RELEASE_TASK_SCRIPT)
+        self._reap_tasks = self._r.register_script(REAP_TASKS_SCRIPT)
+        self._requeue_uploads = self._r.register_script(REQUEUE_UPLOADS_SCRIPT)
 
     def get_keys(self, pattern: str):
         """
         Получение списка ключей по паттерну.
+        Используется SCAN, чтобы не блокировать сервер, как это делает KEYS.
         :param pattern: Шаблон поиска
         :return: Список ключей
         """
-        results = self._r.keys(pattern)
-        return [r.decode('utf-8') for r in results]
+        return decode_keys(self._r.scan_iter(pattern))
+
+    def add_records(self, records: dict[str, dict]):
+        """
+        Сохранение нескольких отложенных ('videos:...') или регулярных ('regular:...') записей вместе с индексами.
+        Записи хранятся в виде хэшей (см. encode_record). Интервалы прежних версий записей, которые не перезаписываются
+        новыми, удаляются (см. drop_stale_records). Выполняется одной транзакцией: множества имен читаются под WATCH,
+        и если их кто-то изменил до конца транзакции, она повторяется.
+        :param records: Словарь "ключ записи -> информация о записи"
+        """
+        names = record_names(records)
+        with self._r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(*names)
+                    members = decode_keys(pipe.sunion(*names))
+
+                    pipe.multi()
+                    drop_stale_records(pipe, records, members)
+                    for key, info in records.items():
+                        pipe.delete(key)
+                        pipe.hset(key, mapping=encode_record(info))
+                        index_record(pipe, key, info)
+                    bump_records_version(pipe)
+                    pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    def add_record(self, key: str, info: dict):
+        """
+        Сохранение одной записи вместе с индексами.
+        :param key: Ключ записи
+        :param info: Информация о записи
+        """
+        self.add_records({key: info})
+
+    def get_records(self, keys: list[str]) -> dict[str, dict]:
+        """
+        Получение нескольких записей за один запрос к серверу.
+        :param keys: Ключи записей
+        :return: Словарь "ключ записи -> информация о записи" (только для существующих записей)
+        """
+        if not keys:
+            return {}
+
+        pipe = self._r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return {key: decode_record(fields) for key, fields in zip(keys, pipe.execute()) if fields}
+
+    def get_record(self, key: str) -> dict | None:
+        """
+        Получение одной записи.
+        :param key: Ключ записи
+        :return: Информация о записи или None, если записи нет
+        """
+        return self.get_records([key]).get(key)
+
+    def _migrate_string_records(self, keys: list[str]):
+        """
+        Перевод записей, сохраненных строкой json (до перехода на хэши), в хэши.
+        :param keys: Ключи записей
+        """
+        pipe = self._r.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        legacy = [key for key, key_type in zip(keys, pipe.execute()) if key_type in (b'string', 'string')]
+
+        if legacy:
+            pipe = self._r.pipeline()
+            for key, val in zip(legacy, self._r.mget(legacy)):
+                pipe.delete(key)
+                pipe.hset(key, mapping=encode_record(json.loads(val)))
+            pipe.execute()
+
+    def rebuild_indexes(self):
+        """
+        Перестроение вторичных индексов по всем записям БД (например, для записей, созданных до появления индексов).
+        """
+        keys = self.get_keys('videos:*') + self.get_keys('regular:*')
+        self._migrate_string_records(keys)
+
+        pipe = self._r.pipeline()
+        pipe.delete(VIDEOS_FROM_INDEX, VIDEOS_TO_INDEX, REGULAR_INDEX)
+        # Индексы по дням недели остались от старых версий, расписание строится по WeeklyIndex
+        if name_keys := self.get_keys('names:*') + self.get_keys('index:regular:day:*'):
+            pipe.delete(*name_keys)
+        for key, info in self.get_records(keys).items():
+            index_record(pipe, key, info)
+            # Компиляция расписания для регулярных записей, созданных до появления week_intervals
+            if key.startswith('regular:') and 'week_intervals' not in info:
+                pipe.hset(key, 'week_intervals', json.dumps(compile_regular_record(info)))
+        bump_records_version(pipe)
+        pipe.execute()
+
+    def get_record_keys(self, kind: Literal['videos', 'regular']) -> list[str]:
+        """
+        Получение ключей всех отложенных или регулярных записей из индекса.
+        :param kind: 'videos' или 'regular'
+        :return: Список ключей
+        """
+        if kind == 'videos':
+            return decode_keys(self._r.zrange(VIDEOS_FROM_INDEX, 0, -1))
+        return decode_keys(self._r.smembers(REGULAR_INDEX))
+
+    def get_unfinished_record_keys(self, now: datetime) -> list[str]:
+        """
+        Получение ключей отложенных записей, которые еще не закончились.
+        :param now: Текущий момент
+        :return: Список ключей
+        """
+        return decode_keys(self._r.zrangebyscore(VIDEOS_TO_INDEX, f'({now.timestamp()}', '+inf'))
+
+    def get_due_record_keys(self, now: datetime) -> tuple[list[str], set[str]]:
+        """
+        Получение ключей незапущенных отложенных записей, которые должны выполняться сейчас, и запущенных тасок.
+        Выполняется за один запрос к серверу.
+        Регулярные записи, которые должны выполняться сейчас, определяются по WeeklyIndex (см. weekly_schedule.py).
+        :param now: Текущий момент
+        :return: Ключи отложенных записей и множество ключей запущенных тасок
+        """
+        timestamp = now.timestamp()
+
+        pipe = self._r.pipeline(transaction=False)
+        pipe.zrangebyscore(VIDEOS_FROM_INDEX, '-inf', timestamp)
+        pipe.zrangebyscore(VIDEOS_TO_INDEX, f'({timestamp}', '+inf')
+        pipe.smembers(TASKS_KEY)
+        started, unfinished, running = pipe.execute()
+
+        running = set(decode_keys(running))
+        return [key for key in decode_keys(set(started) & set(unfinished)) if key not in running], running
 
     def get_all_records(self):
         """
         Получение отложенных и регулярных записей в json-friendly формате.
+        Выполняется за два запроса к серверу независимо от количества записей.
         :return: Словарь со всеми записями
         """
+        pipe = self._r.pipeline(transaction=False)
+        pipe.zrange(VIDEOS_FROM_INDEX, 0, -1)
+        pipe.smembers(REGULAR_INDEX)
+        videos, regular = (decode_keys(keys) for keys in pipe.execute())
+
+        records = self.get_records(videos + regular)
         return {
-            'records': {rec: self[rec] for rec in self.get_keys('videos:*')},
-            'regularRecords': {rec: self[rec] for rec in self.get_keys('regular:*')}
+            'records': {rec: records[rec] for rec in videos if rec in records},
+            'regularRecords': {rec: records[rec] for rec in regular if rec in records},
         }
 
     def delete_record(self, name):
         """
-        Удаление записи по имени.
+        Удаление записи по имени (всех ее интервалов).
+        Выполняется за два запроса к серверу благодаря индексу имен.
         :param name: Имя записи
         """
-        keys = chain(self._r.keys('videos:*'), self._r.keys('regular:*'))
+        keys = decode_keys(self._r.smembers(name_index(name)))
+
+        pipe = self._r.pipeline()
         for key in keys:
-            if self[key]['name'] == name:
-                self._r.delete(key)
-                self._r.delete(f'tasks:{key}')
-                break
+            pipe.delete(key, f'tasks:{key}')
+            unindex_record(pipe, key)
+        pipe.delete(name_index(name))
+        bump_records_version(pipe)
+        pipe.execute()
 
     def has(self, pattern: str) -> bool:
         """
@@ -70,67 +491,401 @@ class RedisConnection:
 
     def change_record_status(self, key: str, status_value: Literal['queued', 'in_progress', 'error', 'completed']):
         """
-        Изменение статуса записи.
+        Изменение статуса записи. Меняется одно поле хэша, остальные поля не перезаписываются.
         :param key: Ключ записи
         :param status_value: 'queued', 'in_progress', 'error', 'completed'
         """
-        content = self[key]
-        content['status'] = status_value
-        self[key] = content
+        self._set_status(
+            keys=[key, RECORDS_VERSION_KEY],
+            args=[json.dumps(status_value), PUBSUB_RECORDS_CHANNEL_NAME],
+        )
 
-    def init_task(self, key: str):
+    def claim_task(self, key: str, owner: str) -> bool:
         """
-        Создание таски записи.
+        Атомарный захват таски записи: таска создается, только если запись существует и аренду таски никто
+        не удерживает. Аренда выдается узлу owner на LEASE_TTL_SECONDS (см. renew_leases).
+        Безопасно при нескольких одновременно работающих планировщиках.
         :param key: Ключ записи
+        :param owner: Идентификатор узла
+        :return: True, если таска захвачена; False, если она уже запущена или запись удалена
         """
-        self.change_record_status(key, 'in_progress')
-        self[f'tasks:{key}'] = {}
+        return bool(self._claim_task(
+            keys=[key, TASKS_KEY, RECORDS_VERSION_KEY, lease_key(key)],
+            args=[json.dumps('in_progress'), PUBSUB_RECORDS_CHANNEL_NAME, owner, LEASE_TTL_SECONDS * 1000],
+        ))
 
-    def task_is_running(self, key: str) -> bool:
+    def renew_leases(self, keys: list[str], owner: str) -> list[str]:
         """
-        Есть ли в БД запущенная таска.
+        Продление аренды тасок узла за один запрос к серверу.
+        :param keys: Ключи записей, которые идут на узле
+        :param owner: Идентификатор узла
+        :return: Ключи записей, аренду которых захватил другой узел
+        """
+        if not keys:
+            return []
+        lost = self._renew_leases(
+            keys=[TASKS_KEY, *(lease_key(key) for key in keys)],
+            args=[owner, LEASE_TTL_SECONDS * 1000, *keys],
+        )
+        return [keys[i - 1] for i in lost]
+
+    def release_task(self, key: str, owner: str) -> bool:
+        """
+        Освобождение таски без изменения статуса записи (например, если процесс записи не удалось запустить
+        или он завершился аварийно). Таска освобождается, только если ее аренда принадлежит узлу owner.
         :param key: Ключ записи
-        :return: True or False
+        :param owner: Идентификатор узла
+        :return: True, если таска была освобождена
         """
-        return self[f'tasks:{key}'] is not None
+        return bool(self._release_task(keys=[lease_key(key), TASKS_KEY, f'tasks:{key}'], args=[owner, key]))
 
-    def complete_task(self, key: str):
+    def reap_expired_tasks(self) -> list[str]:
         """
-        Завершение таски (то есть ее удаление).
+        Удаление отметок о запущенных тасках с истекшей арендой.
+        Ключи аренды передаются в скрипт явно (KEYS): Redis требует, чтобы скрипт обращался только к объявленным ключам.
+        :return: Ключи записей, отметки которых были удалены
+        """
+        keys = decode_keys(self._r.smembers(TASKS_KEY))
+        if not keys:
+            return []
+        return decode_keys(self._reap_tasks(keys=[TASKS_KEY, *(lease_key(key) for key in keys)], args=keys))
+
+    def get_lease_owner(self, key: str) -> str | None:
+        """
+        Узел, который удерживает аренду таски записи.
         :param key: Ключ записи
+        :return: Идентификатор узла или None, если аренды нет
         """
-        self._r.delete(f'tasks:{key}')
-        self.change_record_status(key, 'completed')
+        owner = self._r.get(lease_key(key))
+        return owner.decode('utf-8') if owner is not None else None
 
-    # Пока не используется
-    def add_running_process(self, key: str, pid: int, path: str):
+    def register_node(self, node_id: str, info: dict):
+        """
+        Регистрация узла записи (его емкости и загрузки) в общем реестре узлов.
+        :param node_id: Идентификатор узла
+        :param info: Информация об узле
         """
-        Добавление запущенного процесса записи в таску.
+        self._r.hset(NODES_KEY, node_id, json.dumps(info))
+
+    def get_nodes(self) -> dict[str, dict]:
+        """
+        Получение реестра узлов записи.
+        :return: Словарь "идентификатор узла -> информация об узле"
+        """
+        return {node.decode('utf-8'): json.loads(info) for node, info in self._r.hgetall(NODES_KEY).items()}
+
+    def unregister_nodes(self, node_ids: list[str]):
+        """
+        Удаление узлов из реестра.
+        :param node_ids: Идентификаторы узлов
+        """
+        if node_ids:
+            self._r.hdel(NODES_KEY, *node_ids)
+
+    def task_is_running(self, key: str) -> bool:
+        """
+        Есть ли в БД запущенная таска.
         :param key: Ключ записи
-        :param pid: PID процесса
-        :param path: Путь к записываемому файлу
+        :return: True or False
         """
-        task_info = self[f'tasks:{key}']
-        task_info[pid] = path
-        self[f'tasks:{key}'] = task_info
+        return bool(self._r.sismember(TASKS_KEY, key))
 
-    # Пока не используется
-    def complete_process(self, key: str, pid: int):
+    def running_tasks(self, keys: list[str]) -> set[str]:
+        """
+        Проверка нескольких тасок за один запрос.
+        :param keys: Ключи записей
+        :return: Множество ключей, для которых таска запущена
         """
-        Завершение процесса из таски (его удаление).
+        if not keys:
+            return set()
+        return {key for key, running in zip(keys, self._r.smismember(TASKS_KEY, keys)) if running}
+
+    def complete_task(self, key: str):
+        """
+        Завершение таски (то есть ее удаление).
         :param key: Ключ записи
-        :param pid: PID процесса
         """
-        task_info = self[f'tasks:{key}']
-        del task_info[str(pid)]
-        self[f'tasks:{key}'] = task_info
+        pipe = self._r.pipeline()
+        pipe.srem(TASKS_KEY, key)
+        pipe.delete(f'tasks:{key}', lease_key(key))
+        self._set_status(
+            keys=[key, RECORDS_VERSION_KEY],
+            args=[json.dumps('completed'), PUBSUB_RECORDS_CHANNEL_NAME],
+            client=pipe,
+        )
+        pipe.execute()
 
     def reset_tasks(self):
         """
         Удаление всех тасок из БД.
         """
-        if keys := self._r.keys('tasks:*'):
+        if keys := self.get_keys('tasks:*'):
             self._r.delete(*keys)
+        self._r.delete(TASKS_KEY)
+
+    def push_metrics(self, counters: dict[str, float], gauges: dict[str, float], removed=()):
+        """
+        Отправка метрик процесса за один запрос к серверу (см. server/metrics.py).
+        Вместе с gauge-метриками сохраняется время их обновления (METRICS_GAUGES_UPDATED_KEY).
+        :param counters: Приращения счетчиков
+        :param gauges: Значения gauge-метрик
+        :param removed: Gauge-метрики, которые нужно удалить
+        """
+        pipe = self._r.pipeline(transaction=False)
+        for key, value in counters.items():
+            pipe.hincrbyfloat(METRICS_COUNTERS_KEY, key, value)
+        if gauges:
+            pipe.hset(METRICS_GAUGES_KEY, mapping=gauges)
+            pipe.hset(METRICS_GAUGES_UPDATED_KEY, mapping=dict.fromkeys(gauges, time.time()))
+        if removed:
+            pipe.hdel(METRICS_GAUGES_KEY, *removed)
+            pipe.hdel(METRICS_GAUGES_UPDATED_KEY, *removed)
+        pipe.execute()
+
+    def enqueue_upload(self, path: str):
+        """
+        Постановка видео в очередь загрузки на диск (Redis Stream своего приоритета, см. upload_priority).
+        В отличие от publish сообщение сохраняется, пока загрузчик не подтвердит загрузку.
+        :param path: Путь к видео
+        """
+        self._r.xadd(upload_stream_key(upload_priority(path)), {'path': path, 'attempts': 0})
+
+    def create_upload_group(self):
+        """
+        Создание группы загрузчиков (consumer group) для очередей загрузки всех приоритетов, если ее еще нет.
+        Группа читает очередь с самого начала, поэтому видео, поставленные в очередь до первого запуска
+        загрузчика, тоже будут загружены.
+        Видео из очередей приоритетов, которых больше нет в настройках, переносятся в очереди своих приоритетов.
+        """
+        for priority in upload_priorities():
+            try:
+                self._r.xgroup_create(upload_stream_key(priority), UPLOADS_GROUP, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+        known = {upload_stream_key(priority) for priority in upload_priorities()}
+        for key in self.get_keys(f'{UPLOADS_STREAM_PREFIX}*'):
+            if key in known:
+                continue
+            pipe = self._r.pipeline()
+            for _, path, attempts in decode_uploads(0, self._r.xrange(key)):
+                pipe.xadd(upload_stream_key(upload_priority(path)), {'path': path, 'attempts': attempts})
+            pipe.delete(key)
+            pipe.execute()
+
+    def read_uploads(self, consumer: str, count: int | None, pending=False) -> list[tuple[str, str, int]]:
+        """
+        Получение видео из очереди загрузки: сначала из очереди с самым высоким приоритетом, затем из следующих.
+        Полученные сообщения числятся за загрузчиком consumer, пока он их не подтвердит (ack_upload, retry_upload
+        или dead_letter_upload).
+        :param consumer: Имя загрузчика
+        :param count: Максимальное количество сообщений (None - без ограничения)
+        :param pending: Получить заново уже полученные, но не подтвержденные загрузчиком сообщения
+            (после перезапуска загрузчика)
+        :return: Список (идентификатор сообщения, путь к видео, количество неудачных попыток)
+        """
+        uploads = []
+        for priority in upload_priorities():
+            remain = None if count is None else count - len(uploads)
+            if remain is not None and remain <= 0:
+                break
+            response = self._r.xreadgroup(
+                UPLOADS_GROUP, consumer, {upload_stream_key(priority): '0' if pending else '>'}, count=remain,
+            )
+            if response:
+                uploads += decode_uploads(priority, response[0][1])
+        return uploads
+
+    def claim_stale_uploads(self, consumer: str, count: int) -> list[tuple[str, str, int]]:
+        """
+        Перехват неподтвержденных сообщений, которые дольше UPLOAD_CLAIM_IDLE_SECONDS никто не продлевал
+        (загрузчик, который их получил, умер). Сообщения перехватываются в порядке приоритетов.
+        :param consumer: Имя загрузчика
+        :param count: Максимальное количество сообщений
+        :return: Список (идентификатор сообщения, путь к видео, количество неудачных попыток)
+        """
+        uploads = []
+        for priority in upload_priorities():
+            if len(uploads) >= count:
+                break
+            _, entries, *_ = self._r.xautoclaim(
+                upload_stream_key(priority), UPLOADS_GROUP, consumer, UPLOAD_CLAIM_IDLE_SECONDS * 1000,
+                count=count - len(uploads),
+            )
+            uploads += decode_uploads(priority, entries)
+        return uploads
+
+    def remove_idle_upload_consumers(self, consumer: str) -> int:
+        """
+        Удаление из группы загрузчиков, у которых не осталось сообщений и которые дольше UPLOAD_CLAIM_IDLE_SECONDS
+        не обращались к очереди (имя загрузчика меняется при каждом запуске, поэтому старые имена копятся в группе).
+        :param consumer: Имя текущего загрузчика (не удаляется)
+        :return: Количество удаленных загрузчиков (по всем очередям)
+        """
+        removed = 0
+        for priority in upload_priorities():
+            key = upload_stream_key(priority)
+            for info in self._r.xinfo_consumers(key, UPLOADS_GROUP):
+                if info['pending'] == 0 and info['idle'] > UPLOAD_CLAIM_IDLE_SECONDS * 1000 \
+                        and info['name'].decode('utf-8') != consumer:
+                    self._r.xgroup_delconsumer(key, UPLOADS_GROUP, info['name'])
+                    removed += 1
+        return removed
+
+    def touch_uploads(self, consumer: str, entry_ids: list[str]):
+        """
+        Продление сообщений, видео которых сейчас загружаются, чтобы их не перехватили другие загрузчики.
+        :param consumer: Имя загрузчика
+        :param entry_ids: Идентификаторы сообщений
+        """
+        by_priority = defaultdict(list)
+        for entry_id in entry_ids:
+            priority, stream_id = split_upload_id(entry_id)
+            by_priority[priority].append(stream_id)
+
+        pipe = self._r.pipeline(transaction=False)
+        for priority, stream_ids in by_priority.items():
+            pipe.xclaim(upload_stream_key(priority), UPLOADS_GROUP, consumer, 0, stream_ids, justid=True)
+        pipe.execute()
+
+    def _remove_upload(self, pipe, entry_id: str) -> int:
+        """
+        Подтверждение и удаление сообщения из очереди своего приоритета в транзакции pipe.
+        :return: Приоритет сообщения
+        """
+        priority, stream_id = split_upload_id(entry_id)
+        pipe.xack(upload_stream_key(priority), UPLOADS_GROUP, stream_id)
+        pipe.xdel(upload_stream_key(priority), stream_id)
+        return priority
+
+    def ack_upload(self, entry_id: str):
+        """
+        Подтверждение загрузки видео (сообщение удаляется из очереди).
+        :param entry_id: Идентификатор сообщения
+        """
+        pipe = self._r.pipeline()
+        self._remove_upload(pipe, entry_id)
+        pipe.execute()
+
+    def retry_upload(self, entry_id: str, path: str, attempts: int, retry_at: float):
+        """
+        Откладывание загрузки видео после неудачной попытки (см. requeue_due_uploads).
+        :param entry_id: Идентификатор сообщения
+        :param path: Путь к видео
+        :param attempts: Количество неудачных попыток
+        :param retry_at: Время повторной попытки (unix timestamp)
+        """
+        pipe = self._r.pipeline()
+        priority = self._remove_upload(pipe, entry_id)
+        pipe.zadd(UPLOADS_RETRY_KEY, {json.dumps({'path': path, 'attempts': attempts, 'priority': priority}): retry_at})
+        pipe.execute()
+
+    def dead_letter_upload(self, entry_id: str, path: str, attempts: int):
+        """
+        Перенос видео, которое не удалось загрузить за все попытки, в список UPLOADS_DEAD_KEY.
+        :param entry_id: Идентификатор сообщения
+        :param path: Путь к видео
+        :param attempts: Количество неудачных попыток
+        """
+        pipe = self._r.pipeline()
+        self._remove_upload(pipe, entry_id)
+        pipe.rpush(UPLOADS_DEAD_KEY, json.dumps({
+            'path': path, 'attempts': attempts, 'failed_at': datetime.now().strftime(DATE_FORMAT),
+        }))
+        pipe.execute()
+
+    def requeue_due_uploads(self, now: float, count=100) -> int:
+        """
+        Возврат в очередь загрузки (своего приоритета) отложенных видео, время повторной попытки которых наступило.
+        :param now: Текущее время (unix timestamp)
+        :param count: Максимальное количество видео за один вызов
+        :return: Количество возвращенных видео
+        """
+        priorities = upload_priorities()
+        return self._requeue_uploads(
+            keys=[UPLOADS_RETRY_KEY, *(upload_stream_key(priority) for priority in priorities)],
+            args=[now, count, UPLOAD_DEFAULT_PRIORITY, *priorities],
+        )
+
+    def queued_upload_paths(self, include_dead=True) -> set[str]:
+        """
+        Пути всех видео, которые есть в очереди загрузки (в том числе отложенных).
+        Читает очередь целиком, поэтому подходит только для редких проверок (например, при запуске загрузчика).
+        :param include_dead: Включать ли видео, которые не удалось загрузить
+        :return: Множество путей к видео
+        """
+        priorities = upload_priorities()
+        pipe = self._r.pipeline(transaction=False)
+        for priority in priorities:
+            pipe.xrange(upload_stream_key(priority))
+        pipe.zrange(UPLOADS_RETRY_KEY, 0, -1)
+        if include_dead:
+            pipe.lrange(UPLOADS_DEAD_KEY, 0, -1)
+        results = pipe.execute()
+        streams, (retry, *dead) = results[:len(priorities)], results[len(priorities):]
+        dead = dead[0] if dead else []
+        paths = {
+            path for priority, entries in zip(priorities, streams) for _, path, _ in decode_uploads(priority, entries)
+        }
+        return paths | {json.loads(item)['path'] for item in retry + dead}
+
+    def get_upload_checkpoint(self, path: str) -> dict | None:
+        """
+        Получение сохраненного состояния загрузки файла.
+        :param path: Путь к файлу в хранилище
+        :return: Сессия загрузки, размер файла и загруженный объем или None
+        """
+        if checkpoint := self._r.hget(UPLOADS_CHECKPOINTS_KEY, path):
+            return json.loads(checkpoint)
+        return None
+
+    def save_upload_checkpoint(self, path: str, session: str, size: int, offset: int):
+        """
+        Сохранение состояния загрузки файла, чтобы продолжить ее после сбоя или перезапуска загрузчика.
+        :param path: Путь к файлу в хранилище
+        :param session: Идентификатор сессии загрузки
+        :param size: Размер файла
+        :param offset: Загруженный объем
+        """
+        self._r.hset(UPLOADS_CHECKPOINTS_KEY, path, json.dumps({'session': session, 'size': size, 'offset': offset}))
+
+    def delete_upload_checkpoint(self, path: str):
+        """
+        Удаление состояния завершенной загрузки.
+        :param path: Путь к файлу в хранилище
+        """
+        self._r.hdel(UPLOADS_CHECKPOINTS_KEY, path)
+
+    def upload_queue_stats(self) -> dict[str, int]:
+        """
+        Размеры очереди загрузки за один запрос к серверу.
+        :return: Словарь с количеством видео в очереди (queued, по всем приоритетам), отложенных (retry)
+        и не загруженных (dead)
+        """
+        priorities = upload_priorities()
+        pipe = self._r.pipeline(transaction=False)
+        for priority in priorities:
+            pipe.xlen(upload_stream_key(priority))
+        pipe.zcard(UPLOADS_RETRY_KEY)
+        pipe.llen(UPLOADS_DEAD_KEY)
+        *queued, retry, dead = pipe.execute()
+        return {'queued': sum(queued), 'retry': retry, 'dead': dead}
+
+    def sample_upload_paths(self, count: int) -> list[str]:
+        """
+        Пути последних поставленных в очередь видео (для оценки объема очереди без чтения ее целиком).
+        :param count: Максимальное количество видео из очереди каждого приоритета
+        :return: Список путей к видео
+        """
+        priorities = upload_priorities()
+        pipe = self._r.pipeline(transaction=False)
+        for priority in priorities:
+            pipe.xrevrange(upload_stream_key(priority), count=count)
+        return [
+            path for priority, entries in zip(priorities, pipe.execute())
+            for _, path, _ in decode_uploads(priority, entries)
+        ]
 
     def subscribe(self, channel: str):
         """
@@ -17,6 +17,15 @@ def exists(path: str) -> bool:
     return os.path.exists(path)
 
 
+def get_size(path: str) -> int:
+    """
+    Размер файла в байтах
+    :param path: Путь
+    :return: Размер файла
+    """
+    return os.path.getsize(path)
+
+
 def get_filename(filename: str) -> str:
     """
     Извлекает имя файла без расширения
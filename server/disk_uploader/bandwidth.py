@@ -0,0 +1,116 @@
+import threading
+import time
+
+from datetime import datetime
+from typing import BinaryIO, Optional
+
+from server.const import TIME_FORMAT
+
+
+def bandwidth_limit(profiles: list[tuple[str, str, float]], now: datetime) -> Optional[float]:
+    """
+    Ограничение скорости загрузки на текущее время суток.
+    Интервал, у которого начало позже конца, переходит через полночь.
+    Пример: ([('09-00', '19-00', 1048576)], 12:00) -> 1048576; (..., 23:00) -> None.
+    :param profiles: Интервалы (начало и конец в формате TIME_FORMAT, скорость в байтах в секунду)
+    :param now: Текущий момент
+    :return: Скорость в байтах в секунду или None, если скорость не ограничена
+    """
+    current = now.time()
+    for start, end, rate in profiles:
+        start = datetime.strptime(start, TIME_FORMAT).time()
+        end = datetime.strptime(end, TIME_FORMAT).time()
+        if start <= current < end if start <= end else (current >= start or current < end):
+            return rate
+    return None
+
+
+class TokenBucket:
+    """
+    Ограничение скорости по алгоритму token bucket, общее для всех потоков загрузки.
+    Токены (байты) накапливаются со скоростью rate, но не больше чем на burst_seconds секунд. Если токенов не хватает,
+    поток ждет, пока они накопятся, поэтому средняя скорость всех потоков вместе не превышает rate.
+    :param rate: Скорость в байтах в секунду (None - без ограничения)
+    :param burst_seconds: На сколько секунд можно накопить токены
+
+    :param self.consumed: Сколько всего байт прошло через ограничитель (для измерения текущей скорости)
+    """
+
+    def __init__(self, rate: Optional[float], burst_seconds: float):
+        self.burst_seconds = burst_seconds
+        self.consumed = 0
+
+        self._rate = rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    @property
+    def capacity(self) -> Optional[float]:
+        return None if self._rate is None else self._rate * self.burst_seconds
+
+    def set_rate(self, rate: Optional[float]):
+        """
+        Изменение скорости (например, при смене профиля по времени суток).
+        :param rate: Скорость в байтах в секунду (None - без ограничения)
+        """
+        with self._lock:
+            if rate == self._rate:
+                return
+            self._rate = rate
+            self._tokens = self.capacity
+            self._updated_at = time.monotonic()
+
+    def consume(self, amount: int):
+        """
+        Получение amount токенов с ожиданием, если их не хватает.
+        Токены можно взять в долг (больше, чем помещается в ведро), тогда ожидание будет пропорционально долгу.
+        :param amount: Количество байт
+        """
+        with self._lock:
+            self.consumed += amount
+            if self._rate is None:
+                return
+
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            self._tokens -= amount
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def chunk_size(self, max_size: int) -> int:
+        """
+        Размер части файла при загрузке по частям: не больше, чем помещается в ведро, чтобы части уходили
+        равномерно, а не большими пачками на полной скорости канала.
+        :param max_size: Размер части без ограничения скорости
+        """
+        capacity = self.capacity
+        return max_size if capacity is None else max(64 * 1024, min(max_size, int(capacity)))
+
+
+class ThrottledReader:
+    """
+    Обертка над файлом, которая берет токены у ограничителя на каждый прочитанный байт.
+    Остальные методы файла (seek, tell, fileno, ...) вызываются напрямую.
+    :param file: Файл, открытый на чтение в двоичном режиме
+    :param bucket: Ограничитель скорости
+    """
+
+    def __init__(self, file: BinaryIO, bucket: TokenBucket):
+        self._file = file
+        self._bucket = bucket
+
+    def read(self, size=-1) -> bytes:
+        data = self._file.read(size)
+        self._bucket.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
@@ -0,0 +1,51 @@
+import threading
+
+from collections import OrderedDict
+
+
+class DirectoryCache:
+    """
+    Ограниченный по размеру кэш папок на диске, про которые известно, что они существуют.
+    При переполнении вытесняется папка, к которой дольше всего не обращались (LRU).
+    Потокобезопасный: им пользуются все потоки загрузки.
+    :param max_size: Максимальное количество папок в кэше
+
+    :param self._dirs: Папки в порядке последнего обращения
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+
+        self._dirs: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._dirs)
+
+    def __contains__(self, path: str):
+        with self._lock:
+            if path not in self._dirs:
+                return False
+            self._dirs.move_to_end(path)
+            return True
+
+    def add(self, path: str):
+        """
+        Добавление существующей папки.
+        :param path: Путь к папке на диске
+        """
+        with self._lock:
+            self._dirs[path] = None
+            self._dirs.move_to_end(path)
+            while len(self._dirs) > self.max_size:
+                self._dirs.popitem(last=False)
+
+    def discard(self, path: str):
+        """
+        Удаление папки и всех вложенных в нее папок (например, если папку удалили на диске).
+        :param path: Путь к папке на диске
+        """
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            for d in [d for d in self._dirs if d == path or d.startswith(prefix)]:
+                del self._dirs[d]
@@ -1,18 +1,60 @@
 import contextlib
+import glob
 import multiprocessing
+import os
+import socket
+import threading
 import time
 
-import yadisk
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
 
 import server.directory_methods as directory_methods
-from server.const import PUBSUB_VIDEO_CHANNEL_NAME, VIDEO_EXTENSION
-from server.database import RedisConnection
+from server.const import VIDEO_EXTENSION, UPLOAD_WORKERS, UPLOAD_WORKERS_PER_DESTINATION, UPLOAD_MAX_ATTEMPTS, \
+    UPLOAD_RETRY_BACKOFF_SECONDS, UPLOAD_MAX_RETRY_BACKOFF_SECONDS, UPLOAD_HEARTBEAT_SECONDS, \
+    UPLOAD_DIRECTORY_CACHE_SIZE, UPLOAD_CHUNK_SIZE, UPLOAD_BANDWIDTH_PROFILES, UPLOAD_BANDWIDTH_BURST_SECONDS, \
+    UPLOAD_QUEUE_WINDOW, UPLOAD_BACKLOG_SAMPLE_SIZE
+from server.database import RedisConnection, split_upload_id
+from server.disk_uploader.bandwidth import TokenBucket, ThrottledReader, bandwidth_limit
+from server.disk_uploader.directory_cache import DirectoryCache
+from server.disk_uploader.storage import RemoteStorage, StorageError, PathExistsError, DirectoryExistsError, \
+    ParentNotFoundError, UploadSessionExpired, create_storage
+from server.metrics import Metrics
 
 
 class DiskConnection(multiprocessing.Process):
     """
-    Класс осуществляет запись на Яндекс Диск (в данном случае запись видео).
+    Класс осуществляет запись на Яндекс Диск (в данном случае запись видео) или в другое хранилище
+    (см. create_storage).
+    Видео берутся из очереди загрузки в Redis (см. RedisConnection.read_uploads) и загружаются параллельно пулом
+    потоков: всего не больше workers загрузок одновременно и не больше per_destination загрузок в одну папку на диске.
+    У каждого потока свое подключение к диску. Видео загружаются по частям, состояние загрузки хранится в Redis,
+    поэтому прерванная загрузка продолжается с места остановки (если хранилище это умеет).
+    Сообщение очереди подтверждается только после загрузки видео; неудачная загрузка повторяется с экспоненциальной
+    задержкой, после UPLOAD_MAX_ATTEMPTS попыток видео попадает в список не загруженных. Сообщения, полученные
+    загрузчиком до перезапуска или умершим загрузчиком, загружаются заново, поэтому загрузчиков может быть несколько.
+    Скорость загрузки всех потоков вместе ограничивается по профилям времени суток (UPLOAD_BANDWIDTH_PROFILES),
+    видео берутся из очередей в порядке приоритета папки записи (UPLOAD_PRIORITIES), затем от старых к новым.
+    При запуске в очередь ставятся .tmp файлы, загрузка которых прервалась в прошлых запусках.
     Singleton.
+    :param token: Токен доступа к Яндекс Диску
+    :param workers: Количество одновременных загрузок
+    :param per_destination: Количество одновременных загрузок в одну папку
+    :param consumer: Имя загрузчика в очереди (по умолчанию "хост:pid" запущенного процесса: сообщения загрузчика,
+    который перезапустился под другим именем, перехватываются через UPLOAD_CLAIM_IDLE_SECONDS)
+
+    Потоки, блокировки и кэши создаются в запущенном процессе (см. _setup): объект процесса должен сериализоваться
+    при запуске через spawn (Windows).
+
+    :param self._local: Данные потоков (подключение к хранилищу)
+    :param self._directories: Кэш папок, которые уже есть на диске
+    :param self._bandwidth: Ограничитель скорости загрузки
+    :param self._rate_sample: Объем, прошедший через ограничитель, и время последнего измерения скорости
+    :param self._in_flight: Количество идущих загрузок по папкам назначения
+    :param self._entries: Идентификаторы сообщений, видео которых сейчас загружаются
+    :param self._lock: Блокировка для self._in_flight и self._entries
+    :param self._wakeup: Событие завершения загрузки (будит цикл отправки)
     """
     connection = None
 
@@ -21,83 +63,392 @@ class DiskConnection(multiprocessing.Process):
             cls.connection = super().__new__(cls)
         return cls.connection
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, workers: int = UPLOAD_WORKERS, per_destination: int = UPLOAD_WORKERS_PER_DESTINATION,
+                 consumer: str | None = None):
         super().__init__()
-        self._conn: yadisk.YaDisk | None = None
         self._token = token
+        self.workers = workers
+        self.per_destination = per_destination
+        self.consumer = consumer
+
+        self._local: threading.local | None = None
+        self._directories: DirectoryCache | None = None
+        self._bandwidth: TokenBucket | None = None
+        self._rate_sample = None
+        self._in_flight: Counter[str] = Counter()
+        self._entries: set[str] = set()
+        self._lock: threading.Lock | None = None
+        self._wakeup: threading.Event | None = None
+
+    def _setup(self):
+        """
+        Создание состояния загрузчика, которое нельзя передать в другой процесс.
+        """
+        if self.consumer is None:
+            self.consumer = f'{socket.gethostname()}:{os.getpid()}'
+        self._local = threading.local()
+        self._directories = DirectoryCache(UPLOAD_DIRECTORY_CACHE_SIZE)
+        self._bandwidth = TokenBucket(bandwidth_limit(UPLOAD_BANDWIDTH_PROFILES, datetime.now()),
+                                      UPLOAD_BANDWIDTH_BURST_SECONDS)
+        self._rate_sample = (0, time.monotonic())
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    @property
+    def _storage(self) -> RemoteStorage:
+        """
+        Подключение к хранилищу текущего потока.
+        """
+        if getattr(self._local, 'storage', None) is None:
+            self._local.storage = create_storage(self._token)
+        return self._local.storage
 
-    def upload_video(self, src_path: str, dest_path: str):
+    def upload_video(self, src_path: str, dest_path: str) -> bool:
         """
-        Отправляет видео на Яндекс диск
+        Отправляет видео на Яндекс диск.
+        Пока видео загружается, локальный файл и файл в хранилище имеют расширение .tmp.
         :param src_path: Путь до видео
         :param dest_path: Конечный путь видео на диске
-        :return:
+        :return: True, если видео загружено (или его уже нет локально); False в случае ошибки
         """
         if not directory_methods.exists(src_path):
-            print('No file found; cancel upload to cloud!')
-            return
+            # Файл уже переименован прерванной попыткой загрузки
+            tmp_path = directory_methods.change_extension(src_path, 'tmp')
+            if not directory_methods.exists(tmp_path):
+                print('No file found; cancel upload to cloud!')
+                return True
+            src_path = tmp_path
 
+        metrics = Metrics.get()
         try:
             self._mkdir_recursively(dest_path)
 
+            size = directory_methods.get_size(src_path)
             src_path = directory_methods.change_extension(src_path, 'tmp', rename_file=True)
             dest_path = directory_methods.change_extension(dest_path, 'tmp')
 
-            if not self._conn.exists(dest_path):
-                self._conn.upload(
-                    src_path,
-                    dest_path,
-                    overwrite=False,
-                    n_retries=3
-                )
-                filename = directory_methods.extract_filename(dest_path)
-                filename = directory_methods.change_extension(filename, VIDEO_EXTENSION)
-                self._conn.rename(dest_path, filename)
-
-        except (yadisk.exceptions.ConflictError, yadisk.exceptions.LockedError, PermissionError) as e:
+            # Если .tmp файл уже есть в хранилище, то он загружен целиком и осталось его переименовать
+            started_at = time.monotonic()
+            with contextlib.suppress(PathExistsError):
+                sent = self._upload_file(src_path, dest_path, size)
+                elapsed = time.monotonic() - started_at
+
+                metrics.inc('uploader_uploads_total')
+                metrics.inc('uploader_uploaded_bytes_total', sent)
+                metrics.observe('uploader_upload_seconds', elapsed)
+                if elapsed > 0:
+                    metrics.set('uploader_bytes_per_second', sent / elapsed)
+
+            filename = directory_methods.extract_filename(dest_path)
+            filename = directory_methods.change_extension(filename, VIDEO_EXTENSION)
+            try:
+                self._storage.rename(dest_path, filename)
+            except PathExistsError:
+                # Прошлая попытка уже переименовала файл в хранилище, но не успела переименовать локальный
+                print(f'{filename} is already uploaded')
+            directory_methods.change_extension(src_path, VIDEO_EXTENSION, rename_file=True)
+
+        except ParentNotFoundError as e:
+            # Папку удалили на диске, при следующей попытке она будет создана заново
             print('Error while sending to disk!')
             print(e)
+            self._directories.discard(directory_methods.extract_directories(dest_path)[0])
+            metrics.inc('uploader_upload_failures_total')
+            return False
+        except (StorageError, PermissionError) as e:
+            print('Error while sending to disk!')
+            print(e)
+            metrics.inc('uploader_upload_failures_total')
+            return False
         except (Exception) as e:
             print(f'Unknown exception! {dest_path}')
             print(e)
+            metrics.inc('uploader_upload_failures_total')
+            return False
+
+        return True
+
+    def _upload_file(self, src_path: str, dest_path: str, size: int) -> int:
+        """
+        Загрузка файла по частям с сохранением состояния загрузки в Redis после каждой части.
+        Если для файла сохранена сессия загрузки и хранилище ее еще помнит, загрузка продолжается с того объема,
+        который уже получило хранилище.
+        :param src_path: Путь до файла
+        :param dest_path: Путь файла в хранилище
+        :param size: Размер файла
+        :return: Количество отправленных байт
+        """
+        storage = self._storage
+        db = RedisConnection()
+
+        session, offset = None, 0
+        checkpoint = db.get_upload_checkpoint(dest_path) if storage.resumable else None
+        if checkpoint is not None and checkpoint['size'] == size:
+            with contextlib.suppress(UploadSessionExpired):
+                offset = storage.get_offset(checkpoint['session'])
+                session = checkpoint['session']
+                print(f'Resume upload of {dest_path} from {offset}/{size} bytes')
+                Metrics.get().inc('uploader_resumed_uploads_total')
+
+        if session is None:
+            try:
+                session, offset = storage.create_upload(dest_path, size), 0
+            except PathExistsError:
+                db.delete_upload_checkpoint(dest_path)
+                raise
+
+        def save_checkpoint(uploaded: int):
+            if storage.resumable:
+                db.save_upload_checkpoint(dest_path, session, size, uploaded)
+
+        save_checkpoint(offset)
+        with open(src_path, 'rb') as file:
+            storage.upload(
+                session, ThrottledReader(file, self._bandwidth), offset, size,
+                self._bandwidth.chunk_size(UPLOAD_CHUNK_SIZE), save_checkpoint,
+            )
+        db.delete_upload_checkpoint(dest_path)
+        return size - offset
 
     def _mkdir_recursively(self, path: str):
         """
-        Создает вложенные директории на Яндекс диске
+        Создает вложенные директории на Яндекс диске.
+        Папки из кэша не проверяются, остальные создаются за один проход от первой неизвестной папки без
+        предварительной проверки существования (существующая папка просто добавляется в кэш).
         :param path: Путь до файла/папки, из которого извлекаются необходимые для создания директории
         :return:
         """
         dirs = directory_methods.extract_directories(path)
 
-        for d in dirs:
-            if not self._conn.exists(d):
-                self._conn.mkdir(d)
+        # Самая глубокая известная папка: все ее родители тоже существуют
+        known = next((i for i in range(len(dirs) - 1, -1, -1) if dirs[i] in self._directories), -1)
+
+        for d in dirs[known + 1:]:
+            try:
+                self._storage.mkdir(d)
+            except DirectoryExistsError:
+                pass
+            self._directories.add(d)
+
+    @staticmethod
+    def _destination(path: str) -> str:
+        """
+        Папка назначения видео на диске (для ограничения одновременных загрузок в одну папку).
+        """
+        return os.path.dirname(path)
+
+    def _upload_task(self, entry_id: str, video_path: str, attempts: int):
+        """
+        Загрузка видео из очереди и подтверждение сообщения (или откладывание загрузки при ошибке).
+        Если подтвердить сообщение не удалось, оно остается за загрузчиком и будет обработано заново.
+        :param entry_id: Идентификатор сообщения
+        :param video_path: Путь к видео
+        :param attempts: Количество предыдущих неудачных попыток
+        """
+        db = RedisConnection()
+        print('Sending video...')
+        if self.upload_video(video_path, video_path):
+            db.ack_upload(entry_id)
+            print('Completed')
+            return
+
+        attempts += 1
+        if attempts >= UPLOAD_MAX_ATTEMPTS:
+            print(f'Give up uploading {video_path} after {attempts} attempts!')
+            db.dead_letter_upload(entry_id, video_path, attempts)
+            Metrics.get().inc('uploader_dead_letters_total')
+            return
+
+        delay = min(UPLOAD_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1), UPLOAD_MAX_RETRY_BACKOFF_SECONDS)
+        db.retry_upload(entry_id, video_path, attempts, time.time() + delay)
+        Metrics.get().inc('uploader_upload_retries_total')
+
+    def _on_done(self, entry_id: str, destination: str, future: Future):
+        with self._lock:
+            self._entries.discard(entry_id)
+            self._in_flight[destination] -= 1
+            if not self._in_flight[destination]:
+                del self._in_flight[destination]
+        self._wakeup.set()
+
+        if (e := future.exception()) is not None:
+            print('Upload worker failed!')
+            print(e)
+
+    @staticmethod
+    def _priority(entry: tuple[str, str, int]) -> tuple[int, int, int]:
+        """
+        Ключ сортировки очереди: приоритет очереди, из которой получено сообщение (меньше - раньше), затем время
+        постановки в очередь из идентификатора сообщения.
+        :param entry: Сообщение (идентификатор сообщения, путь к видео, количество неудачных попыток)
+        """
+        priority, stream_id = split_upload_id(entry[0])
+        ms, seq = stream_id.split('-')
+        return priority, int(ms), int(seq)
+
+    def _dispatch(self, executor: ThreadPoolExecutor, queue: deque):
+        """
+        Отправка видео из очереди в пул загрузок в порядке приоритета с учетом общего лимита и лимита на папку
+        назначения. Видео, папка которых занята, остаются в очереди.
+        :param executor: Пул потоков загрузки
+        :param queue: Очередь сообщений (идентификатор сообщения, путь к видео, количество неудачных попыток)
+        """
+        entries = deque(sorted(queue, key=self._priority))
+        queue.clear()
+
+        waiting = deque()
+        while entries:
+            entry = entries.popleft()
+            entry_id, video_path, _ = entry
+            destination = self._destination(video_path)
+
+            with self._lock:
+                free = sum(self._in_flight.values()) < self.workers
+                if free and self._in_flight[destination] < self.per_destination:
+                    self._in_flight[destination] += 1
+                    self._entries.add(entry_id)
+                else:
+                    waiting.append(entry)
+                    if not free:
+                        break
+                    continue
+
+            future = executor.submit(self._upload_task, *entry)
+            future.add_done_callback(lambda f, e=entry_id, d=destination: self._on_done(e, d, f))
+
+        queue.extend(waiting)
+        queue.extend(entries)
+
+    def _heartbeat(self, db: RedisConnection, queue: deque):
+        """
+        Продление сообщений загрузчика, возврат в очередь отложенных видео, перехват сообщений умерших загрузчиков,
+        смена ограничения скорости по времени суток и обновление метрик очереди.
+        :param db: Указатель на базу данных
+        :param queue: Очередь сообщений загрузчика
+        """
+        with self._lock:
+            entry_ids = list(self._entries)
+            in_flight = sum(self._in_flight.values())
+        db.touch_uploads(self.consumer, entry_ids + [entry_id for entry_id, _, _ in queue])
+
+        db.requeue_due_uploads(time.time())
+        # Сообщений умерших загрузчиков перехватывается не больше, чем свободно в окне UPLOAD_QUEUE_WINDOW (см. _seek)
+        count = UPLOAD_QUEUE_WINDOW - in_flight - len(queue)
+        if count > 0 and (stale := db.claim_stale_uploads(self.consumer, count)):
+            print(f'Claimed {len(stale)} uploads of dead uploaders')
+            queue.extend(stale)
+        db.remove_idle_upload_consumers(self.consumer)
+
+        self._bandwidth.set_rate(bandwidth_limit(UPLOAD_BANDWIDTH_PROFILES, datetime.now()))
+
+        stats = db.upload_queue_stats()
+        metrics = Metrics.get()
+        metrics.set('uploader_queue_depth', stats['queued'])
+        metrics.set('uploader_retry_queue_depth', stats['retry'])
+        metrics.set('uploader_dead_letters', stats['dead'])
+        self._report_rate(db, stats['queued'] + stats['retry'])
+
+    def _report_rate(self, db: RedisConnection, queued: int):
+        """
+        Метрики скорости: ограничение, текущая скорость (с прошлого измерения), объем очереди и оценка времени,
+        за которое очередь будет загружена.
+        Объем очереди оценивается по среднему размеру последних UPLOAD_BACKLOG_SAMPLE_SIZE видео каждой очереди,
+        чтобы не читать очередь целиком и не проверять каждый файл на каждом heartbeat.
+        :param db: Указатель на базу данных
+        :param queued: Количество видео в очереди (вместе с отложенными)
+        """
+        consumed, measured_at = self._bandwidth.consumed, time.monotonic()
+        previous, previous_at = self._rate_sample
+        self._rate_sample = (consumed, measured_at)
+        rate = (consumed - previous) / (measured_at - previous_at) if measured_at > previous_at else 0
+
+        sizes = []
+        for path in db.sample_upload_paths(UPLOAD_BACKLOG_SAMPLE_SIZE):
+            for candidate in (path, directory_methods.change_extension(path, 'tmp')):
+                if directory_methods.exists(candidate):
+                    sizes.append(directory_methods.get_size(candidate))
+                    break
+        backlog = sum(sizes) / len(sizes) * queued if sizes else 0
+
+        metrics = Metrics.get()
+        metrics.set('uploader_bandwidth_limit_bytes_per_second', self._bandwidth.rate or 0)
+        metrics.set('uploader_rate_bytes_per_second', rate)
+        metrics.set('uploader_backlog_bytes', backlog)
+
+        # Пока загрузок не было, время оценивается по ограничению скорости
+        if drain_rate := rate or self._bandwidth.rate:
+            metrics.set('uploader_backlog_drain_seconds', backlog / drain_rate)
+        elif not backlog:
+            metrics.set('uploader_backlog_drain_seconds', 0)
+
+    def _recover_tmp_files(self, db: RedisConnection):
+        """
+        Постановка в очередь загрузки .tmp файлов из папок записей, которых нет в очереди (загрузка прервалась
+        до появления очереди или сообщение о них потерялось).
+        :param db: Указатель на базу данных
+        """
+        queued = {os.path.normpath(path) for path in db.queued_upload_paths()}
+        records = db.get_all_records()
+        folders = {info['path'] for kind in records.values() for info in kind.values() if info.get('path')}
+
+        recovered = 0
+        for folder in folders:
+            for tmp_path in glob.glob(os.path.join(glob.escape(folder), '**', '*.tmp'), recursive=True):
+                path = directory_methods.change_extension(tmp_path, VIDEO_EXTENSION)
+                if os.path.normpath(path) in queued or directory_methods.exists(path):
+                    continue
+                db.enqueue_upload(path)
+                recovered += 1
+
+        if recovered:
+            print(f'Recovered {recovered} interrupted uploads')
+            Metrics.get().inc('uploader_recovered_files_total', recovered)
 
     def _seek(self):
         """
-        Поиск готовых для отправки видео через систему publisher-subscriber Redis
+        Получение готовых для отправки видео из очереди загрузки в Redis.
+        При запуске сначала загружаются видео, полученные, но не подтвержденные до перезапуска (если имя загрузчика
+        задано явно и сохраняется между перезапусками).
         :return:
         """
-        subscription = RedisConnection().subscribe(PUBSUB_VIDEO_CHANNEL_NAME)
-        while True:
-            if message := subscription.get_message(ignore_subscribe_messages=True):
-                video_path = message['data'].decode('utf-8')
-                print('Sending video...')
-                self.upload_video(video_path, video_path)
-                print('Completed')
-            time.sleep(1)
+        db = RedisConnection()
+        db.create_upload_group()
+        queue = deque(db.read_uploads(self.consumer, count=None, pending=True))
+        if queue:
+            print(f'Replay {len(queue)} unacknowledged uploads')
+        self._recover_tmp_files(db)
+
+        heartbeat_at = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='uploader') as executor:
+            while True:
+                if time.monotonic() >= heartbeat_at:
+                    self._heartbeat(db, queue)
+                    heartbeat_at = time.monotonic() + UPLOAD_HEARTBEAT_SECONDS
+
+                with self._lock:
+                    in_flight = sum(self._in_flight.values())
+
+                # Сообщений берется не больше UPLOAD_QUEUE_WINDOW (сначала из очередей с высоким приоритетом),
+                # остальные достанутся другим загрузчикам
+                if (count := UPLOAD_QUEUE_WINDOW - in_flight - len(queue)) > 0:
+                    queue.extend(db.read_uploads(self.consumer, count))
+
+                self._dispatch(executor, queue)
+                Metrics.get().set('uploader_uploads_in_flight', in_flight)
+
+                # Ожидание завершения загрузки или следующей проверки очереди
+                self._wakeup.wait(timeout=1)
+                self._wakeup.clear()
 
     def run(self) -> None:
         super().run()
-        self._conn = yadisk.YaDisk(token=self._token)
+        self._setup()
         self._seek()
 
 
 if __name__ == '__main__':
     yandex_disk = DiskConnection(token='y0_AgAAAAALeWngAAk_4QAAAADhNY13bDy5DG7RRCeiby8aDYpzelmB_wY')
-    yandex_disk._conn = yadisk.YaDisk(token='y0_AgAAAAALeWngAAk_4QAAAADhNY13bDy5DG7RRCeiby8aDYpzelmB_wY')
-
-    import glob
+    yandex_disk._setup()
 
     for file in glob.glob('../../Exchange/Planeta/20 April 2023/*.mkv') + glob.glob('../../Exchange/Planeta/20 April 2023/*.tmp'):
         print(file, file[6:])
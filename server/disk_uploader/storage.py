@@ -0,0 +1,248 @@
+import contextlib
+
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Callable
+
+import requests
+import yadisk
+
+from server.const import UPLOAD_STORAGE_URL
+
+
+class StorageError(Exception):
+    """
+    Ошибка удаленного хранилища.
+    """
+
+
+class PathExistsError(StorageError):
+    """
+    Файл или папка уже есть в хранилище.
+    """
+
+
+class DirectoryExistsError(PathExistsError):
+    """
+    Папка уже есть в хранилище.
+    """
+
+
+class ParentNotFoundError(StorageError):
+    """
+    В хранилище нет родительской папки.
+    """
+
+
+class UploadSessionExpired(StorageError):
+    """
+    Хранилище больше не знает сессию загрузки, загрузку нужно начать заново.
+    """
+
+
+class RemoteStorage(ABC):
+    """
+    Удаленное хранилище видео.
+    Файл загружается в рамках сессии загрузки (create_upload) по частям (write_chunk); хранилище создает файл,
+    когда получены все его байты. Если хранилище умеет продолжать загрузку (resumable), то после сбоя загрузка
+    продолжается с смещения, которое вернет get_offset.
+    """
+    resumable = True
+
+    @abstractmethod
+    def mkdir(self, path: str):
+        """
+        Создание папки.
+        :param path: Путь к папке
+        :raises DirectoryExistsError: Папка уже существует
+        :raises ParentNotFoundError: Нет родительской папки
+        """
+
+    @abstractmethod
+    def rename(self, path: str, new_name: str):
+        """
+        Переименование файла в той же папке.
+        :param path: Путь к файлу
+        :param new_name: Новое имя файла
+        :raises PathExistsError: Файл с новым именем уже существует
+        """
+
+    @abstractmethod
+    def create_upload(self, path: str, size: int) -> str:
+        """
+        Начало загрузки файла.
+        :param path: Путь к файлу в хранилище
+        :param size: Размер файла в байтах
+        :return: Идентификатор сессии загрузки
+        :raises PathExistsError: Файл уже существует
+        :raises ParentNotFoundError: Нет родительской папки
+        """
+
+    @abstractmethod
+    def get_offset(self, session: str) -> int:
+        """
+        Количество байт файла, которое уже получило хранилище.
+        :param session: Идентификатор сессии загрузки
+        :raises UploadSessionExpired: Сессия больше не существует
+        """
+
+    @abstractmethod
+    def write_chunk(self, session: str, offset: int, chunk: bytes) -> int:
+        """
+        Загрузка части файла.
+        :param session: Идентификатор сессии загрузки
+        :param offset: Смещение части в файле
+        :param chunk: Часть файла
+        :return: Количество байт файла, которое получило хранилище
+        :raises UploadSessionExpired: Сессия больше не существует
+        """
+
+    def upload(self, session: str, file: BinaryIO, offset: int, size: int, chunk_size: int,
+               on_progress: Callable[[int], None]):
+        """
+        Загрузка файла по частям начиная со смещения offset.
+        :param session: Идентификатор сессии загрузки
+        :param file: Файл, открытый на чтение в двоичном режиме
+        :param offset: Смещение, с которого продолжается загрузка
+        :param size: Размер файла
+        :param chunk_size: Размер части файла
+        :param on_progress: Вызывается после каждой загруженной части с новым смещением
+        """
+        file.seek(offset)
+        while offset < size:
+            offset = self.write_chunk(session, offset, file.read(chunk_size))
+            file.seek(offset)
+            on_progress(offset)
+
+
+class YandexStorage(RemoteStorage):
+    """
+    Яндекс Диск.
+    API Яндекс Диска не умеет продолжать прерванную загрузку, поэтому файл загружается одним запросом
+    (с чтением файла по мере отправки), а после сбоя - заново.
+    :param token: Токен доступа к Яндекс Диску
+    """
+    resumable = False
+
+    def __init__(self, token: str):
+        self._disk = yadisk.YaDisk(token=token)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _errors():
+        try:
+            yield
+        except yadisk.exceptions.DirectoryExistsError as e:
+            raise DirectoryExistsError(str(e)) from e
+        except yadisk.exceptions.PathExistsError as e:
+            raise PathExistsError(str(e)) from e
+        except yadisk.exceptions.ParentNotFoundError as e:
+            raise ParentNotFoundError(str(e)) from e
+        except yadisk.exceptions.YaDiskError as e:
+            raise StorageError(str(e)) from e
+
+    def mkdir(self, path: str):
+        with self._errors():
+            self._disk.mkdir(path)
+
+    def rename(self, path: str, new_name: str):
+        with self._errors():
+            self._disk.rename(path, new_name)
+
+    def create_upload(self, path: str, size: int) -> str:
+        with self._errors():
+            return self._disk.get_upload_link(path, overwrite=False)
+
+    def get_offset(self, session: str) -> int:
+        raise UploadSessionExpired(session)
+
+    def write_chunk(self, session: str, offset: int, chunk: bytes) -> int:
+        raise StorageError('Yandex Disk does not support chunked uploads')
+
+    def upload(self, session: str, file: BinaryIO, offset: int, size: int, chunk_size: int,
+               on_progress: Callable[[int], None]):
+        file.seek(0)
+        with self._errors():
+            self._disk.upload_by_link(file, session, n_retries=3)
+        on_progress(size)
+
+
+class HttpChunkedStorage(RemoteStorage):
+    """
+    HTTP-хранилище с возобновляемой загрузкой по протоколу в духе tus 1.0:
+    - POST {url}/mkdir?path=... - создание папки (201; 409 - папка существует; 404 - нет родительской папки);
+    - POST {url}/move?path=...&name=... - переименование (201; 409 - новое имя занято);
+    - POST {url}/uploads?path=... с заголовком Upload-Length - начало загрузки (201, адрес сессии в Location;
+      409 - файл существует; 404 - нет родительской папки);
+    - HEAD {сессия} - смещение в заголовке Upload-Offset (404 - сессии нет);
+    - PATCH {сессия} с заголовком Upload-Offset и частью файла - загрузка части (204, новое смещение
+      в Upload-Offset; 404 - сессии нет; 409 - смещение не совпало).
+    Подходит для своего сервера хранения или локального сервера-заглушки при отладке загрузчика.
+    :param url: Адрес сервера
+    :param token: Токен доступа (заголовок Authorization)
+    """
+
+    def __init__(self, url: str, token: str):
+        self.url = url.rstrip('/')
+        self._session = requests.Session()
+        self._session.headers['Authorization'] = f'OAuth {token}'
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        try:
+            response = self._session.request(method, url, timeout=60, **kwargs)
+        except requests.RequestException as e:
+            raise StorageError(str(e)) from e
+        if response.status_code >= 400 and response.status_code not in (404, 409):
+            raise StorageError(f'{method} {url}: {response.status_code} {response.text}')
+        return response
+
+    def mkdir(self, path: str):
+        response = self._request('POST', f'{self.url}/mkdir', params={'path': path})
+        if response.status_code == 409:
+            raise DirectoryExistsError(path)
+        if response.status_code == 404:
+            raise ParentNotFoundError(path)
+
+    def rename(self, path: str, new_name: str):
+        response = self._request('POST', f'{self.url}/move', params={'path': path, 'name': new_name})
+        if response.status_code == 409:
+            raise PathExistsError(new_name)
+        if response.status_code == 404:
+            raise StorageError(f'{path} not found')
+
+    def create_upload(self, path: str, size: int) -> str:
+        response = self._request(
+            'POST', f'{self.url}/uploads', params={'path': path}, headers={'Upload-Length': str(size)},
+        )
+        if response.status_code == 409:
+            raise PathExistsError(path)
+        if response.status_code == 404:
+            raise ParentNotFoundError(path)
+        return requests.compat.urljoin(f'{self.url}/', response.headers['Location'])
+
+    def get_offset(self, session: str) -> int:
+        response = self._request('HEAD', session)
+        if response.status_code != 200:
+            raise UploadSessionExpired(session)
+        return int(response.headers['Upload-Offset'])
+
+    def write_chunk(self, session: str, offset: int, chunk: bytes) -> int:
+        response = self._request(
+            'PATCH', session, data=chunk,
+            headers={'Upload-Offset': str(offset), 'Content-Type': 'application/offset+octet-stream'},
+        )
+        if response.status_code == 404:
+            raise UploadSessionExpired(session)
+        if response.status_code == 409:
+            # Сервер получил другое количество байт (например, ответ на прошлую часть потерялся)
+            return self.get_offset(session)
+        return int(response.headers['Upload-Offset'])
+
+
+def create_storage(token: str) -> RemoteStorage:
+    """
+    Создание хранилища для загрузчика: HTTP-хранилище, если задан UPLOAD_STORAGE_URL, иначе Яндекс Диск.
+    :param token: Токен доступа к хранилищу
+    """
+    if UPLOAD_STORAGE_URL:
+        return HttpChunkedStorage(UPLOAD_STORAGE_URL, token)
+    return YandexStorage(token)
@@ -0,0 +1,218 @@
+import os
+import threading
+import time
+
+from collections import defaultdict
+from typing import Literal
+
+from server.const import METRICS_FLUSH_INTERVAL_SECONDS
+from server.database import RedisConnection
+
+
+MetricType = Literal['counter', 'gauge', 'summary']
+
+# Описание всех метрик: имя -> (тип, описание)
+METRICS: dict[str, tuple[MetricType, str]] = {
+    'scheduler_records_started_total': ('counter', 'Records started by the scheduler'),
+    'scheduler_start_lag_seconds': ('summary', 'Actual record start minus scheduled start'),
+    'scheduler_leases_lost_total': ('counter', 'Records stopped because another node took over their lease'),
+    'scheduler_tasks_reaped_total': ('counter', 'Tasks released after their lease expired'),
+    'scheduler_node_running': ('gauge', 'Records running on the node'),
+    'scheduler_node_capacity': ('gauge', 'Maximum number of records running on the node'),
+    'supervisor_admission_rejected_total': ('counter', 'Record starts refused because the node is out of budget'),
+    'supervisor_recorder_crashes_total': ('counter', 'Recorder processes that exited with a non-zero code'),
+    'supervisor_recorder_restarts_total': ('counter', 'Recorder processes restarted after a crash'),
+
+    'recorder_frames_written_total': ('counter', 'Frames written by video recorders'),
+    'recorder_dropped_frames_total': ('counter', 'Frames dropped because the encoder fell behind the capture'),
+    'recorder_retrieve_failures_total': ('counter', 'Failed VideoCapture.retrieve() calls'),
+    'recorder_motion_skipped_segments_total': ('counter', 'Segments without motion that were not written'),
+    'recorder_segments_total': ('counter', 'Segments written by stream copy recorders'),
+    'recorder_reconnects_total': ('counter', 'Reconnects to cameras'),
+    'recorder_lease_lost_total': ('counter', 'Recorders stopped because their lease or parent process was lost'),
+    'recorder_stale_keyframes_total': ('counter', 'Timelapse deadlines skipped because no new keyframe arrived'),
+    'recorder_achieved_fps': ('gauge', 'Frames per second written during the last segment'),
+    'recorder_camera_fps': ('gauge', 'Frames per second reported by the camera'),
+    'recorder_segment_write_seconds': ('summary', 'Time spent encoding and writing one segment'),
+
+    'encoder_pool_pending_frames': ('gauge', 'Frames waiting for an encoder pool worker'),
+    'encoder_pool_dropped_frames_total': ('counter', 'Frames overwritten in the ring buffer before encoding'),
+    'encoder_pool_failed_segments_total': ('counter', 'Segments skipped because encoding failed'),
+    'encoder_pool_worker_restarts_total': ('counter', 'Encoder pool workers restarted after a crash'),
+
+    'uploader_queue_depth': ('gauge', 'Segments waiting for upload'),
+    'uploader_retry_queue_depth': ('gauge', 'Segments waiting for another upload attempt'),
+    'uploader_dead_letters': ('gauge', 'Segments that could not be uploaded after all attempts'),
+    'uploader_upload_retries_total': ('counter', 'Failed uploads scheduled for another attempt'),
+    'uploader_dead_letters_total': ('counter', 'Segments moved to the dead-letter list'),
+    'uploader_resumed_uploads_total': ('counter', 'Uploads resumed from a saved checkpoint'),
+    'uploader_recovered_files_total': ('counter', 'Leftover .tmp files queued for upload at startup'),
+    'uploader_bandwidth_limit_bytes_per_second': ('gauge', 'Current upload bandwidth limit (0 - unlimited)'),
+    'uploader_rate_bytes_per_second': ('gauge', 'Upload rate of all workers since the previous measurement'),
+    'uploader_backlog_bytes': ('gauge', 'Size of segments waiting for upload'),
+    'uploader_backlog_drain_seconds': ('gauge', 'Expected time to upload the backlog at the current rate'),
+    'uploader_uploads_in_flight': ('gauge', 'Segments being uploaded right now'),
+    'uploader_uploads_total': ('counter', 'Uploaded segments'),
+    'uploader_upload_failures_total': ('counter', 'Failed segment uploads'),
+    'uploader_uploaded_bytes_total': ('counter', 'Uploaded bytes'),
+    'uploader_upload_seconds': ('summary', 'Time spent uploading one segment'),
+    'uploader_bytes_per_second': ('gauge', 'Upload speed of the last segment'),
+}
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metric_key(name: str, **labels) -> str:
+    """
+    Имя метрики с метками в формате Prometheus.
+    Пример: ('recorder_reconnects_total', camera='cam') -> 'recorder_reconnects_total{camera="cam"}'.
+    :param name: Имя метрики
+    :param labels: Метки
+    :return: Строка с именем и метками
+    """
+    if not labels:
+        return name
+    label_str = ','.join(f'{label}="{_escape(value)}"' for label, value in sorted(labels.items()))
+    return f'{name}{{{label_str}}}'
+
+
+class Metrics:
+    """
+    Буфер метрик процесса. Значения копятся локально и отправляются в Redis одним pipeline
+    не чаще, чем раз в METRICS_FLUSH_INTERVAL_SECONDS (см. RedisConnection.push_metrics), в том числе фоновым потоком,
+    если процесс давно ничего не записывал. Gauge-метрики отправляются при каждой отправке, поэтому gauge-метрики
+    живого процесса не устаревают (см. METRICS_GAUGE_TTL_SECONDS), а метрики умершего процесса перестают отдаваться.
+    Для каждого процесса создается свой экземпляр (см. Metrics.get), поэтому значения,
+    накопленные родителем до fork, не дублируются в дочерних процессах.
+
+    :param self._counters: Приращения счетчиков (включая _sum и _count у summary)
+    :param self._gauges: Последние значения gauge-метрик
+    :param self._removed: Gauge-метрики, которые нужно удалить из Redis при следующей отправке
+    """
+    _instance = None
+    _pid = None
+
+    @classmethod
+    def get(cls) -> 'Metrics':
+        """
+        Экземпляр буфера для текущего процесса.
+        :return: Объект Metrics
+        """
+        if cls._instance is None or cls._pid != os.getpid():
+            cls._instance = cls()
+            cls._pid = os.getpid()
+        return cls._instance
+
+    def __init__(self, flush_interval: float = METRICS_FLUSH_INTERVAL_SECONDS):
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters: dict[str, float] = defaultdict(float)
+        self._gauges: dict[str, float] = {}
+        self._removed: set[str] = set()
+        self._flushed_at = time.monotonic()
+
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.maybe_flush()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Увеличение счетчика.
+        :param name: Имя метрики
+        :param value: Приращение
+        :param labels: Метки
+        """
+        with self._lock:
+            self._counters[metric_key(name, **labels)] += value
+        self.maybe_flush()
+
+    def set(self, name: str, value: float, **labels):
+        """
+        Установка значения gauge-метрики.
+        :param name: Имя метрики
+        :param value: Значение
+        :param labels: Метки
+        """
+        with self._lock:
+            self._gauges[metric_key(name, **labels)] = value
+        self.maybe_flush()
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Добавление наблюдения в summary-метрику (сумма и количество наблюдений).
+        :param name: Имя метрики
+        :param value: Наблюдаемое значение
+        :param labels: Метки
+        """
+        with self._lock:
+            self._counters[metric_key(f'{name}_sum', **labels)] += value
+            self._counters[metric_key(f'{name}_count', **labels)] += 1
+        self.maybe_flush()
+
+    def remove_gauges(self, **labels):
+        """
+        Удаление gauge-метрик процесса с указанными метками (например, всех метрик камеры после окончания записи).
+        Метрики удаляются из Redis сразу.
+        :param labels: Метки
+        """
+        label_strs = [f'{label}="{_escape(value)}"' for label, value in labels.items()]
+        with self._lock:
+            for key in [key for key in self._gauges if all(label in key for label in label_strs)]:
+                del self._gauges[key]
+                self._removed.add(key)
+        self.flush()
+
+    def maybe_flush(self):
+        """
+        Отправка метрик в Redis, если с прошлой отправки прошло больше flush_interval секунд.
+        """
+        if time.monotonic() - self._flushed_at >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Отправка накопленных метрик в Redis.
+        """
+        with self._lock:
+            counters, gauges, removed = dict(self._counters), dict(self._gauges), self._removed
+            self._counters.clear()
+            self._removed = set()
+            self._flushed_at = time.monotonic()
+
+        if not counters and not gauges and not removed:
+            return
+
+        try:
+            RedisConnection().push_metrics(counters, gauges, removed)
+        except Exception as e:
+            print('Can\'t push metrics!')
+            print(e)
+
+
+def render_prometheus(counters: dict[str, float], gauges: dict[str, float]) -> str:
+    """
+    Перевод метрик из Redis в текстовый формат Prometheus.
+    :param counters: Значения счетчиков (ключ - имя с метками)
+    :param gauges: Значения gauge-метрик (ключ - имя с метками)
+    :return: Текст для эндпоинта /metrics
+    """
+    samples: dict[str, list[str]] = defaultdict(list)
+    for key, value in (counters | gauges).items():
+        name = key.split('{', 1)[0]
+        for suffix in ('_sum', '_count'):
+            if name.endswith(suffix) and METRICS.get(name[:-len(suffix)], ('',))[0] == 'summary':
+                name = name[:-len(suffix)]
+        samples[name].append(f'{key} {value}')
+
+    lines = []
+    for name in sorted(samples):
+        metric_type, description = METRICS.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.extend(sorted(samples[name]))
+    return '\n'.join(lines) + '\n'
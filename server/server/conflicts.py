@@ -0,0 +1,143 @@
+import heapq
+
+from collections import defaultdict
+from datetime import datetime, time
+from typing import Literal, NamedTuple
+
+from server.weekly_schedule import MINUTES_IN_DAY, MINUTES_IN_WEEK, week_intervals
+
+
+class Interval(NamedTuple):
+    """
+    Интервал записи камеры.
+    :param start: Начало (timestamp для отложенных записей, минута недели для регулярных)
+    :param end: Конец (не включительно)
+    :param kind: 'delayed' или 'regular'
+    :param name: Имя записи
+    :param index: Номер интервала в записи
+    :param existing: Сохранена ли запись в БД (True) или импортируется (False)
+    """
+    start: float
+    end: float
+    kind: Literal['delayed', 'regular']
+    name: str
+    index: int
+    existing: bool
+
+
+def _overlapping_pairs(intervals: list[Interval]):
+    """
+    Поиск всех пар пересекающихся интервалов сортировкой и одним проходом (sweep line).
+    Сложность O(n log n + k), где k - количество найденных пар.
+    :param intervals: Интервалы одной камеры
+    :return: Генератор пар (более ранний интервал, более поздний интервал)
+    """
+    active: list[tuple[float, int, Interval]] = []
+    for i, current in enumerate(sorted(intervals)):
+        while active and active[0][0] <= current.start:
+            heapq.heappop(active)
+        for _, _, other in active:
+            yield other, current
+        heapq.heappush(active, (current.end, i, current))
+
+
+def _project_to_week(start: datetime, end: datetime) -> list[tuple[int, int]]:
+    """
+    Проекция отложенного интервала на неделю (в минутах от начала недели) для сравнения с регулярными записями.
+    :param start: Начало интервала
+    :param end: Конец интервала
+    :return: Список интервалов в минутах недели
+    """
+    duration = int((end - start).total_seconds() // 60)
+    if duration >= MINUTES_IN_WEEK:
+        return [(0, MINUTES_IN_WEEK)]
+
+    a = start.weekday() * MINUTES_IN_DAY + start.hour * 60 + start.minute
+    b = a + duration
+    if b > MINUTES_IN_WEEK:
+        return [(a, MINUTES_IN_WEEK), (0, b - MINUTES_IN_WEEK)]
+    return [(a, b)] if a < b else []
+
+
+class ConflictFinder:
+    """
+    Поиск пересекающихся интервалов записи одной камеры (камера определяется по rtsp_url).
+    Отложенные записи сравниваются между собой по абсолютному времени, регулярные - между собой и с отложенными
+    в минутах от начала недели.
+
+    :param self._delayed: Отложенные интервалы по камерам
+    :param self._weekly: Регулярные и спроецированные на неделю отложенные интервалы по камерам
+    """
+
+    def __init__(self):
+        self._delayed: dict[str, list[Interval]] = defaultdict(list)
+        self._weekly: dict[str, list[Interval]] = defaultdict(list)
+
+    def add_delayed(self, camera: str, name: str, index: int, start: datetime, end: datetime, existing=False):
+        """
+        Добавление интервала отложенной записи.
+        :param camera: URL камеры
+        :param name: Имя записи
+        :param index: Номер интервала в записи
+        :param start: Начало интервала
+        :param end: Конец интервала
+        :param existing: Сохранена ли запись в БД
+        """
+        self._delayed[camera].append(Interval(start.timestamp(), end.timestamp(), 'delayed', name, index, existing))
+        for a, b in _project_to_week(start, end):
+            self._weekly[camera].append(Interval(a, b, 'delayed', name, index, existing))
+
+    def add_regular(self, camera: str, name: str, index: int, time_from: time, time_to: time,
+                    days_of_week: list[int], existing=False):
+        """
+        Добавление интервала регулярной записи.
+        :param camera: URL камеры
+        :param name: Имя записи
+        :param index: Номер интервала в записи
+        :param time_from: Время начала
+        :param time_to: Время конца
+        :param days_of_week: Дни недели
+        :param existing: Сохранена ли запись в БД
+        """
+        for a, b in week_intervals(time_from, time_to, days_of_week):
+            self._weekly[camera].append(Interval(a, b, 'regular', name, index, existing))
+
+    def find(self) -> list[dict]:
+        """
+        Поиск конфликтов. Конфликты между двумя уже сохраненными записями не сообщаются.
+        :return: Список конфликтов в json-friendly формате
+        """
+        found = {}
+
+        def report(camera: str, first: Interval, second: Interval):
+            if first.existing and second.existing:
+                return
+            # Части одного интервала, разбитого на границе недели
+            if (first.kind, first.name, first.index) == (second.kind, second.name, second.index):
+                return
+            # Импортируемый интервал указывается первым
+            if first.existing:
+                first, second = second, first
+
+            key = (camera, first.kind, first.name, first.index, second.kind, second.name, second.index)
+            found.setdefault(key, {
+                'reason': 'overlap',
+                'camera': camera,
+                'record': {'type': first.kind, 'name': first.name, 'interval': first.index},
+                'conflictsWith': {
+                    'type': second.kind, 'name': second.name, 'interval': second.index, 'existing': second.existing,
+                },
+            })
+
+        for camera, intervals in self._delayed.items():
+            for first, second in _overlapping_pairs(intervals):
+                report(camera, first, second)
+
+        for camera, intervals in self._weekly.items():
+            for first, second in _overlapping_pairs(intervals):
+                # Пары отложенных интервалов уже проверены по абсолютному времени
+                if first.kind == second.kind == 'delayed':
+                    continue
+                report(camera, first, second)
+
+        return list(found.values())
@@ -0,0 +1,52 @@
+import json
+
+from typing import Optional
+
+
+class RecordsCache:
+    """
+    Кэш сериализованного списка записей для GET-запроса списка записей.
+    Сбрасывается по уведомлениям из канала PUBSUB_RECORDS_CHANNEL_NAME (см. bump_records_version в database.py).
+    Пока подписка на канал не активна (listening = False), кэш не используется.
+
+    :param self.listening: Активна ли подписка на уведомления об изменениях
+    :param self._generation: Локальный счетчик сбросов. Защищает от сохранения списка, прочитанного до сброса
+    :param self._entry: ETag и тело ответа
+    """
+
+    def __init__(self):
+        self.listening = False
+        self._generation = 0
+        self._entry: Optional[tuple[str, bytes]] = None
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self) -> Optional[tuple[str, bytes]]:
+        """
+        Получение закэшированного ответа.
+        :return: ETag и тело ответа или None, если кэш пуст или ему нельзя доверять
+        """
+        return self._entry if self.listening else None
+
+    def store(self, generation: int, version: int, records: dict) -> tuple[str, bytes]:
+        """
+        Сериализация списка записей и сохранение его в кэш.
+        Список не сохраняется, если с момента начала его чтения (generation) кэш успели сбросить.
+        :param generation: Значение generation на момент начала чтения списка из БД
+        :param version: Версия списка записей в БД
+        :param records: Список записей
+        :return: ETag и тело ответа
+        """
+        entry = (f'"{version}"', json.dumps(records).encode('utf-8'))
+        if self.listening and generation == self._generation:
+            self._entry = entry
+        return entry
+
+    def invalidate(self):
+        """
+        Сброс кэша.
+        """
+        self._generation += 1
+        self._entry = None
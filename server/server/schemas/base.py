@@ -1,12 +1,28 @@
-from pydantic import BaseModel, validator, constr, PositiveFloat, PositiveInt
+from pydantic import BaseModel, validator, constr, conint, confloat, NonNegativeFloat, PositiveFloat, PositiveInt
 from abc import ABC
+from typing import Optional
 
 from server.const import DEFAULT_SEGMENT_TIME
 
 
+class MotionConfig(BaseModel):
+    """
+    Настройки записи по движению.
+    :param pixel_threshold: Минимальное изменение яркости пикселя (0..255), которое считается движением
+    :param min_area: Минимальная доля изменившихся пикселей кадра, при которой кадр считается кадром с движением
+    :param pre_roll: Сколько секунд до начала движения нужно записать
+    :param post_roll: Сколько секунд нужно писать после окончания движения
+    """
+    pixel_threshold: conint(ge=1, le=255) = 25
+    min_area: confloat(gt=0, le=1) = 0.005
+    pre_roll: NonNegativeFloat = 2
+    post_roll: NonNegativeFloat = 10
+
+
 class Config(BaseModel):
     audio: bool = False
     segment_time: PositiveInt = DEFAULT_SEGMENT_TIME
+    motion: Optional[MotionConfig] = None
 
 
 class BaseRecord(ABC, BaseModel):
@@ -0,0 +1,18 @@
+from pydantic import BaseModel, Field
+from typing import List
+
+from server.server.schemas.record import VideoRecorderInput
+from server.server.schemas.record_regular import RegularVideoRecorderInput
+
+
+class BulkRecordsInput(BaseModel):
+    """
+    JSON-схема post-запроса массового импорта расписания.
+    :param records: Отложенные записи (см. VideoRecorderInput)
+    :param regular_records: Регулярные записи (см. RegularVideoRecorderInput), ключ в json - regularRecords
+    """
+    records: List[VideoRecorderInput] = []
+    regular_records: List[RegularVideoRecorderInput] = Field([], alias='regularRecords')
+
+    class Config:
+        allow_population_by_field_name = True
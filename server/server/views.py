@@ -1,12 +1,23 @@
-from fastapi import FastAPI
+import asyncio
+
+from datetime import datetime
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 import server.directory_methods as directory_methods
-from server.const import DATE_FORMAT
+from server.const import DATE_FORMAT, PUBSUB_SCHEDULE_CHANNEL_NAME, PUBSUB_RECORDS_CHANNEL_NAME, \
+    RECONNECT_DELAY_SECONDS
+from server.metrics import render_prometheus
+from server.server.conflicts import ConflictFinder
+from server.server.records_cache import RecordsCache
+from server.server.schemas.bulk import BulkRecordsInput
 from server.server.schemas.record import VideoRecorderInput
 from server.server.schemas.record_regular import RegularVideoRecorderInput
-from server.database import RedisConnection
+from server.async_database import AsyncRedisConnection
 from server.const import REDIS_SERVER, REDIS_PORT, REDIS_DB
+from server.weekly_schedule import week_intervals
 
 
 app = FastAPI()
@@ -24,83 +35,260 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+records_cache = RecordsCache()
 
-@app.post('/')
-async def start_record(rec: VideoRecorderInput):
+
+async def listen_for_record_changes():
     """
-    Post-запрос для записи отложенных видео. См. VideoRecorderInput для списка параметров.
-    :param rec: Входные данные для записи, извлекаемые из json-объекта тела запроса
+    Сброс кэша списка записей по уведомлениям об изменениях в БД.
+    При потере подписки кэш отключается до переподключения.
     """
-    redis_db = RedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+    redis_db = AsyncRedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+    while True:
+        subscription = None
+        try:
+            subscription = await redis_db.subscribe(PUBSUB_RECORDS_CHANNEL_NAME)
+            records_cache.invalidate()
+            records_cache.listening = True
 
-    # Создаю папку, в которую будут записываться видео с изображениями
+            async for message in subscription.listen():
+                if message['type'] == 'message':
+                    records_cache.invalidate()
+        except Exception as e:
+            print('Lost subscription to record changes!')
+            print(e)
+        finally:
+            records_cache.listening = False
+            records_cache.invalidate()
+            if subscription is not None:
+                await subscription.close()
+
+        await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+
+@app.on_event('startup')
+async def connect_to_db():
+    AsyncRedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+    app.state.records_listener = asyncio.create_task(listen_for_record_changes())
+
+
+@app.on_event('shutdown')
+async def disconnect_from_db():
+    app.state.records_listener.cancel()
+    await AsyncRedisConnection().close()
+
+
+def _video_path(rec: VideoRecorderInput | RegularVideoRecorderInput) -> str:
+    """
+    Путь до папки, в которую будут записываться видео.
+    :param rec: Входные данные для записи
+    :return: Путь
+    """
     video_path = f'{rec.path}/{rec.name}' if rec.path != '' else rec.name
-    video_path = directory_methods.to_directory_friendly(video_path)
-    directory_methods.mkdir(video_path)
+    return directory_methods.to_directory_friendly(video_path)
 
-    # Применяю функцию записи к каждому временному интервалу
-    for i, interval in enumerate(rec.intervals):
-        task_db_key = f'videos:{rec.name}:{i}'
 
-        # TODO: Добавить нормальную аннотацию типов через методы класса
-        # Запись в БД
-        redis_db[task_db_key] = {
+def _video_records(rec: VideoRecorderInput) -> dict[str, dict]:
+    """
+    Перевод входных данных отложенной записи в записи БД (по одной на каждый временной интервал).
+    :param rec: Входные данные для записи
+    :return: Словарь "ключ записи -> информация о записи"
+    """
+    # TODO: Добавить нормальную аннотацию типов через методы класса
+    return {
+        f'videos:{rec.name}:{i}': {
             "name": rec.name,
             "comment": rec.comment,
             "rtsp_url": rec.rtsp_url,
-            "path": video_path,
+            "path": _video_path(rec),
             "date_from": interval['date_from'].strftime(DATE_FORMAT),
             "date_to": interval['date_to'].strftime(DATE_FORMAT),
             "fpm": rec.fpm,
             "status": 'queued',
             "with_audio": rec.config.audio,
             "segment_time": rec.config.segment_time,
+            "motion": rec.config.motion and rec.config.motion.dict(),
         }
-
-        # Запуск процесса записи
-        print('Waiting...')
+        for i, interval in enumerate(rec.intervals)
+    }
 
 
-@app.post('/regular')
-async def start_regular_record(rec: RegularVideoRecorderInput):
+def _regular_records(rec: RegularVideoRecorderInput) -> dict[str, dict]:
     """
-    Post-запрос для записи регулярных видео. См. RegularVideoRecorderInput для списка параметров.
-    :param rec: Входные данные для записи, извлекаемые из json-объекта тела запроса
+    Перевод входных данных регулярной записи в записи БД (по одной на каждый временной интервал).
+    :param rec: Входные данные для записи
+    :return: Словарь "ключ записи -> информация о записи"
     """
-    redis_db = RedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
-
-    video_path = f'{rec.path}/{rec.name}' if rec.path != '' else rec.name
-    video_path = directory_methods.to_directory_friendly(video_path)
-
-    for i, interval in enumerate(rec.intervals):
-        task_id = f'regular:{rec.name}:{i}'
-
-        # Запись в БД
-        redis_db[task_id] = {
+    return {
+        f'regular:{rec.name}:{i}': {
             "name": rec.name,
             "comment": rec.comment,
             "rtsp_url": rec.rtsp_url,
-            "path": video_path,
+            "path": _video_path(rec),
             "time_from": interval['time_from'].strftime(DATE_FORMAT),
             "time_to": interval['time_to'].strftime(DATE_FORMAT),
             "fpm": rec.fpm,
             "status": 'queued',
             "days_of_week": rec.days_of_week,
+            "week_intervals": [list(w) for w in week_intervals(interval['time_from'], interval['time_to'],
+                                                               rec.days_of_week)],
             "with_audio": rec.config.audio,
             "segment_time": rec.config.segment_time,
+            "motion": rec.config.motion and rec.config.motion.dict(),
         }
+        for i, interval in enumerate(rec.intervals)
+    }
+
+
+@app.post('/')
+async def start_record(rec: VideoRecorderInput):
+    """
+    Post-запрос для записи отложенных видео. См. VideoRecorderInput для списка параметров.
+    :param rec: Входные данные для записи, извлекаемые из json-объекта тела запроса
+    """
+    redis_db = AsyncRedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+
+    # Создаю папку, в которую будут записываться видео с изображениями
+    await asyncio.to_thread(directory_methods.mkdir, _video_path(rec))
+
+    # Запись в БД одной транзакцией (по записи на каждый временной интервал)
+    await redis_db.add_records(_video_records(rec))
+
+    # Оповещение планировщика об изменении расписания
+    await redis_db.publish(PUBSUB_SCHEDULE_CHANNEL_NAME, rec.name)
+    print('Waiting...')
+
+
+@app.post('/regular')
+async def start_regular_record(rec: RegularVideoRecorderInput):
+    """
+    Post-запрос для записи регулярных видео. См. RegularVideoRecorderInput для списка параметров.
+    :param rec: Входные данные для записи, извлекаемые из json-объекта тела запроса
+    """
+    redis_db = AsyncRedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+
+    await redis_db.add_records(_regular_records(rec))
+
+    await redis_db.publish(PUBSUB_SCHEDULE_CHANNEL_NAME, rec.name)
+
+
+@app.post('/bulk')
+async def import_records(bulk: BulkRecordsInput):
+    """
+    Post-запрос для массового импорта отложенных и регулярных записей. См. BulkRecordsInput для списка параметров.
+    Пересечения интервалов одной камеры (между импортируемыми записями и с уже сохраненными) ищутся за один проход
+    по отсортированным интервалам. Записи без конфликтов сохраняются одной транзакцией, записи с конфликтами
+    пропускаются.
+    :param bulk: Входные данные для импорта, извлекаемые из json-объекта тела запроса
+    :return: Имена сохраненных записей и список всех конфликтов
+    """
+    redis_db = AsyncRedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+
+    conflicts = []
+    finder = ConflictFinder()
+
+    # Импортируемые записи. Повторное имя в рамках одного типа записей - тоже конфликт
+    imported = set()
+    for kind, recs in (('delayed', bulk.records), ('regular', bulk.regular_records)):
+        for rec in recs:
+            if (kind, rec.name) in imported:
+                conflicts.append({
+                    'reason': 'duplicateName',
+                    'camera': rec.rtsp_url,
+                    'record': {'type': kind, 'name': rec.name, 'interval': None},
+                    'conflictsWith': {'type': kind, 'name': rec.name, 'interval': None, 'existing': False},
+                })
+                continue
+            imported.add((kind, rec.name))
+
+            for i, interval in enumerate(rec.intervals):
+                if kind == 'delayed':
+                    finder.add_delayed(rec.rtsp_url, rec.name, i, interval['date_from'], interval['date_to'])
+                else:
+                    finder.add_regular(rec.rtsp_url, rec.name, i, interval['time_from'], interval['time_to'],
+                                       rec.days_of_week)
+
+    # Сохраненные записи. Записи с импортируемыми именами будут перезаписаны целиком (лишние интервалы удаляются
+    # в add_records), поэтому не учитываются.
+    # Закончившиеся отложенные записи ни с чем не конфликтуют
+    existing = await redis_db.get_active_records(datetime.now())
+    for key, info in existing['records'].items():
+        if ('delayed', info['name']) not in imported:
+            finder.add_delayed(info['rtsp_url'], info['name'], int(key.rsplit(':', 1)[1]),
+                               datetime.strptime(info['date_from'], DATE_FORMAT),
+                               datetime.strptime(info['date_to'], DATE_FORMAT), existing=True)
+    for key, info in existing['regularRecords'].items():
+        if ('regular', info['name']) not in imported:
+            finder.add_regular(info['rtsp_url'], info['name'], int(key.rsplit(':', 1)[1]),
+                               datetime.strptime(info['time_from'], DATE_FORMAT).time(),
+                               datetime.strptime(info['time_to'], DATE_FORMAT).time(),
+                               info['days_of_week'], existing=True)
+
+    conflicts += finder.find()
+
+    rejected = set()
+    for conflict in conflicts:
+        rejected.add((conflict['record']['type'], conflict['record']['name']))
+        if not conflict['conflictsWith']['existing']:
+            rejected.add((conflict['conflictsWith']['type'], conflict['conflictsWith']['name']))
+
+    valid_records = [rec for rec in bulk.records if ('delayed', rec.name) not in rejected]
+    valid_regular_records = [rec for rec in bulk.regular_records if ('regular', rec.name) not in rejected]
+
+    records = {}
+    for rec in valid_records:
+        records |= _video_records(rec)
+    for rec in valid_regular_records:
+        records |= _regular_records(rec)
+
+    if records:
+        await asyncio.to_thread(lambda: [directory_methods.mkdir(_video_path(rec)) for rec in valid_records])
+        await redis_db.add_records(records)
+        await redis_db.publish(PUBSUB_SCHEDULE_CHANNEL_NAME, 'bulk')
+
+    return {
+        'created': {
+            'records': [rec.name for rec in valid_records],
+            'regularRecords': [rec.name for rec in valid_regular_records],
+        },
+        'conflicts': conflicts,
+    }
 
 
 @app.get('/')
-async def get_records():
+async def get_records(request: Request):
     """
     Получение списка записей из БД.
+    Список кэшируется до ближайшего изменения записей. Ответ содержит ETag (версию списка), поэтому повторный запрос
+    с совпадающим If-None-Match получает 304 без обращения к БД.
+    :return:
+    """
+    if (entry := records_cache.get()) is None:
+        redis_db = AsyncRedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+        generation = records_cache.generation
+        version, records = await redis_db.get_versioned_records()
+        entry = records_cache.store(generation, version, records)
+
+    etag, body = entry
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
+
+
+@app.get('/metrics')
+async def get_metrics():
+    """
+    Метрики планировщика, процессов записи и загрузчика в текстовом формате Prometheus (см. server/metrics.py).
     :return:
     """
-    redis_db = RedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
-    return redis_db.get_all_records()
+    redis_db = AsyncRedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+    counters, gauges = await redis_db.get_metrics()
+    return PlainTextResponse(render_prometheus(counters, gauges), media_type='text/plain; version=0.0.4')
 
 
 @app.delete('/{name}')
@@ -109,5 +297,6 @@ async def delete_record(name: str):
     Удаление записи с указанным в параметрах запроса именем.
     :param name: Имя записи
     """
-    redis_db = RedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
-    redis_db.delete_record(name)
+    redis_db = AsyncRedisConnection(REDIS_SERVER, REDIS_PORT, REDIS_DB)
+    await redis_db.delete_record(name)
+    await redis_db.publish(PUBSUB_SCHEDULE_CHANNEL_NAME, name)
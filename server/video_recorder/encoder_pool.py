@@ -0,0 +1,295 @@
+import multiprocessing
+import queue
+import time
+
+from collections import deque
+from contextlib import suppress
+from typing import Optional
+
+from server.database import RedisConnection
+from server.metrics import Metrics
+from server.video_recorder.frame_ring import FrameRingReader
+from server.video_recorder.video_writer_manager import VideoWriterManager
+
+
+class _Stream:
+    """
+    Сегмент одной записи, который кодирует воркер.
+    :param reader: Кольцевой буфер кадров записи (None, если к нему не удалось подключиться)
+    :param writer: Объект записи в файл
+    :param path: Путь до файла сегмента
+    :param camera: Имя записи (для метрик)
+
+    :param self.pending: Номера кадров, ожидающих кодирования
+    :param self.closing: Пришла ли команда завершения сегмента
+    """
+
+    def __init__(self, reader: Optional[FrameRingReader], writer: VideoWriterManager, path: str, camera: str):
+        self.reader = reader
+        self.writer = writer
+        self.path = path
+        self.camera = camera
+
+        self.pending: deque[int] = deque()
+        self.closing = False
+
+
+class EncoderWorker(multiprocessing.Process):
+    """
+    Процесс-кодировщик из пула EncoderPool.
+    Получает команды от процессов записи через очередь inbox, кадры читает из их кольцевых буферов (FrameRing).
+    Кодирует сегменты разных записей по очереди, по одному кадру (round-robin), поэтому запись с большим FPS
+    не задерживает остальные.
+    Ошибка кодирования одного сегмента не останавливает воркер: сегмент закрывается и пропускается, а остальные
+    команды этого сегмента игнорируются.
+    :param index: Номер воркера в пуле
+    :param inbox: Очередь команд
+    :param load: Количество сегментов у каждого воркера пула (общий массив)
+    """
+
+    def __init__(self, index: int, inbox: multiprocessing.Queue, load):
+        super().__init__(daemon=True)
+        self.index = index
+        self.inbox = inbox
+        self.load = load
+
+        self._streams: dict[str, _Stream] = {}
+        self._turns: deque[str] = deque()
+        self._db = None
+        self._metrics = None
+
+    def _release_load(self):
+        with self.load.get_lock():
+            # После перезапуска воркера счетчик обнулен, а сегменты из очереди команд еще закрываются
+            self.load[self.index] = max(self.load[self.index] - 1, 0)
+
+    def _open(self, stream_id: str, ring_name: str, path: str, fps: float, resolution: tuple[int, int],
+              camera: str):
+        try:
+            reader = FrameRingReader(ring_name)
+        except FileNotFoundError:
+            # Запись уже завершилась и удалила буфер, кадры сегмента потеряны
+            reader = None
+
+        try:
+            writer = VideoWriterManager(writer_path=path, fps=fps, resolution=resolution)
+        except Exception:
+            if reader is not None:
+                reader.close()
+            raise
+        self._streams[stream_id] = _Stream(reader, writer, path, camera)
+
+    def _fail(self, stream_id: str, camera: str, error: Exception):
+        """
+        Пропуск сегмента, при кодировании которого произошла ошибка: файл закрывается, но не публикуется.
+        """
+        print(f'Error while encoding segment {stream_id}! (worker {self.index})')
+        print(error)
+        self._metrics.inc('encoder_pool_failed_segments_total', camera=camera)
+
+        stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            return
+        if stream_id in self._turns:
+            self._turns.remove(stream_id)
+
+        with suppress(Exception):
+            stream.writer.release()
+        if stream.reader is not None:
+            with suppress(Exception):
+                stream.reader.close()
+        self._release_load()
+
+    def _handle(self, message: tuple):
+        command, stream_id, *args = message
+
+        if command == 'open':
+            try:
+                self._open(stream_id, *args)
+            except Exception as e:
+                self._fail(stream_id, args[-1], e)
+                self._release_load()
+            return
+
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            # Сегмент не удалось открыть или он был открыт до перезапуска воркера
+            return
+
+        if command == 'frame':
+            if not stream.pending:
+                self._turns.append(stream_id)
+            stream.pending.append(args[0])
+
+        elif command == 'close':
+            stream.closing = True
+            if not stream.pending:
+                try:
+                    self._finish(stream_id)
+                except Exception as e:
+                    self._fail(stream_id, stream.camera, e)
+
+    def _encode_next(self):
+        """
+        Кодирование одного кадра записи, чья очередь подошла.
+        """
+        stream_id = self._turns.popleft()
+        stream = self._streams[stream_id]
+        seq = stream.pending.popleft()
+
+        try:
+            frame = stream.reader.get(seq) if stream.reader is not None else None
+            if frame is None:
+                # Кадр перезаписан в кольцевом буфере, пока ждал кодирования
+                self._metrics.inc('encoder_pool_dropped_frames_total', camera=stream.camera)
+            else:
+                stream.writer.write(frame[2])
+
+            if stream.pending:
+                self._turns.append(stream_id)
+            elif stream.closing:
+                self._finish(stream_id)
+        except Exception as e:
+            self._fail(stream_id, stream.camera, e)
+
+    def _finish(self, stream_id: str):
+        """
+        Завершение сегмента: закрытие файла и публикация сегмента для загрузки.
+        """
+        stream = self._streams[stream_id]
+        stream.writer.release(on_released=self._db.enqueue_upload)
+
+        del self._streams[stream_id]
+        if stream.reader is not None:
+            stream.reader.close()
+        self._release_load()
+
+        self._metrics.observe('recorder_segment_write_seconds', stream.writer.write_seconds, camera=stream.camera)
+
+    def run(self):
+        self._db = RedisConnection()
+        self._metrics = Metrics.get()
+
+        while True:
+            # Пока есть работа, команды только вычитываются без ожидания
+            try:
+                message = self.inbox.get(block=not self._turns, timeout=None if self._turns else 1)
+                self._handle(message)
+                while True:
+                    self._handle(self.inbox.get_nowait())
+            except queue.Empty:
+                pass
+
+            if self._turns:
+                self._encode_next()
+
+            self._metrics.set(
+                'encoder_pool_pending_frames',
+                sum(len(stream.pending) for stream in self._streams.values()),
+                worker=self.index,
+            )
+
+
+class EncoderPool:
+    """
+    Общий пул процессов-кодировщиков для всех записей узла (ENCODER_POOL_SIZE в const.py).
+    Процессы записи только захватывают кадры и кладут их в свои кольцевые буферы, а кодирование идет в M воркерах,
+    поэтому N камер не занимают больше M ядер на кодирование. Сегмент целиком кодируется одним воркером
+    (наименее загруженным на момент открытия сегмента).
+    Пул создается до запуска процессов записи, которые получают его через аргумент encoder_pool.
+    Упавший воркер перезапускается владельцем пула (см. restart_dead_workers) с той же очередью команд;
+    сегменты, которые он кодировал, теряются.
+    Обратного давления нет: процесс записи не ждет воркер. Если воркер отстает от записи больше чем на размер
+    кольцевого буфера (ENCODER_POOL_RING_SLOTS кадров, при 25 FPS это около 2.5 секунд), старые кадры
+    перезаписываются и пропускаются (encoder_pool_dropped_frames_total), а запись продолжается без задержек.
+    :param size: Количество воркеров
+
+    :param self._inboxes: Очереди команд воркеров
+    :param self._load: Количество открытых сегментов у каждого воркера
+    :param self._workers: Процессы-воркеры (есть только у владельца пула, в процессы записи не передаются)
+    """
+
+    def __init__(self, size: int):
+        self._load = multiprocessing.Array('i', size)
+        self._inboxes = [multiprocessing.Queue() for _ in range(size)]
+        self._workers = [EncoderWorker(i, inbox, self._load) for i, inbox in enumerate(self._inboxes)]
+
+    def __getstate__(self):
+        # Процессам записи нужны только очереди и счетчики загрузки, а объекты процессов не сериализуются
+        state = self.__dict__.copy()
+        state['_workers'] = []
+        return state
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    def restart_dead_workers(self) -> int:
+        """
+        Перезапуск завершившихся воркеров с прежними очередями команд, поэтому процессы записи продолжают
+        работать с пулом без изменений.
+        :return: Количество перезапущенных воркеров
+        """
+        restarted = 0
+        for index, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+
+            print(f'Encoder worker {index} died with exit code {worker.exitcode}!')
+            with self._load.get_lock():
+                self._load[index] = 0
+            self._workers[index] = EncoderWorker(index, self._inboxes[index], self._load)
+            self._workers[index].start()
+            restarted += 1
+        return restarted
+
+    def open_segment(self, stream_id: str, ring_name: str, path: str, fps: float, resolution: tuple[int, int],
+                     camera: str) -> 'PooledSegment':
+        """
+        Открытие сегмента на наименее загруженном воркере.
+        :param stream_id: Уникальный идентификатор записи (ключ записи в БД)
+        :param ring_name: Имя кольцевого буфера кадров записи
+        :param path: Путь до файла сегмента
+        :param fps: FPS видеофайла
+        :param resolution: Разрешение видеофайла
+        :param camera: Имя записи (для метрик)
+        :return: Объект для отправки кадров сегмента
+        """
+        with self._load.get_lock():
+            index = min(range(len(self._inboxes)), key=self._load.__getitem__)
+            self._load[index] += 1
+
+        inbox = self._inboxes[index]
+        inbox.put(('open', stream_id, ring_name, path, fps, resolution, camera))
+        return PooledSegment(inbox, stream_id)
+
+
+class PooledSegment:
+    """
+    Сегмент, который кодирует воркер пула. Вместо кадров воркеру отправляются их номера в кольцевом буфере.
+    Закрытый сегмент публикует воркер, после того как закодирует все кадры.
+    :param inbox: Очередь команд воркера
+    :param stream_id: Идентификатор записи
+
+    :param self.write_seconds: Время отправки кадров (для совместимости с VideoWriterManager)
+    """
+
+    def __init__(self, inbox: multiprocessing.Queue, stream_id: str):
+        self._inbox = inbox
+        self._stream_id = stream_id
+        self.write_seconds = 0.0
+
+    def write(self, seq: int):
+        """
+        Отправка кадра на кодирование.
+        :param seq: Номер кадра в кольцевом буфере
+        """
+        started_at = time.perf_counter()
+        self._inbox.put(('frame', self._stream_id, seq))
+        self.write_seconds += time.perf_counter() - started_at
+
+    def release(self):
+        """
+        Завершение сегмента.
+        """
+        self._inbox.put(('close', self._stream_id))
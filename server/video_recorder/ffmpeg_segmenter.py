@@ -0,0 +1,117 @@
+import os
+import signal
+import subprocess
+import tempfile
+import time
+
+from typing import Iterator, Optional
+
+from server.const import VIDEO_EXTENSION
+
+# Имена сегментов совпадают с именами файлов VideoRecorder: datetime.isoformat(timespec='seconds') с '_' вместо ':'
+SEGMENT_NAME_PATTERN = f'%Y-%m-%dT%H_%M_%S.{VIDEO_EXTENSION}'
+
+
+class FfmpegSegmenter:
+    """
+    Один долгоживущий процесс ffmpeg на окно записи, который нарезает RTSP-поток на файлы сегментным муксером
+    (-f segment) без перекодирования видео (-c:v copy).
+    Завершенные сегменты ffmpeg дописывает в список сегментов (-segment_list), который читается методом segments.
+    :param rtsp: URL для подключения к камере
+    :param path: Папка для сегментов
+    :param segment_seconds: Длительность одного сегмента в секундах
+    :param duration: Длительность записи в секундах
+    :param audio: Записывать ли звук (pcm_s16le); иначе звук отбрасывается
+
+    :param self._process: Процесс ffmpeg
+    :param self._list_path: Путь к списку завершенных сегментов
+    """
+    POLL_INTERVAL_SECONDS = 1
+
+    def __init__(self, rtsp: str, path: str, segment_seconds: int, duration: float, audio=False):
+        self.rtsp = rtsp
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.duration = duration
+        self.audio = audio
+
+        self._process: Optional[subprocess.Popen] = None
+        self._list_path = None
+
+    def _command(self) -> list[str]:
+        audio = ['-c:a', 'pcm_s16le'] if self.audio else ['-an']
+        return [
+            'ffmpeg', '-loglevel', 'error', '-y',
+            '-rtsp_transport', 'tcp', '-use_wallclock_as_timestamps', '1',
+            '-i', self.rtsp,
+            '-t', f'{self.duration:.3f}',
+            '-map', '0:v', *(['-map', '0:a?'] if self.audio else []),
+            '-c:v', 'copy', *audio,
+            '-f', 'segment',
+            '-segment_time', str(self.segment_seconds),
+            '-reset_timestamps', '1',
+            '-segment_list', self._list_path, '-segment_list_type', 'flat',
+            '-strftime', '1',
+            os.path.join(self.path, SEGMENT_NAME_PATTERN),
+        ]
+
+    def start(self):
+        """
+        Запуск ffmpeg. Процесс запускается в отдельной сессии, чтобы сигналы терминала не доходили до него
+        раньше, чем до процесса записи.
+        """
+        fd, self._list_path = tempfile.mkstemp(prefix='segments-', suffix='.txt')
+        os.close(fd)
+
+        self._process = subprocess.Popen(
+            self._command(),
+            stdin=subprocess.DEVNULL,
+            start_new_session=os.name == 'posix',
+        )
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return None if self._process is None else self._process.poll()
+
+    def segments(self) -> Iterator[str]:
+        """
+        Завершенные сегменты по мере их закрытия. Генератор завершается вместе с процессом ffmpeg.
+        :return: Генератор путей к сегментам
+        """
+        try:
+            with open(self._list_path, 'r') as segment_list:
+                pending = ''
+                while True:
+                    finished = self._process.poll() is not None
+
+                    # Строка списка считается записанной, только когда дописан перевод строки
+                    pending += segment_list.read()
+                    *lines, pending = pending.split('\n')
+                    for line in lines:
+                        if line:
+                            yield os.path.join(self.path, line)
+
+                    if finished:
+                        break
+                    time.sleep(self.POLL_INTERVAL_SECONDS)
+        finally:
+            # Список удаляется и при ошибке, и если генератор закрыли раньше времени
+            os.remove(self._list_path)
+
+    def stop(self, timeout: float = 10):
+        """
+        Остановка ffmpeg. По SIGINT ffmpeg корректно закрывает текущий сегмент.
+        :param timeout: Время ожидания завершения до принудительной остановки
+        """
+        if self._process is None or self._process.poll() is not None:
+            return
+
+        if os.name == 'posix':
+            self._process.send_signal(signal.SIGINT)
+        else:
+            self._process.terminate()
+        try:
+            self._process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
@@ -0,0 +1,96 @@
+import threading
+
+from collections import deque
+from typing import Any, Literal, Optional
+
+OverflowPolicy = Literal['drop_oldest', 'drop_newest']
+
+
+def frame_queue_size(maxsize: int, memory_mb: float, resolution: tuple[int, int]) -> int:
+    """
+    Размер очереди кадров, при котором кадры в ней занимают не больше memory_mb.
+    :param maxsize: Максимальное количество кадров в очереди
+    :param memory_mb: Бюджет памяти очереди в мегабайтах
+    :param resolution: Разрешение кадров (ширина, высота), кадр - 3 байта на пиксель
+    :return: Размер очереди (не меньше 1)
+    """
+    width, height = resolution
+    frame_bytes = width * height * 3
+    if frame_bytes <= 0:
+        return maxsize
+    return max(1, min(maxsize, int(memory_mb * 1024 * 1024 // frame_bytes)))
+
+
+class FrameQueue:
+    """
+    Ограниченная очередь кадров между потоком захвата и потоком кодирования.
+    Поток захвата никогда не блокируется: при переполнении кадр выбрасывается согласно политике.
+    :param maxsize: Максимальное количество кадров в очереди
+    :param policy: Политика при переполнении: 'drop_oldest' - выбросить самый старый кадр из очереди,
+    'drop_newest' - выбросить новый кадр
+
+    :param self.dropped: Количество выброшенных кадров
+    :param self._frames: Кадры
+    :param self._cond: Условная переменная для ожидания кадров
+    :param self._closed: Закрыта ли очередь (новых кадров не будет)
+    """
+
+    def __init__(self, maxsize: int, policy: OverflowPolicy = 'drop_oldest'):
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+        if policy not in ('drop_oldest', 'drop_newest'):
+            raise ValueError(f'Unknown overflow policy: {policy}')
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+
+        self._frames = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._frames)
+
+    def put(self, frame: Any) -> bool:
+        """
+        Добавление кадра без блокировки.
+        :param frame: Кадр
+        :return: True, если кадр добавлен (возможно, с вытеснением старого); False, если кадр выброшен
+        """
+        with self._cond:
+            if self._closed:
+                return False
+
+            if len(self._frames) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == 'drop_newest':
+                    return False
+                self._frames.popleft()
+
+            self._frames.append(frame)
+            self._cond.notify()
+            return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """
+        Получение кадра. Ждет, пока кадр появится или очередь закроется.
+        :param timeout: Максимальное время ожидания в секундах (None - без ограничения)
+        :return: Кадр или None, если очередь закрыта и пуста или время ожидания истекло
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._frames or self._closed, timeout=timeout)
+            return self._frames.popleft() if self._frames else None
+
+    def close(self):
+        """
+        Закрытие очереди. Оставшиеся кадры можно дочитать через get.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import time
+
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
+
+import numpy as np
+
+# Заголовок: количество слотов, высота, ширина, количество каналов, номер последнего записанного кадра
+_HEADER_FIELDS = 5
+_HEADER_SIZE = _HEADER_FIELDS * 8
+
+Frame = tuple[int, float, np.ndarray]
+
+
+def frame_ring_name(db_key: str) -> str:
+    """
+    Имя блока разделяемой памяти для кольцевого буфера кадров записи.
+    Имя не зависит от символов в ключе записи и укладывается в ограничения длины имен на всех платформах.
+    :param db_key: Ключ записи в БД
+    :return: Имя блока разделяемой памяти
+    """
+    return f'frames-{hashlib.sha1(db_key.encode("utf-8")).hexdigest()[:16]}'
+
+
+def _ring_size(slots: int, shape: tuple[int, int, int]) -> int:
+    return _HEADER_SIZE + slots * (16 + int(np.prod(shape)))
+
+
+class _FrameRingLayout:
+    """
+    Представление блока разделяемой памяти в виде numpy-массивов (без копирования).
+    Для каждого слота хранятся номер кадра, время его получения (unix timestamp) и сам кадр.
+    Номер кадра 0 означает, что слот пуст или в него идет запись.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self._shm = shm
+        self.header = np.ndarray((_HEADER_FIELDS,), dtype=np.uint64, buffer=shm.buf)
+
+        slots, height, width, channels = (int(value) for value in self.header[:4])
+        self.slots = slots
+        self.shape = (height, width, channels)
+
+        offset = _HEADER_SIZE
+        self.seqs = np.ndarray((slots,), dtype=np.uint64, buffer=shm.buf, offset=offset)
+        offset += slots * 8
+        self.stamps = np.ndarray((slots,), dtype=np.float64, buffer=shm.buf, offset=offset)
+        offset += slots * 8
+        self.frames = np.ndarray((slots, *self.shape), dtype=np.uint8, buffer=shm.buf, offset=offset)
+
+    def release(self):
+        # Массивы держат ссылки на буфер, без их удаления блок памяти нельзя закрыть
+        del self.header, self.seqs, self.stamps, self.frames
+        self._shm.close()
+
+
+class FrameRing:
+    """
+    Кольцевой буфер последних декодированных кадров записи в разделяемой памяти (multiprocessing.shared_memory).
+    Пишет в него только процесс записи, читать могут любые процессы (см. FrameRingReader) без отдельного
+    подключения к камере и без повторного декодирования.
+    :param name: Имя блока разделяемой памяти (см. frame_ring_name)
+    :param shape: Форма кадра (высота, ширина, количество каналов)
+    :param slots: Количество кадров в буфере
+    """
+
+    def __init__(self, name: str, shape: tuple[int, int, int], slots: int):
+        size = _ring_size(slots, shape)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Блок остался от упавшего процесса записи
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        self.name = name
+        self._shm = shm
+        np.ndarray((_HEADER_FIELDS,), dtype=np.uint64, buffer=shm.buf)[:] = (slots, *shape, 0)
+        self._layout = _FrameRingLayout(shm)
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return self._layout.shape
+
+    def write(self, frame: np.ndarray) -> int:
+        """
+        Запись кадра в буфер поверх самого старого.
+        :param frame: Кадр (форма должна совпадать с shape)
+        :return: Номер кадра
+        """
+        layout = self._layout
+        seq = int(layout.header[4]) + 1
+        slot = seq % layout.slots
+
+        layout.seqs[slot] = 0
+        layout.frames[slot] = frame
+        layout.stamps[slot] = time.time()
+        layout.seqs[slot] = seq
+        layout.header[4] = seq
+        return seq
+
+    def close(self):
+        """
+        Закрытие и удаление буфера.
+        """
+        self._layout.release()
+        self._shm.unlink()
+
+
+class FrameRingReader:
+    """
+    Чтение кадров из кольцевого буфера записи (см. FrameRing).
+    Если copy=False, возвращаются массивы, которые ссылаются прямо на разделяемую память: они будут перезаписаны
+    через slots кадров, проверить актуальность кадра можно методом is_valid. Такие массивы нужно удалить до close.
+    :param name: Имя блока разделяемой памяти (см. frame_ring_name)
+    """
+
+    def __init__(self, name: str):
+        self._shm = shared_memory.SharedMemory(name=name)
+        # Читатель не владеет блоком: без этого resource_tracker удалит блок при завершении процесса-читателя
+        if os.name == 'posix':
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._layout = _FrameRingLayout(self._shm)
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return self._layout.shape
+
+    @property
+    def last_seq(self) -> int:
+        return int(self._layout.header[4])
+
+    def is_valid(self, seq: int) -> bool:
+        """
+        Находится ли кадр с номером seq все еще в буфере.
+        :param seq: Номер кадра
+        """
+        return seq > 0 and int(self._layout.seqs[seq % self._layout.slots]) == seq
+
+    def get(self, seq: int, copy=True) -> Optional[Frame]:
+        """
+        Кадр по номеру.
+        :param seq: Номер кадра
+        :param copy: Копировать ли кадр из разделяемой памяти
+        :return: Номер кадра, время его получения и кадр или None, если кадр уже перезаписан
+        """
+        layout = self._layout
+        slot = seq % layout.slots
+        if int(layout.seqs[slot]) != seq:
+            return None
+
+        stamp = float(layout.stamps[slot])
+        frame = layout.frames[slot].copy() if copy else layout.frames[slot]
+
+        # Кадр перезаписали во время чтения
+        if copy and not self.is_valid(seq):
+            return None
+        return seq, stamp, frame
+
+    def latest(self, copy=True) -> Optional[Frame]:
+        """
+        Последний кадр.
+        :param copy: Копировать ли кадр из разделяемой памяти
+        :return: Номер кадра, время его получения и кадр или None, если кадров еще нет
+        """
+        return self.get(self.last_seq, copy) if self.last_seq else None
+
+    def since(self, seq: int, copy=True) -> list[Frame]:
+        """
+        Кадры с номером больше seq, которые еще есть в буфере, от старых к новым.
+        :param seq: Номер последнего прочитанного кадра (0 - все кадры в буфере)
+        :param copy: Копировать ли кадры из разделяемой памяти
+        :return: Список кадров (номер, время получения, кадр)
+        """
+        last = self.last_seq
+        first = max(seq + 1, last - self._layout.slots + 1, 1)
+        return [frame for i in range(first, last + 1) if (frame := self.get(i, copy)) is not None]
+
+    def close(self):
+        """
+        Отключение от буфера (сам буфер не удаляется).
+        """
+        self._layout.release()
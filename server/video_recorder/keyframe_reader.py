@@ -0,0 +1,108 @@
+import subprocess
+import threading
+
+from typing import Optional
+
+import numpy as np
+
+
+class KeyframeReader:
+    """
+    Чтение только ключевых кадров RTSP-потока через ffmpeg (-skip_frame nokey).
+    Декодер пропускает все кадры, кроме ключевых, поэтому редкая (timelapse) запись почти не нагружает процессор.
+    Кадры читаются из stdout ffmpeg в формате rawvideo (bgr24) в отдельном потоке, хранится только последний кадр.
+    :param rtsp: URL для подключения к камере
+    :param resolution: Разрешение кадров (ширина, высота)
+
+    :param self._process: Процесс ffmpeg
+    :param self._thread: Поток чтения кадров
+    :param self._frame: Последний прочитанный кадр
+    :param self._frame_number: Номер последнего прочитанного кадра
+    :param self._returned_number: Номер последнего кадра, который вернул latest
+    :param self._cond: Условная переменная для ожидания нового кадра
+    """
+
+    def __init__(self, rtsp: str, resolution: tuple[int, int]):
+        self.rtsp = rtsp
+        self.resolution = resolution
+
+        self._process = None
+        self._thread = None
+
+        self._frame = None
+        self._frame_number = 0
+        self._returned_number = 0
+        self._cond = threading.Condition()
+
+    def _command(self) -> list[str]:
+        width, height = self.resolution
+        return [
+            'ffmpeg', '-loglevel', 'error',
+            '-rtsp_transport', 'tcp',
+            '-skip_frame', 'nokey',
+            '-i', self.rtsp,
+            '-an', '-vsync', 'passthrough',
+            '-s', f'{width}x{height}',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-',
+        ]
+
+    def start(self):
+        """
+        Запуск ffmpeg и потока чтения кадров.
+        """
+        self._process = subprocess.Popen(self._command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        width, height = self.resolution
+        frame_size = width * height * 3
+
+        try:
+            while True:
+                buffer = self._process.stdout.read(frame_size)
+                if len(buffer) < frame_size:
+                    break
+
+                frame = np.frombuffer(buffer, dtype=np.uint8).reshape((height, width, 3))
+                with self._cond:
+                    self._frame = frame
+                    self._frame_number += 1
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._cond.notify_all()
+
+    @property
+    def alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def latest(self, timeout: float) -> Optional[np.ndarray]:
+        """
+        Последний ключевой кадр, который еще не возвращался. Если нового кадра нет, ждет его не дольше timeout секунд:
+        ключевые кадры бывают реже дедлайнов, и один и тот же кадр не должен записываться несколько раз.
+        :param timeout: Максимальное время ожидания нового кадра
+        :return: Кадр или None, если ffmpeg завершился или новый кадр не пришел за timeout
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._frame_number > self._returned_number or not self.alive, timeout=timeout)
+            if not self.alive or self._frame_number == self._returned_number:
+                return None
+            self._returned_number = self._frame_number
+            return self._frame
+
+    def close(self):
+        """
+        Остановка ffmpeg и потока чтения кадров.
+        """
+        if self._process is None:
+            return
+
+        self._process.terminate()
+        try:
+            self._process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._thread.join()
+        self._process.stdout.close()
@@ -0,0 +1,79 @@
+import multiprocessing
+import threading
+import time
+
+from typing import Callable, Optional
+
+from server.const import LEASE_HEARTBEAT_SECONDS, LEASE_TTL_SECONDS
+from server.database import RedisConnection
+
+
+class LeaseGuard:
+    """
+    Проверка в процессе записи, что узел все еще удерживает аренду таски, а родительский процесс (RecordManager) жив.
+    Аренду продлевает родитель: если он умер, через LEASE_TTL_SECONDS таску захватит другой узел, и без проверки
+    камера писалась бы на двух узлах. Поэтому процесс записи завершается, если родитель умер, аренду захватил
+    другой узел или аренды нет дольше LEASE_TTL_SECONDS.
+    Проверка идет в отдельном потоке раз в LEASE_HEARTBEAT_SECONDS.
+    :param db_key: Ключ записи
+    :param owner: Идентификатор узла, которому выдана аренда (None - проверяется только родитель)
+    :param on_lost: Вызывается (из потока проверки) один раз при потере аренды
+
+    :param self.lost: Событие потери аренды
+    :param self._missing_since: Время, с которого аренды нет в БД
+    """
+
+    def __init__(self, db_key: str, owner: Optional[str], on_lost: Optional[Callable[[], None]] = None):
+        self.db_key = db_key
+        self.owner = owner
+        self.on_lost = on_lost
+        self.lost = threading.Event()
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._missing_since = None
+
+    def _is_lost(self, db: RedisConnection) -> bool:
+        parent = multiprocessing.parent_process()
+        if parent is not None and not parent.is_alive():
+            print(f'Parent of {self.db_key} is dead!')
+            return True
+
+        if self.owner is None:
+            return False
+
+        try:
+            holder = db.get_lease_owner(self.db_key)
+        except Exception as e:
+            # Недоступность БД не повод останавливать запись: аренду в это время не может захватить и другой узел
+            print(f'Can\'t check lease of {self.db_key}!')
+            print(e)
+            return False
+
+        if holder is not None:
+            self._missing_since = None
+            return holder != self.owner
+
+        now = time.monotonic()
+        if self._missing_since is None:
+            self._missing_since = now
+        return now - self._missing_since > LEASE_TTL_SECONDS
+
+    def _watch(self):
+        db = RedisConnection()
+        while not self._stop.wait(LEASE_HEARTBEAT_SECONDS):
+            if self._is_lost(db):
+                print(f'Lease of {self.db_key} is lost, stop recording!')
+                self.lost.set()
+                if self.on_lost is not None:
+                    self.on_lost()
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
@@ -0,0 +1,94 @@
+import math
+
+from collections import deque
+from typing import Any, Optional
+
+import cv2
+import numpy as np
+
+
+class MotionDetector:
+    """
+    Детектор движения по разнице соседних кадров.
+    Кадры сравниваются в уменьшенном (до width пикселей по ширине) черно-белом виде, поэтому проверка кадра
+    стоит намного дешевле его кодирования.
+    :param pixel_threshold: Минимальное изменение яркости пикселя, которое считается движением
+    :param min_area: Минимальная доля изменившихся пикселей, при которой в кадре есть движение
+    :param width: Ширина уменьшенного кадра
+
+    :param self._previous: Предыдущий уменьшенный кадр
+    """
+
+    def __init__(self, pixel_threshold: int, min_area: float, width: int = 160):
+        self.pixel_threshold = pixel_threshold
+        self.min_area = min_area
+        self.width = width
+
+        self._previous: Optional[np.ndarray] = None
+
+    def _prepare(self, frame: np.ndarray) -> np.ndarray:
+        height = max(1, round(frame.shape[0] * self.width / frame.shape[1]))
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small.astype(np.int16)
+
+    def update(self, frame: np.ndarray) -> bool:
+        """
+        Проверка кадра на движение относительно предыдущего кадра.
+        :param frame: Кадр
+        :return: True, если в кадре есть движение (первый кадр всегда считается кадром с движением)
+        """
+        current = self._prepare(frame)
+        previous, self._previous = self._previous, current
+
+        if previous is None or previous.shape != current.shape:
+            return True
+        changed = np.count_nonzero(np.abs(current - previous) > self.pixel_threshold)
+        return changed >= self.min_area * current.size
+
+
+class MotionGate:
+    """
+    Отбор кадров для записи по движению с предзаписью (pre-roll) и дозаписью (post-roll).
+    Пока движения нет, последние кадры за pre_roll секунд хранятся в памяти и записываются, как только
+    появится движение; после окончания движения запись идет еще post_roll секунд.
+    :param detector: Детектор движения
+    :param pre_roll: Длительность предзаписи в секундах
+    :param post_roll: Длительность дозаписи в секундах
+    :param fps: Частота кадров (для ограничения размера буфера предзаписи)
+
+    :param self._buffer: Кадры предзаписи (время получения, кадр или связанные с ним данные)
+    :param self._active_until: Время окончания дозаписи (time.monotonic)
+    """
+
+    def __init__(self, detector: MotionDetector, pre_roll: float, post_roll: float, fps: float):
+        self.detector = detector
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+
+        self._buffer: deque[tuple[float, Any]] = deque(maxlen=max(1, math.ceil(pre_roll * fps)))
+        self._active_until = None
+
+    def feed(self, frame: np.ndarray, now: float, payload: Any = None) -> list:
+        """
+        Обработка очередного кадра.
+        :param frame: Кадр
+        :param now: Время получения кадра (time.monotonic)
+        :param payload: Что вернуть для записи вместо кадра (например, кадр вместе с его номером)
+        :return: Кадры (или payload), которые нужно записать (пустой список, если движения нет)
+        """
+        payload = frame if payload is None else payload
+
+        if self.detector.update(frame):
+            self._active_until = now + self.post_roll
+            selected = [buffered for at, buffered in self._buffer if now - at <= self.pre_roll]
+            self._buffer.clear()
+            return selected + [payload]
+
+        if self._active_until is not None and now < self._active_until:
+            return [payload]
+
+        if self.pre_roll > 0:
+            self._buffer.append((now, payload))
+        return []
@@ -1,15 +1,28 @@
+import shutil
+
 from server.video_recorder.video_audio_record_process import VideoAudioRecorder
 from server.video_recorder.record_process import VideoRecorder
+from server.video_recorder.stream_copy_process import StreamCopyRecorder
 
 
 def create_recorder(audio: bool, **kwargs):
     """
-    Функция по созданию объектов класса VideoAudioRecorder и VideoRecorder.
-    :param audio: Создавать объект VideoAudioRecorder (True) или VideoRecorder (False)
+    Функция по созданию объектов класса VideoAudioRecorder, StreamCopyRecorder и VideoRecorder.
+    Запись без звука и без fpm идет без перекодирования (StreamCopyRecorder), если доступен ffmpeg.
+    Запись по движению (motion) требует декодирования кадров, поэтому идет через VideoRecorder; для записи со звуком
+    motion не поддерживается и игнорируется. Общий пул кодировщиков (encoder_pool) используется только VideoRecorder.
+    :param audio: Создавать объект VideoAudioRecorder (True) или объект записи только видео (False)
     :param kwargs: Атрибуты класса
     :return: Объект класса записи
     """
     if audio:
-        kwargs.pop('fpm', None)
+        for option in ('fpm', 'motion', 'encoder_pool'):
+            kwargs.pop(option, None)
+        return VideoAudioRecorder(**kwargs)
+
+    if kwargs.get('fpm') is None and not kwargs.get('motion') and shutil.which('ffmpeg') is not None:
+        for option in ('fpm', 'motion', 'encoder_pool'):
+            kwargs.pop(option, None)
+        return StreamCopyRecorder(**kwargs)
 
-    return VideoAudioRecorder(**kwargs) if audio else VideoRecorder(**kwargs)
+    return VideoRecorder(**kwargs)
@@ -1,12 +1,20 @@
 import multiprocessing
-import time as time_
+import os
+import socket
 
 from datetime import datetime, timedelta, time
+from typing import Optional
 
 import server.directory_methods as directory_methods
 from server.database import RedisConnection
-from server.const import DATE_FORMAT
+from server.const import DATE_FORMAT, PUBSUB_SCHEDULE_CHANNEL_NAME, LEASE_HEARTBEAT_SECONDS, LEASE_TTL_SECONDS, \
+    NODE_MAX_RECORDERS, ENCODER_POOL_SIZE
+from server.metrics import Metrics
+from server.video_recorder.encoder_pool import EncoderPool
 from server.video_recorder.record_factory import create_recorder
+from server.video_recorder.scheduler import RecordScheduler, ScheduleEvent
+from server.video_recorder.supervisor import RecordSupervisor
+from server.weekly_schedule import WeeklyIndex, compile_regular_record, next_window
 
 
 def str_to_time(time_str: str) -> time:
@@ -56,28 +64,15 @@ class RecordLauncher:
     Статический класс-менеджер, ответственный за запуск процессов отложенной записи.
     """
     @staticmethod
-    def seek_for_record(db: RedisConnection, today: datetime):
+    def get_window(info: dict, now: datetime) -> Optional[tuple[datetime, datetime]]:
         """
-        Осуществляет поиск незапущенных процессов отложенной записи.
-        :param db: Указатель на базу данных
-        :param today: Сегодняшний день. Понятия не имею, почему я принимаю его как параметром, а не вычисляю in-place
-        :return task: Ключ записи БД
-        :return info: Информация в виде словаря по ключу записи БД
+        Вычисляет окно отложенной записи, которое еще не закончилось.
+        :param info: Информация в виде словаря по ключу записи БД
+        :param now: Текущий момент
+        :return: Начало и конец окна записи или None, если запись уже завершилась
         """
-        def date_in_interval(start: datetime, end: datetime):
-            return start < today < end
-
-        recs = db.get_keys('videos:*')
-
-        for task in recs:
-            info = db[task]
-
-            # Запускать процесс, если:
-            # 1) Процесс не запускался;
-            # 2) процесс находится во временном промежутке запуска.
-            if not db.task_is_running(task) and \
-                    date_in_interval(str_to_datetime(info['date_from']), str_to_datetime(info['date_to'])):
-                return task, info
+        start, end = str_to_datetime(info['date_from']), str_to_datetime(info['date_to'])
+        return (start, end) if end > now else None
 
     @staticmethod
     def start_record_process(with_audio=False, **kwargs):
@@ -85,11 +80,13 @@ class RecordLauncher:
         Запускает процесс отложенной записи
         :param with_audio: Нужно ли записывать звук
         :param kwargs: Аргументы объекта записи
+        :return: Запущенный объект записи
         """
         process = create_recorder(audio=with_audio, start_date=datetime.now(), **kwargs)
 
         directory_methods.mkdir(kwargs['path'])
         process.start()
+        return process
 
 
 class RegularRecordLauncher:
@@ -97,37 +94,18 @@ class RegularRecordLauncher:
     Статический класс-менеджер, ответственный за запуск потоков регулярной записи.
     """
     @staticmethod
-    def seek_for_regular_record(db: RedisConnection, today: datetime):
+    def get_window(info: dict, now: datetime) -> Optional[tuple[datetime, datetime]]:
         """
-        Осуществляет поиск незапущенных процессов отложенной записи.
-        :param db: Указатель на базу данных
-        :param today: Сегодняшний день
-        :return task: Ключ записи БД
-        :return info: Информация в виде словаря по ключу записи БД
+        Вычисляет ближайшее окно регулярной записи, которое еще не закончилось.
+        Если time_from больше time_to, окно переходит через полночь: запись в разрешенный день идет
+        с полуночи до time_to и с time_from до time_to следующего дня.
+        Окно вычисляется по расписанию, скомпилированному при сохранении записи (week_intervals).
+        :param info: Информация в виде словаря по ключу записи БД
+        :param now: Текущий момент
+        :return: Начало и конец окна записи или None, если не задано ни одного дня недели
         """
-        def today_is_day_of_week(permitted_days: list[int]) -> bool:
-            return today.weekday() in permitted_days
-
-        def time_in_interval(now: time, start: time, end: time) -> bool:
-            if start < end:
-                return start <= now <= end
-
-            return now >= start and now >= end or now <= start and now <= end
-
-        recs = db.get_keys('regular:*')
-
-        for task in recs:
-            info = db[task]
-
-            # Запускать процесс, если:
-            # 1) совпадает день недели;
-            # 2) процесс еще не запущен;
-            # 3) процесс находится во временном промежутке запуска.
-
-            if today_is_day_of_week(info['days_of_week']) and \
-                    not db.task_is_running(task) and \
-                    time_in_interval(today.time(), str_to_time(info['time_from']), str_to_time(info['time_to'])):
-                return task, info
+        intervals = info['week_intervals'] if 'week_intervals' in info else compile_regular_record(info)
+        return next_window(intervals, now)
 
     @staticmethod
     def start_record_process(end_time, with_audio=False, **kwargs):
@@ -136,6 +114,7 @@ class RegularRecordLauncher:
         :param with_audio: Нужно ли записывать звук
         :param end_time: Время конца записи
         :param kwargs: Аргументы объекта записи
+        :return: Запущенный объект записи
         """
         today = datetime.now()
 
@@ -149,60 +128,221 @@ class RegularRecordLauncher:
         directory_methods.mkdir(kwargs['path'])
 
         process.start()
+        return process
 
 
 class RecordManager(multiprocessing.Process):
     """
-    Непосредственно класс, сканирующий каждые n секунд наличие новых записей в БД, необходимых к запуску
+    Непосредственно класс, запускающий записи по расписанию.
+    Спит до ближайшего события расписания (см. RecordScheduler), запускает все наступившие записи за один проход
+    и перестраивает расписание при изменении записей через API (канал PUBSUB_SCHEDULE_CHANNEL_NAME).
+    Несколько менеджеров (на одной или разных машинах) могут работать с одной БД: таска записи захватывается узлом
+    с арендой (см. RedisConnection.claim_task), которая продлевается раз в LEASE_HEARTBEAT_SECONDS, пока процесс
+    записи жив. Если узел умер, его аренды истекают, и записи подхватываются другими узлами.
+    Процессами записи узла владеет RecordSupervisor: он ограничивает их количество и перезапускает упавшие.
+    :param max_recorders: Максимальное количество записей, одновременно идущих на узле
+
+    :param self.node_id: Идентификатор узла (задается в запущенном процессе)
+    :param self._supervisor: Супервизор процессов записи (создается в запущенном процессе)
+    :param self._encoder_pool: Общий пул кодировщиков для процессов записи узла (None, если ENCODER_POOL_SIZE = 0)
     """
-    SCAN_INTERVAL_SECONDS = 10
+    RESYNC_INTERVAL_SECONDS = 60
     TIME_FORMAT = '%H:%M:%S'
 
-    def __init__(self):
+    def __init__(self, max_recorders: int = NODE_MAX_RECORDERS):
         super().__init__()
+        self.max_recorders = max_recorders
+        self.node_id = None
+        self._supervisor = None
+        self._encoder_pool = None
+
+    @staticmethod
+    def _load_records(db: RedisConnection, now: datetime) -> dict[str, dict]:
+        """
+        Загрузка незавершенных отложенных и всех регулярных записей из БД.
+        :param db: Указатель на базу данных
+        :param now: Текущий момент
+        :return: Словарь "ключ записи -> информация о записи"
+        """
+        return db.get_records(db.get_unfinished_record_keys(now) + db.get_record_keys('regular'))
+
+    def _start_regular_record(self, db: RedisConnection, key: str, info: dict):
+        subdirectory = generate_day_label(datetime.now())
+
+        print(f'Start {info["name"]}')
+        return RegularRecordLauncher.start_record_process(
+            db_key=key,
+            name=info['name'],
+            path=f'{info["path"]}/{subdirectory}',
+            fpm=info['fpm'],
+            rtsp=info['rtsp_url'],
+            end_time=str_to_time(info['time_to']),
+            with_audio=info['with_audio'],
+            segment_time=info['segment_time'],
+            motion=info.get('motion'),
+            encoder_pool=self._encoder_pool,
+            owner=self.node_id,
+        )
+
+    def _start_delayed_record(self, db: RedisConnection, key: str, info: dict):
+        print(f'Start {info["name"]}')
+        return RecordLauncher.start_record_process(
+            db_key=key,
+            name=info['name'],
+            path=info['path'],
+            fpm=info['fpm'],
+            rtsp=info['rtsp_url'],
+            end_date=str_to_datetime(info['date_to']),
+            with_audio=info['with_audio'],
+            segment_time=info['segment_time'],
+            motion=info.get('motion'),
+            encoder_pool=self._encoder_pool,
+            owner=self.node_id,
+        )
+
+    def _handle_event(self, db: RedisConnection, scheduler: RecordScheduler, event: ScheduleEvent, now: datetime,
+                      info: dict, due_keys: set[str]):
+        """
+        Обработка наступившего события расписания.
+        :param db: Указатель на базу данных
+        :param scheduler: Очередь событий
+        :param event: Событие
+        :param now: Текущий момент
+        :param info: Информация о записи
+        :param due_keys: Ключи незапущенных записей, которые должны выполняться сейчас
+        """
+        # Окно закончилось - планируем следующее (актуально для регулярных записей)
+        if event.kind == 'stop':
+            scheduler.plan(event.key, info, now)
+            return
+
+        # Запускать процесс, если:
+        # 1) процесс еще не запущен;
+        # 2) запись все еще находится во временном промежутке запуска.
+        if event.key not in due_keys:
+            return
+
+        # Процесс записи постоянно падал, до конца окна запись не перезапускается
+        if self._supervisor.gave_up(event.key, now):
+            return
+
+        # Узел загружен - запись подхватит другой узел, или этот повторит попытку после следующего heartbeat,
+        # когда завершившиеся процессы освободят место
+        if not self._supervisor.can_admit():
+            Metrics.get().inc('supervisor_admission_rejected_total', node=self.node_id)
+            scheduler.postpone(event, now + timedelta(seconds=LEASE_HEARTBEAT_SECONDS))
+            return
+
+        # Таска захватывается до запуска процесса, чтобы другой планировщик не запустил ту же камеру
+        due_keys.discard(event.key)
+        if not db.claim_task(event.key, self.node_id):
+            return
+
+        is_regular = event.key.startswith('regular:')
+        launcher, start = (
+            (RegularRecordLauncher, self._start_regular_record) if is_regular
+            else (RecordLauncher, self._start_delayed_record)
+        )
+        scheduled_at, ends_at = launcher.get_window(info, now)
+        try:
+            self._supervisor.start(event.key, lambda: start(db, event.key, info), ends_at)
+        except Exception as e:
+            print(f'Can\'t start record {event.key}!')
+            print(e)
+            db.release_task(event.key, self.node_id)
+            db.change_record_status(event.key, 'error')
+            return
+
+        # Задержка запуска относительно начала окна записи
+        metrics = Metrics.get()
+        metrics.inc('scheduler_records_started_total')
+        metrics.observe('scheduler_start_lag_seconds', (datetime.now() - scheduled_at).total_seconds())
+
+    def _heartbeat(self, db: RedisConnection) -> bool:
+        """
+        Обработка завершившихся процессов записи, продление аренд запущенных узлом записей, перезапуск упавших
+        воркеров пула кодировщиков и освобождение тасок умерших узлов (с истекшей арендой) со статусом 'error'.
+        :param db: Указатель на базу данных
+        :return: True, если освободились таски и расписание нужно перестроить
+        """
+        metrics = Metrics.get()
+
+        released = self._supervisor.check(db, datetime.now())
+        self._supervisor.renew(db)
+
+        if self._encoder_pool is not None:
+            metrics.inc('encoder_pool_worker_restarts_total', self._encoder_pool.restart_dead_workers())
+
+        reaped = db.reap_expired_tasks()
+        for key in reaped:
+            print(f'Reap task {key}')
+            db.change_record_status(key, 'error')
+        metrics.inc('scheduler_tasks_reaped_total', len(reaped))
+
+        now = datetime.now().timestamp()
+        db.register_node(self.node_id, {
+            'capacity': self._supervisor.capacity,
+            'running': len(self._supervisor),
+            'heartbeat_at': now,
+        })
+        db.unregister_nodes([
+            node for node, info in db.get_nodes().items() if now - info['heartbeat_at'] > 3 * LEASE_TTL_SECONDS
+        ])
+        metrics.set('scheduler_node_running', len(self._supervisor), node=self.node_id)
+        metrics.set('scheduler_node_capacity', self._supervisor.capacity, node=self.node_id)
+        metrics.flush()
+
+        return bool(released or reaped)
 
     def _seek(self):
         db = RedisConnection()
+        subscription = db.subscribe(PUBSUB_SCHEDULE_CHANNEL_NAME)
+        scheduler = RecordScheduler({
+            'videos': RecordLauncher.get_window,
+            'regular': RegularRecordLauncher.get_window,
+        })
+
+        resync_at = heartbeat_at = datetime.now()
         while True:
             now = datetime.now()
-            if ret := RegularRecordLauncher.seek_for_regular_record(db, now):
-                key, info = ret
-
-                subdirectory = generate_day_label(datetime.now())
-
-                print(f'Start {info["name"]}')
-                RegularRecordLauncher.start_record_process(
-                    db_key=key,
-                    name=info['name'],
-                    path=f'{info["path"]}/{subdirectory}',
-                    fpm=info['fpm'],
-                    rtsp=info['rtsp_url'],
-                    end_time=str_to_time(info['time_to']),
-                    with_audio=info['with_audio'],
-                    segment_time=info['segment_time'],
-                )
-                db.init_task(key)
-                continue
-
-            if ret := RecordLauncher.seek_for_record(db, now):
-                key, info = ret
-
-                print(f'Start {info["name"]}')
-                RecordLauncher.start_record_process(
-                    db_key=key,
-                    name=info['name'],
-                    path=info['path'],
-                    fpm=info['fpm'],
-                    rtsp=info['rtsp_url'],
-                    end_date=str_to_datetime(info['date_to']),
-                    with_audio=info['with_audio'],
-                    segment_time=info['segment_time'],
-                )
-                db.init_task(key)
-                continue
-
-            time_.sleep(self.SCAN_INTERVAL_SECONDS)
+
+            if now >= heartbeat_at:
+                if self._heartbeat(db):
+                    resync_at = now
+                heartbeat_at = now + timedelta(seconds=LEASE_HEARTBEAT_SECONDS)
+
+            # Полная перестройка расписания: при старте, по уведомлению от API и раз в RESYNC_INTERVAL_SECONDS
+            if now >= resync_at:
+                records = self._load_records(db, now)
+                scheduler.rebuild(records, now)
+                weekly_index = WeeklyIndex({
+                    key: info['week_intervals'] if 'week_intervals' in info else compile_regular_record(info)
+                    for key, info in records.items() if key.startswith('regular:')
+                })
+                resync_at = now + timedelta(seconds=self.RESYNC_INTERVAL_SECONDS)
+
+            if events := scheduler.pop_due(now):
+                videos, running = db.get_due_record_keys(now)
+                due_keys = set(videos) | (weekly_index.active(now) - running)
+                records = db.get_records(list({event.key for event in events}))
+                for event in events:
+                    if event.key in records:
+                        self._handle_event(db, scheduler, event, now, records[event.key], due_keys)
+                Metrics.get().flush()
+
+            now = datetime.now()
+            timeout = (min(resync_at, heartbeat_at) - now).total_seconds()
+            if (delay := scheduler.seconds_until_next(now)) is not None:
+                timeout = min(timeout, delay)
+
+            if subscription.get_message(ignore_subscribe_messages=True, timeout=max(timeout, 0)):
+                resync_at = datetime.now()
 
     def run(self):
         super().run()
+        self.node_id = f'{socket.gethostname()}:{os.getpid()}'
+        self._supervisor = RecordSupervisor(self.node_id, self.max_recorders)
+        if ENCODER_POOL_SIZE > 0:
+            self._encoder_pool = EncoderPool(ENCODER_POOL_SIZE)
+            self._encoder_pool.start()
         self._seek()
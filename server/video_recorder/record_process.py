@@ -1,16 +1,25 @@
-import contextlib
+import math
+import shutil
+import threading
 import time
 
 import cv2
 
 from datetime import datetime, timedelta
-from typing import Union
+from typing import Optional, Union
 import multiprocessing
 
-import server.directory_methods as directory_methods
 from server.const import RECONNECT_DELAY_SECONDS, VIDEO_EXTENSION, \
-    PUBSUB_VIDEO_CHANNEL_NAME
+    FRAME_QUEUE_SIZE, FRAME_QUEUE_MEMORY_MB, FRAME_QUEUE_POLICY, TIMELAPSE_MAX_FPM, \
+    FRAME_RING_SLOTS, ENCODER_POOL_RING_SLOTS, LEASE_HEARTBEAT_SECONDS
 from server.database import RedisConnection
+from server.metrics import Metrics
+from server.video_recorder.encoder_pool import EncoderPool, PooledSegment
+from server.video_recorder.frame_queue import FrameQueue, OverflowPolicy, frame_queue_size
+from server.video_recorder.frame_ring import FrameRing, frame_ring_name
+from server.video_recorder.keyframe_reader import KeyframeReader
+from server.video_recorder.lease_guard import LeaseGuard
+from server.video_recorder.motion_detector import MotionDetector, MotionGate
 from server.video_recorder.video_writer_manager import VideoWriterManager
 
 
@@ -18,6 +27,16 @@ class VideoRecorder(multiprocessing.Process):
     """
     Процесс для записи видео камерой.
     Является процессом из библиотеки multiprocessing. Для записи используется библиотека OpenCV.
+    Захват кадров с камеры идет в отдельном потоке и не ждет кодирования: кадры передаются кодировщику через
+    ограниченную очередь FrameQueue, при переполнении которой кадры выбрасываются.
+    Если fpm меньше FPS камеры, кадры берутся по дедлайнам по часам (а не по количеству пропущенных кадров);
+    если fpm не больше TIMELAPSE_MAX_FPM (режим timelapse), поток декодируется только по ключевым кадрам
+    (KeyframeReader).
+    Если задан motion, пишутся только кадры с движением (с предзаписью и дозаписью, см. MotionGate), а сегменты
+    без движения не создаются и не публикуются.
+    Если передан encoder_pool, процесс только захватывает кадры, а кодируют их воркеры общего пула: кадры передаются
+    через кольцевой буфер, а воркеру отправляются только их номера (см. EncoderPool).
+    Если узел потерял аренду таски или умер родительский процесс, запись останавливается (см. LeaseGuard).
     :param rtsp: URL для подключения к камере
     :param name: Идентификатор записи
     :param start_date: Дата и время начала записи
@@ -26,16 +45,39 @@ class VideoRecorder(multiprocessing.Process):
     :param db_key: Идентификатор записи в базе данных
     :param segment_time: Время одной записи (по умолчанию DEFAULT_SEGMENT_TIME из const.py), по истечении которого
     происходит разбиение
+    :param frame_queue_size: Размер очереди кадров между захватом и кодированием
+    :param frame_queue_memory_mb: Бюджет памяти очереди кадров: при большом разрешении камеры очередь уменьшается
+    (см. frame_queue_size)
+    :param overflow_policy: Политика при переполнении очереди ('drop_oldest' или 'drop_newest')
+    :param frame_ring_slots: Количество последних кадров, доступных другим процессам через кольцевой буфер
+    в разделяемой памяти (см. FrameRingReader и frame_ring_name); 0 - не публиковать кадры
+    :param motion: Настройки записи по движению (см. MotionConfig) или None, если писать нужно все кадры
+    :param encoder_pool: Общий пул кодировщиков или None, если кодировать кадры нужно в этом процессе
+    :param owner: Идентификатор узла, которому выдана аренда таски
 
     :param self._cap: Объект подключения к камере VideoCapture из OpenCV
     :param self._fps: Количество кадров в секунду, записываемых камерой
     :param self._camera_fps: FPS камеры, получаемый при подключении к камере
     :param self._db: Указатель на базу данных Redis
-    :param self._writer: Объект класса VideoWriterManager
+    :param self._writer: Объект класса VideoWriterManager или PooledSegment (None, пока в сегмент не записано
+    ни одного кадра)
+    :param self._writer_path: Путь до файла текущего сегмента
+    :param self._metrics: Буфер метрик процесса
+    :param self._timelapse: Декодировать ли только ключевые кадры
+    :param self._by_deadline: Брать ли кадры по дедлайнам (задан fpm меньше FPS камеры)
+    :param self._capture_failed: Завершился ли поток захвата ошибкой получения кадра
+    :param self._ring: Кольцевой буфер последних кадров
+    :param self._gate: Отбор кадров по движению
+    :param self._guard: Проверка аренды таски
+    :param self._dropped_reported: Количество выброшенных из текущей очереди кадров, уже учтенных в метриках
     """
 
     def __init__(self, rtsp: str, name: str, path: str, start_date: datetime, end_date: datetime,
-                 segment_time: int, db_key: str, fpm: Union[int, float] = None):
+                 segment_time: int, db_key: str, fpm: Union[int, float] = None,
+                 frame_queue_size: int = FRAME_QUEUE_SIZE, frame_queue_memory_mb: float = FRAME_QUEUE_MEMORY_MB,
+                 overflow_policy: OverflowPolicy = FRAME_QUEUE_POLICY,
+                 frame_ring_slots: int = FRAME_RING_SLOTS, motion: Optional[dict] = None,
+                 encoder_pool: Optional[EncoderPool] = None, owner: Optional[str] = None):
         super().__init__()
         self.rtsp = rtsp
 
@@ -48,6 +90,8 @@ class VideoRecorder(multiprocessing.Process):
         self.segment_time = segment_time
 
         self._fps = None if fpm is None else fpm / 60
+        self._timelapse = fpm is not None and fpm <= TIMELAPSE_MAX_FPM
+        self._by_deadline = False
 
         self._camera_fps = None
         self._camera_res = None
@@ -58,6 +102,22 @@ class VideoRecorder(multiprocessing.Process):
         self._cap = None
         self._writer = None
 
+        self.frame_queue_size = frame_queue_size
+        self.frame_queue_memory_mb = frame_queue_memory_mb
+        self.overflow_policy = overflow_policy
+        self.frame_ring_slots = frame_ring_slots
+        self.motion = motion
+        self.encoder_pool = encoder_pool
+        self.owner = owner
+
+        self._metrics = None
+        self._capture_failed = False
+        self._ring = None
+        self._gate = None
+        self._writer_path = None
+        self._guard = None
+        self._dropped_reported = 0
+
     def _connect_to_camera(self):
         """
         Попытка подключение к камере по rtsp.
@@ -77,22 +137,63 @@ class VideoRecorder(multiprocessing.Process):
             print(f'Can\'t connect to a camera! ({self.name})')
             return False
 
-    def _record_cycle(self, end_date: datetime):
+    def _open_frame_ring(self):
         """
-        Один цикл записи.
-        :return: 0 в случае успеха. -1 в случае ошибки.
+        Создание кольцевого буфера кадров по разрешению камеры.
         """
-        self._db.change_record_status(self.db_key, 'in_progress')
+        # Воркерам пула кадры передаются через буфер, поэтому он должен вмещать очередь кадров на кодирование
+        slots = max(self.frame_ring_slots, ENCODER_POOL_RING_SLOTS) if self.encoder_pool else self.frame_ring_slots
+        if slots <= 0 or self._ring is not None:
+            return
 
-        # Запись происходит до назначенного времени
-        file_id = directory_methods.get_next_image_index(self.path)
+        width, height = self._camera_res
+        try:
+            self._ring = FrameRing(frame_ring_name(self.db_key), (height, width, 3), slots)
+        except Exception as e:
+            print(f'Can\'t create frame ring! ({self.name})')
+            print(e)
 
-        i = 1
-        while datetime.now() < end_date:
-            file_id += 1
+    def _close_frame_ring(self):
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
 
-            i += 1
+    def _publish_frame(self, frame) -> Optional[int]:
+        """
+        Публикация кадра в кольцевой буфер. Кадры с другим разрешением (камеру перенастроили) пропускаются.
+        :param frame: Кадр
+        :return: Номер кадра в буфере или None, если кадр не опубликован
+        """
+        if self._ring is not None and frame.shape == self._ring.shape:
+            return self._ring.write(frame)
+        return None
+
+    def _capture(self, queue: FrameQueue, end_date: datetime, stop: threading.Event):
+        """
+        Поток захвата кадров с камеры. Кладет кадры в очередь до end_date, до остановки или до ошибки,
+        после чего закрывает очередь.
+        :param queue: Очередь кадров
+        :param end_date: Время окончания захвата
+        :param stop: Событие остановки захвата (кодировщик завершился)
+        """
+        self._capture_failed = False
+        try:
+            if self._by_deadline:
+                self._capture_by_deadline(queue, end_date, stop)
+            else:
+                self._capture_live(queue, end_date, stop)
+        except Exception as e:
+            print(f'Error while capturing frames! ({self.name})')
+            print(e)
+            self._capture_failed = True
+        finally:
+            queue.close()
 
+    def _capture_live(self, queue: FrameQueue, end_date: datetime, stop: threading.Event):
+        """
+        Захват кадров с декодированием всего потока.
+        """
+        while datetime.now() < end_date and not stop.is_set():
             # Пропуск кадров, если необходимо (задан fps меньше fps камеры)
             for _ in range(int(1 / self._fps * self._camera_fps)):
                 self._cap.grab()
@@ -101,59 +202,259 @@ class VideoRecorder(multiprocessing.Process):
 
             if not ret:
                 print('Error while retrieving image!')
-                return -1
+                self._metrics.inc('recorder_retrieve_failures_total', camera=self.name)
+                self._capture_failed = True
+                return
 
-            self._writer.write(frame)
-        self._cap.release()
-        time.sleep(2)
-        return 0
-
-    def _run_cycle(self, end_date):
-        self._connect_to_camera()
-
-        if self._fps is None:
-            self._fps = self._camera_fps
-
-        with contextlib.suppress(Exception):
-            res = self._record_cycle(end_date)
-            return res if res != -1 else None
+            queue.put((self._publish_frame(frame), frame))
 
-    def record(self):
+    def _capture_by_deadline(self, queue: FrameQueue, end_date: datetime, stop: threading.Event):
         """
-        Непосредственно процесс записи.
-        Запись начинается с определенного момента времени (self.begins_at) и заканчивается
-        в определенный момент времени (self.ends_at).
-        :return:
+        Захват кадров по дедлайнам: один кадр на каждый дедлайн (раз в 1 / fps секунд).
+        Дедлайны отсчитываются по часам, поэтому частота кадров не зависит от реального FPS камеры.
+        В режиме timelapse, если доступен ffmpeg, декодируются только ключевые кадры (KeyframeReader); если к дедлайну
+        нового ключевого кадра нет, дедлайн пропускается. Иначе между дедлайнами кадры пропускаются
+        через VideoCapture.grab().
         """
-        self._db = RedisConnection()
+        interval = 1 / self._fps
 
-        while datetime.now() < self.ends_at:
-            while not self._connect_to_camera():
-                print(self.rtsp)
-                print(f'Error on initial connection to camera! ({self.name})')
-                time.sleep(RECONNECT_DELAY_SECONDS)
+        reader = None
+        if self._timelapse and shutil.which('ffmpeg') is not None:
+            # Поток читает ffmpeg, подключение OpenCV нужно было только для параметров камеры
+            self._cap.release()
+            reader = KeyframeReader(self.rtsp, self._camera_res)
+            reader.start()
 
-            date_now = datetime.now()
-            filename = date_now.isoformat(timespec='seconds').replace(':', '_') + f'.{VIDEO_EXTENSION}'
-
-            print(f'{self.path}/{filename}', self._camera_fps, self._camera_res)
+        try:
+            deadline = time.monotonic()
+            while not stop.is_set() and datetime.now() < end_date:
+                if reader is not None:
+                    # Ожидание дедлайна, но не дольше конца цикла записи
+                    wait = min(deadline - time.monotonic(), (end_date - datetime.now()).total_seconds())
+                    if stop.wait(max(wait, 0)) or datetime.now() >= end_date:
+                        return
+
+                    frame = reader.latest(timeout=max(interval, RECONNECT_DELAY_SECONDS))
+                    ret = frame is not None or reader.alive
+                else:
+                    # Без KeyframeReader кадры до дедлайна пропускаются через grab (без декодирования в retrieve),
+                    # чтобы буфер камеры не переполнялся
+                    ret = self._cap.grab()
+                    while ret and time.monotonic() < deadline and not stop.is_set():
+                        if datetime.now() >= end_date:
+                            return
+                        ret = self._cap.grab()
+                    ret, frame = self._cap.retrieve() if ret else (False, None)
+
+                if not ret:
+                    print('Error while retrieving image!')
+                    self._metrics.inc('recorder_retrieve_failures_total', camera=self.name)
+                    self._capture_failed = True
+                    return
+
+                if frame is not None:
+                    queue.put((self._publish_frame(frame), frame))
+                else:
+                    self._metrics.inc('recorder_stale_keyframes_total', camera=self.name)
+
+                # Пропущенные дедлайны не навёрстываются
+                deadline += interval
+                if (now := time.monotonic()) > deadline:
+                    deadline += math.ceil((now - deadline) / interval) * interval
+        finally:
+            if reader is not None:
+                reader.close()
+
+    def _connect(self) -> bool:
+        """
+        Подключение к камере с повторными попытками до конца окна записи.
+        :return: True при успешном подключении; False, если окно записи закончилось
+        """
+        while datetime.now() < self.ends_at and not self._guard.lost.is_set():
+            if self._connect_to_camera():
+                # FPS камеры может быть неизвестен (0), тогда частоту кадров тоже держат дедлайны
+                self._by_deadline = self._fps is not None and (self._camera_fps <= 0 or self._fps < self._camera_fps)
+                if self._fps is None:
+                    self._fps = self._camera_fps
+                self._metrics.set('recorder_camera_fps', self._camera_fps, camera=self.name)
+                self._db.change_record_status(self.db_key, 'in_progress')
+                return True
+
+            print(self.rtsp)
+            print(f'Error on connection to camera! ({self.name})')
+            self._metrics.inc('recorder_reconnects_total', camera=self.name)
+            time.sleep(RECONNECT_DELAY_SECONDS)
+        return False
+
+    def _start_capture(self) -> tuple[FrameQueue, threading.Event, threading.Thread]:
+        """
+        Запуск потока захвата кадров до конца окна записи.
+        :return: Очередь кадров, событие остановки и поток захвата
+        """
+        queue = FrameQueue(
+            frame_queue_size(self.frame_queue_size, self.frame_queue_memory_mb, self._camera_res),
+            self.overflow_policy,
+        )
+        self._dropped_reported = 0
+        stop = threading.Event()
+        capture = threading.Thread(target=self._capture, args=(queue, self.ends_at, stop), daemon=True)
+        capture.start()
+        return queue, stop, capture
+
+    def _stop_capture(self, queue: FrameQueue, stop: threading.Event, capture: threading.Thread):
+        """
+        Остановка потока захвата кадров и отключение от камеры.
+        """
+        stop.set()
+        capture.join()
+        self._cap.release()
+        self._report_dropped(queue)
 
+    def _report_dropped(self, queue: FrameQueue):
+        """
+        Учет в метриках кадров, выброшенных из очереди после прошлого учета.
+        """
+        dropped = queue.dropped
+        if dropped > self._dropped_reported:
+            self._metrics.inc('recorder_dropped_frames_total', dropped - self._dropped_reported, camera=self.name)
+            self._dropped_reported = dropped
+
+    def _open_writer(self):
+        if self.encoder_pool is not None and self._ring is not None:
+            self._writer = self.encoder_pool.open_segment(
+                stream_id=f'{self.db_key}:{self._writer_path}',
+                ring_name=self._ring.name,
+                path=self._writer_path,
+                fps=self._camera_fps,
+                resolution=self._camera_res,
+                camera=self.name,
+            )
+        else:
             self._writer = VideoWriterManager(
-                writer_path=f'{self.path}/{filename}',
+                writer_path=self._writer_path,
                 fps=self._camera_fps,
                 resolution=self._camera_res,
             )
 
-            end_date = date_now + timedelta(minutes=self.segment_time)
-            while self._run_cycle(end_date) is None:
-                print(f'Error {self.name}')
-                self._db.change_record_status(self.db_key, 'error')
-                time.sleep(RECONNECT_DELAY_SECONDS)
+    def _write(self, item: tuple[Optional[int], object]):
+        """
+        Запись кадра в файл текущего сегмента. Файл создается при записи первого кадра.
+        :param item: Номер кадра в кольцевом буфере и сам кадр
+        """
+        if self._writer is None:
+            self._open_writer()
+
+        seq, frame = item
+        if not isinstance(self._writer, PooledSegment):
+            self._writer.write(frame)
+        elif seq is not None:
+            self._writer.write(seq)
+        else:
+            self._metrics.inc('encoder_pool_dropped_frames_total', camera=self.name)
 
-            self._writer.release()
-            self._db.publish(PUBSUB_VIDEO_CHANNEL_NAME, f'{self.path}/{filename}')
+    def _record_segment(self, queue: FrameQueue, segment_end: datetime) -> bool:
+        """
+        Запись кадров из очереди в текущий файл (self._writer) до конца сегмента.
+        :param queue: Очередь кадров
+        :param segment_end: Время конца сегмента
+        :return: True, если сегмент записан до конца (или аренда таски потеряна); False, если захват кадров
+        завершился ошибкой
+        """
+        written, started_at = 0, time.monotonic()
+        try:
+            while (remain := (segment_end - datetime.now()).total_seconds()) > 0 and not self._guard.lost.is_set():
+                item = queue.get(timeout=min(remain, LEASE_HEARTBEAT_SECONDS))
+                if item is not None:
+                    selected = self._gate.feed(item[1], time.monotonic(), payload=item) if self._gate else (item,)
+                    for selected_item in selected:
+                        self._write(selected_item)
+                        written += 1
+                elif queue.closed:
+                    return not self._capture_failed
+            return True
+        finally:
+            # Фактический FPS записи и выброшенные кадры за сегмент
+            elapsed = time.monotonic() - started_at
+            self._metrics.inc('recorder_frames_written_total', written, camera=self.name)
+            self._report_dropped(queue)
+            if elapsed > 0:
+                self._metrics.set('recorder_achieved_fps', written / elapsed, camera=self.name)
 
-        self._db.complete_task(self.db_key)
+    def record(self):
+        """
+        Непосредственно процесс записи.
+        Запись начинается с определенного момента времени (self.begins_at) и заканчивается
+        в определенный момент времени (self.ends_at).
+        Подключение к камере держится все окно записи: при смене сегмента меняется только файл (VideoWriterManager),
+        переподключение происходит, только если поток с камеры оборвался.
+        :return:
+        """
+        self._db = RedisConnection()
+        self._metrics = Metrics.get()
+        self._guard = LeaseGuard(self.db_key, self.owner)
+        self._guard.start()
+
+        if self._connect():
+            if self.motion:
+                self._gate = MotionGate(
+                    MotionDetector(self.motion['pixel_threshold'], self.motion['min_area']),
+                    pre_roll=self.motion['pre_roll'],
+                    post_roll=self.motion['post_roll'],
+                    fps=self._fps,
+                )
+            self._open_frame_ring()
+            capture = self._start_capture()
+            try:
+                while datetime.now() < self.ends_at and not self._guard.lost.is_set():
+                    date_now = datetime.now()
+                    filename = date_now.isoformat(timespec='seconds').replace(':', '_') + f'.{VIDEO_EXTENSION}'
+
+                    print(f'{self.path}/{filename}', self._camera_fps, self._camera_res)
+
+                    self._writer, self._writer_path = None, f'{self.path}/{filename}'
+                    if self._gate is None:
+                        self._open_writer()
+
+                    segment_end = min(date_now + timedelta(minutes=self.segment_time), self.ends_at)
+                    while not self._record_segment(capture[0], segment_end):
+                        print(f'Error {self.name}')
+                        self._db.change_record_status(self.db_key, 'error')
+                        self._metrics.inc('recorder_reconnects_total', camera=self.name)
+                        self._stop_capture(*capture)
+                        capture = None
+                        time.sleep(RECONNECT_DELAY_SECONDS)
+
+                        if not self._connect():
+                            break
+                        capture = self._start_capture()
+
+                    # Сегмент без движения не создается
+                    if self._writer is None:
+                        self._metrics.inc('recorder_motion_skipped_segments_total', camera=self.name)
+                        continue
+
+                    # Сегмент из пула публикует воркер, после того как закодирует все кадры
+                    if isinstance(self._writer, PooledSegment):
+                        self._writer.release()
+                        continue
+
+                    # Сегмент публикуется после склейки с уже существующим видео (если она нужна)
+                    self._writer.release(on_released=self._db.enqueue_upload)
+                    self._metrics.observe(
+                        'recorder_segment_write_seconds', self._writer.write_seconds, camera=self.name,
+                    )
+            finally:
+                if capture is not None:
+                    self._stop_capture(*capture)
+                self._close_frame_ring()
+
+        self._guard.stop()
+        # Потерянную таску пишет другой узел, завершать ее нельзя
+        if self._guard.lost.is_set():
+            self._metrics.inc('recorder_lease_lost_total', camera=self.name)
+        else:
+            self._db.complete_task(self.db_key)
+        self._metrics.remove_gauges(camera=self.name)
         print('End')
 
         return 0
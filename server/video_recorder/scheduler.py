@@ -0,0 +1,115 @@
+import heapq
+import itertools
+
+from datetime import datetime
+from typing import Callable, Literal, NamedTuple, Optional
+
+
+EventKind = Literal['start', 'stop']
+
+
+class ScheduleEvent(NamedTuple):
+    """
+    Событие расписания.
+    :param at: Момент наступления события
+    :param kind: 'start' (начало окна записи) или 'stop' (конец окна записи)
+    :param key: Ключ записи БД
+    :param ends_at: Конец окна записи, к которому относится событие
+    """
+    at: datetime
+    kind: EventKind
+    key: str
+    ends_at: datetime
+
+
+WindowFunction = Callable[[dict, datetime], Optional[tuple[datetime, datetime]]]
+
+
+class RecordScheduler:
+    """
+    Упорядоченная по времени очередь событий начала и конца записи.
+    Очередь строится по окнам записей (см. RecordLauncher.get_window и RegularRecordLauncher.get_window)
+    и позволяет спать до ближайшего события вместо периодического сканирования БД.
+    :param window_functions: Словарь "префикс ключа -> функция вычисления ближайшего окна записи"
+
+    :param self._heap: Куча событий
+    :param self._counter: Счетчик для стабильной сортировки событий с одинаковым временем
+    """
+
+    def __init__(self, window_functions: dict[str, WindowFunction]):
+        self._window_functions = window_functions
+        self._heap: list[tuple[float, int, ScheduleEvent]] = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _window_function(self, key: str) -> WindowFunction:
+        return self._window_functions[key.split(':', 1)[0]]
+
+    def _push(self, event: ScheduleEvent):
+        heapq.heappush(self._heap, (event.at.timestamp(), next(self._counter), event))
+
+    def clear(self):
+        """
+        Очистка очереди событий.
+        """
+        self._heap.clear()
+
+    def plan(self, key: str, info: dict, now: datetime):
+        """
+        Добавляет в очередь события начала и конца ближайшего окна записи.
+        Если окно уже началось, событие начала назначается на текущий момент.
+        :param key: Ключ записи БД
+        :param info: Информация о записи
+        :param now: Текущий момент
+        """
+        if (window := self._window_function(key)(info, now)) is None:
+            return
+
+        start, end = window
+        self._push(ScheduleEvent(max(start, now), 'start', key, end))
+        self._push(ScheduleEvent(end, 'stop', key, end))
+
+    def postpone(self, event: ScheduleEvent, at: datetime):
+        """
+        Повторное добавление события начала записи, которое сейчас нельзя обработать.
+        Если окно записи закончится раньше, событие не добавляется.
+        :param event: Событие
+        :param at: Новый момент наступления события
+        """
+        if at < event.ends_at:
+            self._push(event._replace(at=at))
+
+    def rebuild(self, records: dict[str, dict], now: datetime):
+        """
+        Полная перестройка очереди по записям из БД.
+        :param records: Словарь "ключ записи -> информация о записи"
+        :param now: Текущий момент
+        """
+        self.clear()
+        for key, info in records.items():
+            if info is not None:
+                self.plan(key, info, now)
+
+    def seconds_until_next(self, now: datetime) -> Optional[float]:
+        """
+        Время до ближайшего события.
+        :param now: Текущий момент
+        :return: Количество секунд (не меньше нуля) или None, если очередь пуста
+        """
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - now.timestamp(), 0)
+
+    def pop_due(self, now: datetime) -> list[ScheduleEvent]:
+        """
+        Извлекает из очереди все наступившие события.
+        :param now: Текущий момент
+        :return: Список событий в порядке наступления
+        """
+        due = []
+        timestamp = now.timestamp()
+        while self._heap and self._heap[0][0] <= timestamp:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
@@ -0,0 +1,111 @@
+import multiprocessing
+
+from datetime import datetime
+from typing import Optional
+
+import server.directory_methods as directory_methods
+from server.const import RECONNECT_DELAY_SECONDS
+from server.database import RedisConnection
+from server.metrics import Metrics
+from server.video_recorder.ffmpeg_segmenter import FfmpegSegmenter
+from server.video_recorder.lease_guard import LeaseGuard
+
+
+class StreamCopyRecorder(multiprocessing.Process):
+    """
+    Процесс для записи видео камерой без перекодирования.
+    Является процессом из библиотеки multiprocessing. RTSP-поток (h264 с камеры) перепаковывается в сегменты
+    VIDEO_EXTENSION утилитой ffmpeg без декодирования (см. FfmpegSegmenter). Используется для записи без звука,
+    если не задан fpm.
+    Если узел потерял аренду таски или умер родительский процесс, ffmpeg останавливается (см. LeaseGuard).
+    :param rtsp: URL для подключения к камере
+    :param name: Идентификатор записи
+    :param path: Папка для записи
+    :param start_date: Дата и время начала записи
+    :param end_date: Дата и время конца записи
+    :param db_key: Идентификатор записи в базе данных
+    :param segment_time: Время одной записи (по умолчанию DEFAULT_SEGMENT_TIME из const.py), по истечении которого
+    происходит разбиение
+    :param owner: Идентификатор узла, которому выдана аренда таски
+
+    :param self._db: Указатель на базу данных Redis
+    :param self._metrics: Буфер метрик процесса
+    :param self._guard: Проверка аренды таски
+    :param self._segmenter: Текущий процесс ffmpeg
+    """
+    # Записывать ли звук (см. VideoAudioRecorder)
+    WITH_AUDIO = False
+
+    def __init__(self, rtsp: str, name: str, path: str, start_date: datetime, end_date: datetime,
+                 segment_time: int, db_key: str, owner: Optional[str] = None):
+        super().__init__()
+        self.rtsp = rtsp
+
+        self.name = name
+        self.path = path
+
+        self.begins_at = start_date
+        self.ends_at = end_date
+
+        self.segment_time = segment_time
+
+        self._db = None
+        self.db_key = db_key
+        self.owner = owner
+
+        self._metrics = None
+        self._guard = None
+        self._segmenter = None
+
+    def _on_lease_lost(self):
+        if self._segmenter is not None:
+            self._segmenter.stop()
+
+    def record(self):
+        """
+        Непосредственно процесс записи.
+        Один процесс ffmpeg пишет все окно записи; если он падает (например, камера отвалилась), запускается
+        новый на оставшееся время.
+        :return:
+        """
+        self._db = RedisConnection()
+        self._metrics = Metrics.get()
+        self._guard = LeaseGuard(self.db_key, self.owner, on_lost=self._on_lease_lost)
+        self._guard.start()
+
+        while not self._guard.lost.is_set() and (remain_seconds := (self.ends_at - datetime.now()).total_seconds()) > 0:
+            directory_methods.mkdir(self.path)
+
+            self._segmenter = segmenter = FfmpegSegmenter(
+                self.rtsp, self.path, self.segment_time * 60, remain_seconds, audio=self.WITH_AUDIO,
+            )
+            segmenter.start()
+            self._db.change_record_status(self.db_key, 'in_progress')
+
+            try:
+                for segment in segmenter.segments():
+                    self._metrics.inc('recorder_segments_total', camera=self.name)
+                    self._db.enqueue_upload(segment)
+            finally:
+                segmenter.stop()
+
+            if segmenter.returncode != 0 and not self._guard.lost.is_set():
+                print(f'Error while recording video stream! {self.name}')
+                self._db.change_record_status(self.db_key, 'error')
+                self._metrics.inc('recorder_reconnects_total', camera=self.name)
+                self._guard.lost.wait(RECONNECT_DELAY_SECONDS)
+
+        self._guard.stop()
+        # Потерянную таску пишет другой узел, завершать ее нельзя
+        if self._guard.lost.is_set():
+            self._metrics.inc('recorder_lease_lost_total', camera=self.name)
+        else:
+            self._db.complete_task(self.db_key)
+        self._metrics.flush()
+        print('End')
+
+        return 0
+
+    def run(self) -> None:
+        super().run()
+        self.record()
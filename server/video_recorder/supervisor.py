@@ -0,0 +1,186 @@
+import multiprocessing
+import os
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from server.const import SUPERVISOR_RECORDERS_PER_CPU, SUPERVISOR_MAX_LOAD_PER_CPU, RECORDER_MEMORY_MB, \
+    SUPERVISOR_RESTART_BACKOFF_SECONDS, SUPERVISOR_MAX_RESTART_BACKOFF_SECONDS, SUPERVISOR_MAX_RESTARTS
+from server.database import RedisConnection
+from server.metrics import Metrics
+
+
+def available_memory_mb() -> Optional[float]:
+    """
+    Объем доступной памяти хоста (MemAvailable из /proc/meminfo).
+    :return: Объем памяти в мегабайтах или None, если его нельзя узнать
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+@dataclass
+class Child:
+    """
+    Процесс записи под наблюдением супервизора.
+    :param start: Функция запуска процесса записи (возвращает запущенный процесс)
+    :param ends_at: Конец окна записи, после которого процесс не перезапускается
+    :param process: Процесс записи (None, пока процесс ждет перезапуска)
+    :param restarts: Количество перезапусков
+    :param restart_at: Время следующего перезапуска
+    """
+    start: Callable[[], multiprocessing.Process]
+    ends_at: datetime
+    process: Optional[multiprocessing.Process] = None
+    restarts: int = 0
+    restart_at: Optional[datetime] = None
+
+
+class RecordSupervisor:
+    """
+    Владелец всех процессов записи узла.
+    Ограничивает количество одновременно идущих записей бюджетом хоста по процессору и памяти, по коду завершения
+    отличает нормальное завершение процесса от падения, перезапускает упавшие процессы с экспоненциальной задержкой
+    (пока не закончилось окно записи) и освобождает таски, которые больше никто не пишет.
+    Пока процесс ждет перезапуска, аренда его таски сохраняется (см. renew), и другие узлы запись не забирают.
+    От записи, процесс которой упал больше SUPERVISOR_MAX_RESTARTS раз, супервизор отказывается до конца ее окна
+    (см. gave_up), иначе планировщик сразу запустил бы ее снова без ограничения перезапусков.
+    :param node_id: Идентификатор узла (владелец аренд тасок)
+    :param max_recorders: Максимальное количество записей на узле
+
+    :param self.capacity: Максимальное количество записей с учетом количества ядер
+    :param self._children: Процессы записи по ключам записей
+    :param self._given_up: Концы окон записей, от которых супервизор отказался, по ключам записей
+    """
+
+    def __init__(self, node_id: str, max_recorders: int):
+        self.node_id = node_id
+        self.capacity = min(max_recorders, max(1, int((os.cpu_count() or 1) * SUPERVISOR_RECORDERS_PER_CPU)))
+        self._children: dict[str, Child] = {}
+        self._given_up: dict[str, datetime] = {}
+
+    def __len__(self):
+        return len(self._children)
+
+    def __contains__(self, key: str):
+        return key in self._children
+
+    def can_admit(self) -> bool:
+        """
+        Можно ли запустить на узле еще одну запись: не превышен лимит записей, средняя загрузка процессора
+        и свободная память позволяют запустить еще один процесс.
+        """
+        if len(self._children) >= self.capacity:
+            return False
+
+        if hasattr(os, 'getloadavg') and os.getloadavg()[0] / (os.cpu_count() or 1) > SUPERVISOR_MAX_LOAD_PER_CPU:
+            return False
+
+        memory = available_memory_mb()
+        return memory is None or memory >= RECORDER_MEMORY_MB
+
+    def start(self, key: str, start: Callable[[], multiprocessing.Process], ends_at: datetime):
+        """
+        Запуск процесса записи под наблюдением супервизора.
+        Исключение при запуске пробрасывается, таска в этом случае освобождается вызывающим кодом.
+        :param key: Ключ записи
+        :param start: Функция запуска процесса записи
+        :param ends_at: Конец окна записи
+        """
+        self._children[key] = Child(start=start, ends_at=ends_at, process=start())
+
+    def _backoff(self, restarts: int) -> timedelta:
+        return timedelta(seconds=min(
+            SUPERVISOR_RESTART_BACKOFF_SECONDS * 2 ** restarts, SUPERVISOR_MAX_RESTART_BACKOFF_SECONDS,
+        ))
+
+    def gave_up(self, key: str, now: datetime) -> bool:
+        """
+        Отказался ли супервизор от записи в ее текущем окне.
+        :param key: Ключ записи
+        :param now: Текущий момент
+        """
+        ends_at = self._given_up.get(key)
+        if ends_at is not None and now >= ends_at:
+            del self._given_up[key]
+            return False
+        return ends_at is not None
+
+    def _give_up(self, db: RedisConnection, key: str):
+        self._given_up[key] = self._children.pop(key).ends_at
+        if db.release_task(key, self.node_id):
+            db.change_record_status(key, 'error')
+
+    def check(self, db: RedisConnection, now: datetime) -> bool:
+        """
+        Обработка завершившихся процессов и перезапуск упавших.
+        :param db: Указатель на базу данных
+        :param now: Текущий момент
+        :return: True, если освободились таски и расписание нужно перестроить
+        """
+        metrics = Metrics.get()
+        released = False
+
+        for key, child in list(self._children.items()):
+            process = child.process
+            if process is not None and process.is_alive():
+                continue
+
+            if process is not None:
+                # Процесс записи сам снимает аренду и отметку о таске при нормальном завершении
+                if process.exitcode == 0:
+                    del self._children[key]
+                    db.release_task(key, self.node_id)
+                    released = True
+                    continue
+
+                print(f'Record {key} crashed with exit code {process.exitcode}!')
+                metrics.inc('supervisor_recorder_crashes_total', record=key)
+                db.change_record_status(key, 'error')
+
+                if now >= child.ends_at or child.restarts >= SUPERVISOR_MAX_RESTARTS:
+                    self._give_up(db, key)
+                    released = True
+                    continue
+
+                child.process = None
+                child.restart_at = now + self._backoff(child.restarts)
+
+            if now < child.restart_at:
+                continue
+
+            if now >= child.ends_at:
+                self._give_up(db, key)
+                released = True
+                continue
+
+            child.restarts += 1
+            print(f'Restart {key} (attempt {child.restarts})')
+            metrics.inc('supervisor_recorder_restarts_total', record=key)
+            try:
+                child.process = child.start()
+            except Exception as e:
+                print(f'Can\'t restart record {key}!')
+                print(e)
+                child.restart_at = now + self._backoff(child.restarts)
+
+        return released
+
+    def renew(self, db: RedisConnection):
+        """
+        Продление аренд тасок всех записей узла. Процессы, аренду которых захватил другой узел, останавливаются.
+        :param db: Указатель на базу данных
+        """
+        for key in db.renew_leases(list(self._children), self.node_id):
+            print(f'Lease of {key} is lost!')
+            Metrics.get().inc('scheduler_leases_lost_total', node=self.node_id)
+            child = self._children.pop(key)
+            if child.process is not None:
+                child.process.terminate()
@@ -1,97 +1,167 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from typing import Callable, Iterator, Optional
+
 import cv2
 
 import server.directory_methods as directory_methods
 from server.const import VIDEO_CODEC
 
 
-def extract_frames_from_video(video_path: str):
+def iter_video_frames(video_path: str) -> Iterator:
     """
-    Считывает все кадры из видео.
+    Последовательно считывает кадры из видео, не загружая их все в память.
     :param video_path: Путь до видео
-    :return video_info: Информация о разрешении и fps камеры
-    :return images: Список кадров из видео
+    :return: Генератор кадров
     """
     vid = cv2.VideoCapture(video_path)
-    images = []
-
-    fps = vid.get(cv2.CAP_PROP_FPS)
-    res = int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    try:
+        while vid.isOpened():
+            ret, frame = vid.read()
+            if not ret:
+                break
+            yield frame
+    finally:
+        vid.release()
 
-    video_info = (res, fps)
 
-    while vid.isOpened():
-        ret, frame = vid.read()
-        if not ret:
-            break
+def video_resolution(video_path: str) -> Optional[tuple[int, int]]:
+    """
+    Разрешение видео.
+    :param video_path: Путь до видео
+    :return: Ширина и высота или None, если видео не удалось открыть
+    """
+    vid = cv2.VideoCapture(video_path)
+    try:
+        if not vid.isOpened():
+            return None
+        return int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        vid.release()
 
-        images.append(frame)
 
-    vid.release()
-    return video_info, images
+def concat_videos(paths: list[str], output_path: str) -> bool:
+    """
+    Склейка видео без перекодирования (ffmpeg concat demuxer, -c copy).
+    :param paths: Пути до видео в порядке склейки
+    :param output_path: Путь до результата
+    :return: True в случае успеха; False, если ffmpeg недоступен или видео нельзя склеить без перекодирования
+    """
+    if shutil.which('ffmpeg') is None:
+        return False
+
+    fd, list_path = tempfile.mkstemp(prefix='concat-', suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as concat_list:
+            for path in paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                concat_list.write(f"file '{escaped}'\n")
+
+        result = subprocess.run(
+            ['ffmpeg', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', list_path,
+             '-map', '0', '-c', 'copy', output_path],
+            stdin=subprocess.DEVNULL,
+        )
+        return result.returncode == 0
+    finally:
+        os.remove(list_path)
 
 
 class VideoWriterManager:
     """
     Осуществляет запись кадров в файл (в данном случае из трансляции с камеры)
+    Если по указанному пути уже есть видео, кадры пишутся в файл-продолжение, который после release склеивается
+    с существующим видео без перекодирования (concat_videos). Если склеить без перекодирования нельзя, видео
+    перекодируются покадрово, поэтому память не зависит от длины существующего видео. Склейка идет в отдельном
+    потоке, чтобы не задерживать запись следующего сегмента. Видео с другим разрешением не склеиваются:
+    файл-продолжение остается отдельным видео.
     :param writer_path: Путь до видео
     :param fps: FPS видеофайла
     :param resolution: Разрешение видеофайла
 
     :param self._copy: Находится ли по указанному пути видеофайл
+    :param self._writer_path: Путь до файла, в который пишутся кадры (файл-продолжение, если self._copy)
+    :param self.write_seconds: Суммарное время кодирования и записи кадров (включая release, но без склейки)
     """
 
-    @staticmethod
-    def _get_video_writer_from_existing_video(video_path):
-        """
-        Возвращает объект VideoWriter из OpenCV, считывая изображения из видео
-        :param video_path: Путь до существующего видео
-        :return: Объект VideoWriter
-        """
-        info, images = extract_frames_from_video(video_path)
-
-        new_path = directory_methods.create_copy_of_filename(video_path)
-        resolution, fps = info
-
-        writer = cv2.VideoWriter(
-            new_path,
-            *VIDEO_CODEC,
-            fps,
-            resolution,
-        )
-
-        for im in images:
-            writer.write(im)
-
-        return writer
-
     def __init__(self, *, writer_path: str, fps: int | float, resolution: tuple[int, int]):
         self._path = writer_path
+        self._fps = fps
+        self._resolution = resolution
+        self.write_seconds = 0.0
+
+        self._copy = directory_methods.exists(writer_path)
+        self._writer_path = directory_methods.create_copy_of_filename(writer_path) if self._copy else writer_path
+        self._writer = self._create_writer(self._writer_path)
+
+    def _create_writer(self, path: str):
+        return cv2.VideoWriter(
+            path,
+            cv2.VideoWriter_fourcc(*f'{VIDEO_CODEC}'),
+            self._fps,
+            self._resolution,
+        )
 
-        if directory_methods.exists(writer_path):
-            self._copy = True
-            self._writer = VideoWriterManager._get_video_writer_from_existing_video(writer_path)
-        else:
-            self._copy = False
-            self._writer = cv2.VideoWriter(
-                writer_path,
-                cv2.VideoWriter_fourcc(*f'{VIDEO_CODEC}'),
-                fps,
-                resolution,
-            )
+    def _merge_with_existing(self) -> str:
+        """
+        Склейка существующего видео с файлом-продолжением. Результат сохраняется по исходному пути.
+        :return: Путь до видео с записанными кадрами: исходный путь или путь файла-продолжения, если разрешение
+        существующего видео не совпадает с разрешением записи
+        """
+        if video_resolution(self._path) != tuple(self._resolution):
+            print(f'Can\'t merge {self._writer_path} into {self._path}: resolution differs')
+            return self._writer_path
+
+        merged_path = directory_methods.create_copy_of_filename(self._writer_path)
+
+        if not concat_videos([self._path, self._writer_path], merged_path):
+            # Покадровая склейка с перекодированием: в памяти одновременно находится только один кадр
+            writer = self._create_writer(merged_path)
+            for path in (self._path, self._writer_path):
+                for frame in iter_video_frames(path):
+                    writer.write(frame)
+            writer.release()
+
+        directory_methods.rename(merged_path, self._path)
+        os.remove(self._writer_path)
+        return self._path
+
+    def _merge_in_background(self, on_released: Optional[Callable[[str], None]]):
+        try:
+            path = self._merge_with_existing()
+        except Exception as e:
+            print(f'Error while merging {self._writer_path} into {self._path}!')
+            print(e)
+            path = self._writer_path
+        if on_released is not None:
+            on_released(path)
 
     def write(self, image):
         """
         Запись изображения в видео.
         :param image: Изображение
         """
+        started_at = time.perf_counter()
         self._writer.write(image)
+        self.write_seconds += time.perf_counter() - started_at
 
-    def release(self):
+    def release(self, on_released: Optional[Callable[[str], None]] = None):
         """
         Прекращение процесса записи в файл.
+        Если нужна склейка с существующим видео, она запускается в отдельном (не daemon) потоке, и on_released
+        вызывается из него после склейки.
+        :param on_released: Вызывается с путем до готового видео (например, чтобы поставить его в очередь загрузки)
         """
+        started_at = time.perf_counter()
         self._writer.release()
+        self.write_seconds += time.perf_counter() - started_at
 
         if self._copy:
-            old_path = directory_methods.create_copy_of_filename(self._path)
-            directory_methods.rename(old_path, self._path)
+            threading.Thread(target=self._merge_in_background, args=(on_released,)).start()
+        elif on_released is not None:
+            on_released(self._path)
@@ -0,0 +1,142 @@
+from array import array
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from typing import Optional
+
+from server.const import DATE_FORMAT
+
+MINUTES_IN_DAY = 24 * 60
+MINUTES_IN_WEEK = 7 * MINUTES_IN_DAY
+
+
+def minute_of_day(t: time) -> int:
+    """
+    Перевод времени в номер минуты от начала суток.
+    :param t: Время
+    :return: Номер минуты (0..1439)
+    """
+    return t.hour * 60 + t.minute
+
+
+def week_intervals(time_from: time, time_to: time, days_of_week: list[int]) -> list[tuple[int, int]]:
+    """
+    Перевод регулярного расписания в список полуоткрытых интервалов [начало, конец) в минутах от начала недели
+    (понедельник, 00:00). Интервалы, переходящие через конец недели, разбиваются на два.
+    Семантика совпадает с RegularRecordLauncher.get_window: если time_from больше или равно time_to, запись в разрешенный
+    день идет с полуночи до time_to и с time_from до time_to следующего дня.
+    :param time_from: Время начала записи
+    :param time_to: Время конца записи
+    :param days_of_week: Дни недели (0..6)
+    :return: Отсортированный список непересекающихся интервалов
+    """
+    start, end = minute_of_day(time_from), minute_of_day(time_to)
+
+    raw = []
+    for day in set(days_of_week):
+        offset = day * MINUTES_IN_DAY
+        if start < end:
+            raw.append((offset + start, offset + end))
+        else:
+            raw.append((offset, offset + end))
+            raw.append((offset + start, offset + MINUTES_IN_DAY + end))
+
+    # Разбиение интервалов, переходящих через конец недели
+    split = []
+    for a, b in raw:
+        if b > MINUTES_IN_WEEK:
+            split.append((a, MINUTES_IN_WEEK))
+            split.append((0, b - MINUTES_IN_WEEK))
+        elif a < b:
+            split.append((a, b))
+
+    # Слияние пересекающихся и соседних интервалов
+    merged = []
+    for a, b in sorted(split):
+        if merged and a <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+        else:
+            merged.append((a, b))
+    return merged
+
+
+def minute_of_week(moment: datetime) -> int:
+    """
+    Номер минуты от начала недели (понедельник, 00:00).
+    :param moment: Момент времени
+    :return: Номер минуты (0..10079)
+    """
+    return moment.weekday() * MINUTES_IN_DAY + moment.hour * 60 + moment.minute
+
+
+def compile_regular_record(info: dict) -> list[list[int]]:
+    """
+    Компиляция регулярной записи из БД в интервалы минут недели (см. week_intervals).
+    :param info: Информация о регулярной записи (time_from и time_to в формате DATE_FORMAT, days_of_week)
+    :return: Список интервалов [начало, конец) в json-friendly формате
+    """
+    time_from = datetime.strptime(info['time_from'], DATE_FORMAT).time()
+    time_to = datetime.strptime(info['time_to'], DATE_FORMAT).time()
+    return [list(interval) for interval in week_intervals(time_from, time_to, info['days_of_week'])]
+
+
+def next_window(intervals: list[list[int]], now: datetime) -> Optional[tuple[datetime, datetime]]:
+    """
+    Ближайшее окно записи по скомпилированным интервалам, которое еще не закончилось.
+    Интервалы, разбитые на границе недели, снова объединяются в одно окно.
+    :param intervals: Интервалы минут недели
+    :param now: Текущий момент
+    :return: Начало и конец окна или None, если интервалов нет
+    """
+    week_start = datetime.combine(now.date() - timedelta(days=now.weekday()), time.min)
+
+    windows = []
+    for week in (-1, 0, 1):
+        offset = week_start + timedelta(weeks=week)
+        for a, b in intervals:
+            start, end = offset + timedelta(minutes=a), offset + timedelta(minutes=b)
+            if windows and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+            else:
+                windows.append((start, end))
+
+    return next((w for w in windows if w[1] > now), None)
+
+
+class WeeklyIndex:
+    """
+    Индекс регулярных записей с поминутным разрешением на неделю.
+    Неделя разбивается на отрезки, внутри которых набор активных записей не меняется. Для каждой минуты недели хранится
+    номер отрезка, поэтому ответ на вопрос "какие записи должны идти сейчас" не зависит от количества записей.
+    :param schedules: Словарь "ключ записи -> интервалы минут недели" (см. compile_regular_record)
+
+    :param self._segments: Множества активных записей для каждого отрезка
+    :param self._minute_segment: Номер отрезка для каждой минуты недели
+    """
+
+    def __init__(self, schedules: dict[str, list[list[int]]]):
+        starts, ends = defaultdict(set), defaultdict(set)
+        for key, intervals in schedules.items():
+            for a, b in intervals:
+                starts[a].add(key)
+                ends[b].add(key)
+
+        points = sorted({0, MINUTES_IN_WEEK} | starts.keys() | ends.keys())
+
+        self._segments: list[frozenset[str]] = []
+        self._minute_segment = array('I', [0]) * MINUTES_IN_WEEK
+
+        active = set()
+        for a, b in zip(points, points[1:]):
+            active -= ends[a]
+            active |= starts[a]
+            if not self._segments or self._segments[-1] != active:
+                self._segments.append(frozenset(active))
+            self._minute_segment[a:b] = array('I', [len(self._segments) - 1]) * (b - a)
+
+    def active(self, moment: datetime) -> frozenset[str]:
+        """
+        Регулярные записи, которые должны идти в указанный момент.
+        :param moment: Момент времени
+        :return: Множество ключей записей
+        """
+        return self._segments[self._minute_segment[minute_of_week(moment)]]
@@ -0,0 +1,200 @@
+import io
+import os
+import posixpath
+import threading
+import unittest
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from server.disk_uploader.storage import HttpChunkedStorage, StorageError, PathExistsError, DirectoryExistsError, \
+    ParentNotFoundError, UploadSessionExpired
+
+
+class StandInStorage:
+    """
+    Сервер-заглушка хранилища по протоколу HttpChunkedStorage. Файлы и папки хранятся в памяти.
+    :param self.files: Загруженные файлы по путям
+    :param self.dirs: Созданные папки ('' - корень)
+    :param self.sessions: Сессии загрузки (путь, размер, полученные байты)
+    :param self.fail_patches: Номера запросов PATCH, на которые сервер отвечает ошибкой 500
+    """
+
+    def __init__(self):
+        self.files: dict[str, bytes] = {}
+        self.dirs = {''}
+        self.sessions: dict[str, dict] = {}
+        self.fail_patches: set[int] = set()
+        self.patches = 0
+        self.lock = threading.Lock()
+
+    def handler(self):
+        storage = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code: int, headers: dict = None):
+                self.send_response(code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                query = {name: values[0] for name, values in parse_qs(url.query).items()}
+                path = query['path'].strip('/')
+                parent = posixpath.dirname(path)
+
+                with storage.lock:
+                    if url.path == '/mkdir':
+                        if path in storage.dirs or path in storage.files:
+                            return self._send(409)
+                        if parent not in storage.dirs:
+                            return self._send(404)
+                        storage.dirs.add(path)
+                        return self._send(201)
+
+                    if url.path == '/move':
+                        new_path = posixpath.join(parent, query['name'])
+                        if path not in storage.files:
+                            return self._send(404)
+                        if new_path in storage.files:
+                            return self._send(409)
+                        storage.files[new_path] = storage.files.pop(path)
+                        return self._send(201)
+
+                    if url.path == '/uploads':
+                        if path in storage.files:
+                            return self._send(409)
+                        if parent not in storage.dirs:
+                            return self._send(404)
+                        session = uuid.uuid4().hex
+                        storage.sessions[session] = {
+                            'path': path, 'size': int(self.headers['Upload-Length']), 'data': b'',
+                        }
+                        return self._send(201, {'Location': f'files/{session}'})
+
+                self._send(400)
+
+            def do_HEAD(self):
+                with storage.lock:
+                    session = storage.sessions.get(posixpath.basename(self.path))
+                    if session is None:
+                        return self._send(404)
+                    self._send(200, {'Upload-Offset': str(len(session['data']))})
+
+            def do_PATCH(self):
+                chunk = self.rfile.read(int(self.headers['Content-Length']))
+                with storage.lock:
+                    session = storage.sessions.get(posixpath.basename(self.path))
+                    if session is None:
+                        return self._send(404)
+
+                    storage.patches += 1
+                    if storage.patches in storage.fail_patches:
+                        return self._send(500)
+                    if int(self.headers['Upload-Offset']) != len(session['data']):
+                        return self._send(409, {'Upload-Offset': str(len(session['data']))})
+
+                    session['data'] += chunk
+                    if len(session['data']) == session['size']:
+                        storage.files[session['path']] = session['data']
+                    self._send(204, {'Upload-Offset': str(len(session['data']))})
+
+        return Handler
+
+
+class HttpChunkedStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInStorage()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.server.handler())
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.storage = HttpChunkedStorage(f'http://127.0.0.1:{self.httpd.server_port}/', 'token')
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _upload(self, path: str, data: bytes, chunk_size: int) -> list[int]:
+        progress = []
+        session = self.storage.create_upload(path, len(data))
+        self.storage.upload(session, io.BytesIO(data), 0, len(data), chunk_size, progress.append)
+        return progress
+
+    def test_mkdir(self):
+        self.storage.mkdir('rec')
+        self.storage.mkdir('rec/cam')
+        self.assertEqual(self.server.dirs, {'', 'rec', 'rec/cam'})
+
+        with self.assertRaises(DirectoryExistsError):
+            self.storage.mkdir('rec')
+        with self.assertRaises(ParentNotFoundError):
+            self.storage.mkdir('missing/cam')
+
+    def test_chunked_upload(self):
+        self.storage.mkdir('rec')
+        data = os.urandom(2500)
+
+        progress = self._upload('rec/a.tmp', data, chunk_size=1000)
+
+        self.assertEqual(progress, [1000, 2000, 2500])
+        self.assertEqual(self.server.files['rec/a.tmp'], data)
+
+    def test_upload_errors(self):
+        with self.assertRaises(ParentNotFoundError):
+            self.storage.create_upload('missing/a.tmp', 10)
+
+        self.storage.mkdir('rec')
+        self._upload('rec/a.tmp', b'x' * 10, chunk_size=1000)
+        with self.assertRaises(PathExistsError):
+            self.storage.create_upload('rec/a.tmp', 10)
+
+        with self.assertRaises(UploadSessionExpired):
+            self.storage.get_offset(f'{self.storage.url}/files/unknown')
+
+    def test_resume_after_failure(self):
+        self.storage.mkdir('rec')
+        data = os.urandom(3500)
+        session = self.storage.create_upload('rec/a.tmp', len(data))
+
+        self.server.fail_patches = {3}
+        with self.assertRaises(StorageError):
+            self.storage.upload(session, io.BytesIO(data), 0, len(data), 1000, lambda offset: None)
+        self.assertNotIn('rec/a.tmp', self.server.files)
+
+        offset = self.storage.get_offset(session)
+        self.assertEqual(offset, 2000)
+
+        self.storage.upload(session, io.BytesIO(data), offset, len(data), 1000, lambda offset: None)
+        self.assertEqual(self.server.files['rec/a.tmp'], data)
+        # Части до сбоя заново не отправлялись: 2 успешные, 1 с ошибкой и 2 после продолжения
+        self.assertEqual(self.server.patches, 5)
+
+    def test_write_chunk_offset_mismatch(self):
+        self.storage.mkdir('rec')
+        session = self.storage.create_upload('rec/a.tmp', 20)
+        self.storage.write_chunk(session, 0, b'x' * 10)
+
+        # Ответ на прошлую часть потерялся, и она отправляется еще раз: сервер возвращает свое смещение
+        self.assertEqual(self.storage.write_chunk(session, 0, b'x' * 10), 10)
+
+    def test_rename(self):
+        self.storage.mkdir('rec')
+        self._upload('rec/a.tmp', b'a', chunk_size=1000)
+        self._upload('rec/b.tmp', b'b', chunk_size=1000)
+
+        self.storage.rename('rec/a.tmp', 'a.mkv')
+        self.assertEqual(self.server.files['rec/a.mkv'], b'a')
+
+        with self.assertRaises(PathExistsError):
+            self.storage.rename('rec/b.tmp', 'a.mkv')
+        with self.assertRaises(StorageError):
+            self.storage.rename('rec/missing.tmp', 'c.mkv')
+
+
+if __name__ == '__main__':
+    unittest.main()
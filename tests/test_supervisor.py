@@ -0,0 +1,128 @@
+import unittest
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+from server.const import LEASE_HEARTBEAT_SECONDS, SUPERVISOR_MAX_RESTARTS, SUPERVISOR_MAX_RESTART_BACKOFF_SECONDS
+from server.video_recorder.record_launcher import RecordLauncher, RecordManager
+from server.video_recorder.scheduler import RecordScheduler
+from server.video_recorder.supervisor import RecordSupervisor
+
+
+class CrashedProcess:
+    """
+    Процесс записи, который сразу упал.
+    """
+    exitcode = 1
+
+    def is_alive(self):
+        return False
+
+
+class GiveUpTest(unittest.TestCase):
+    KEY = 'videos:cam:0'
+
+    def setUp(self):
+        patcher = mock.patch('server.video_recorder.supervisor.Metrics')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('server.video_recorder.record_launcher.Metrics')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.now = datetime(2026, 1, 1, 12, 0)
+        self.info = {'date_from': '2026-01-01T11:00:00', 'date_to': '2026-01-02T12:00:00'}
+        self.ends_at = datetime(2026, 1, 2, 12, 0)
+
+        self.db = mock.Mock()
+        self.db.release_task.return_value = True
+        self.db.claim_task.return_value = True
+
+        self.manager = RecordManager()
+        self.manager.node_id = 'node'
+        self.manager._supervisor = RecordSupervisor('node', max_recorders=4)
+        self.start = mock.Mock(side_effect=CrashedProcess)
+
+    def _crash_until_given_up(self) -> datetime:
+        supervisor = self.manager._supervisor
+        supervisor.start(self.KEY, self.start, self.ends_at)
+
+        now, released = self.now, False
+        for _ in range(3 * SUPERVISOR_MAX_RESTARTS):
+            released = supervisor.check(self.db, now)
+            if released:
+                break
+            now += timedelta(seconds=SUPERVISOR_MAX_RESTART_BACKOFF_SECONDS)
+
+        self.assertTrue(released)
+        self.assertNotIn(self.KEY, supervisor)
+        self.assertEqual(self.start.call_count, SUPERVISOR_MAX_RESTARTS + 1)
+        return now
+
+    def _resync(self, now: datetime):
+        scheduler = RecordScheduler({'videos': RecordLauncher.get_window})
+        scheduler.rebuild({self.KEY: self.info}, now)
+        for event in scheduler.pop_due(now):
+            self.manager._handle_event(self.db, scheduler, event, now, self.info, {self.KEY})
+
+    def test_given_up_record_is_not_restarted_in_its_window(self):
+        now = self._crash_until_given_up()
+
+        with mock.patch.object(RecordSupervisor, 'can_admit', return_value=True):
+            self._resync(now)
+
+        self.db.claim_task.assert_not_called()
+        self.assertNotIn(self.KEY, self.manager._supervisor)
+
+    def test_given_up_record_is_forgotten_after_its_window(self):
+        self._crash_until_given_up()
+
+        self.assertTrue(self.manager._supervisor.gave_up(self.KEY, self.ends_at - timedelta(seconds=1)))
+        self.assertFalse(self.manager._supervisor.gave_up(self.KEY, self.ends_at))
+
+
+class AdmissionTest(unittest.TestCase):
+    KEY = 'videos:cam:0'
+
+    def setUp(self):
+        patcher = mock.patch('server.video_recorder.record_launcher.Metrics')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.now = datetime(2026, 1, 1, 12, 0)
+        self.info = {'date_from': '2026-01-01T11:00:00', 'date_to': '2026-01-01T13:00:00'}
+
+        self.db = mock.Mock()
+        self.manager = RecordManager()
+        self.manager.node_id = 'node'
+        self.manager._supervisor = RecordSupervisor('node', max_recorders=4)
+
+        self.scheduler = RecordScheduler({'videos': RecordLauncher.get_window})
+        self.scheduler.plan(self.KEY, self.info, self.now)
+
+    def _handle_due(self, now: datetime):
+        for event in self.scheduler.pop_due(now):
+            self.manager._handle_event(self.db, self.scheduler, event, now, self.info, {self.KEY})
+
+    def test_rejected_start_is_retried(self):
+        with mock.patch.object(RecordSupervisor, 'can_admit', return_value=False):
+            self._handle_due(self.now)
+        self.db.claim_task.assert_not_called()
+
+        retry_at = self.now + timedelta(seconds=LEASE_HEARTBEAT_SECONDS)
+        self.assertEqual(self.scheduler.pop_due(retry_at - timedelta(seconds=1)), [])
+
+        self.db.claim_task.return_value = False
+        with mock.patch.object(RecordSupervisor, 'can_admit', return_value=True):
+            self._handle_due(retry_at)
+        self.db.claim_task.assert_called_once_with(self.KEY, 'node')
+
+    def test_rejected_start_is_dropped_after_window(self):
+        event = self.scheduler.pop_due(self.now)[0]
+        self.scheduler.postpone(event, event.ends_at)
+
+        self.assertEqual([e.kind for e in self.scheduler.pop_due(event.ends_at)], ['stop'])
+
+
+if __name__ == '__main__':
+    unittest.main()